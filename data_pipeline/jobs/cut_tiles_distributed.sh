@@ -27,6 +27,7 @@ PICKLE_DIR=$(yq eval ".jobs.$JOB_NAME.PICKLE_DIR" $CONFIG_FILE)
 WINDOW_SIZE=$(yq eval '.GLOBAL.WINDOW_SIZE' $CONFIG_FILE)
 MASK_FILE=$(yq eval ".jobs.$JOB_NAME.MASK_FILE" $CONFIG_FILE)
 OVERWRITE=$(yq eval ".jobs.$JOB_NAME.OVERWRITE" $CONFIG_FILE)
+RAW=$(yq eval ".jobs.$JOB_NAME.RAW" $CONFIG_FILE)
 
 # Modules to load
 MODULES=($(yq eval '.SLURM.MODULES[]' $CONFIG_FILE))
@@ -56,6 +57,9 @@ fi
 if [ "$OVERWRITE" = true ] ; then
     CMD+=" --overwrite"
 fi
+if [ "$RAW" = true ] ; then
+    CMD+=" --raw"
+fi
 
 # Execute the command
 echo $CMD
@@ -0,0 +1,179 @@
+import numpy as np
+from collections import namedtuple
+
+# Per-band rules, by 1-based band number of the 26-band datacube. Mirrored by
+# model_pipeline/src/data/band_rules.py for load-time normalization; keep both in sync.
+BINARIZE_BANDS = range(7, 10)
+PASSTHROUGH_BANDS = list(range(7, 13)) + list(range(19, 26))
+FILL_ZERO_BANDS = range(13, 16)
+LOG1P_BANDS = [1, 2, 3, 26]
+
+# Compiled transform plan. Each *_slices field is a list of slices over the band axis (consecutive
+# bands are merged into one slice), and the arrays hold the float32 constants of those bands in order.
+TransformPlan = namedtuple('TransformPlan', [
+    'num_bands', 'tile_size', 'band_names', 'raw',
+    'binarize_slices',
+    'fill_zero_slices', 'fill_values',
+    'log1p_slices',
+    'standardize_slices', 'means', 'inv_stds',
+])
+
+
+def _to_slices(indexes):
+    """
+    Merge sorted 0-based band indexes into slices of consecutive bands.
+
+    :param indexes: Sorted list of band indexes.
+    :return: List of slices.
+    """
+    slices = []
+    for idx in indexes:
+        if slices and slices[-1].stop == idx:
+            slices[-1] = slice(slices[-1].start, idx + 1)
+        else:
+            slices.append(slice(idx, idx + 1))
+    return slices
+
+
+def _gather(values, slices):
+    """
+    Gather per-band constants into an array of shape (bands, 1, 1) for each slice.
+
+    :param values: Per-band values indexed by 0-based band index.
+    :param slices: List of slices.
+    :return: List of float32 arrays.
+    """
+    return [np.asarray(values[s], dtype=np.float32)[:, None, None] for s in slices]
+
+
+def build_transform_plan(band_names, global_stats_dict, tile_size=256, raw=False):
+    """
+    Compile the per-band transforms of a tile into a plan that can be applied to the whole stack at once.
+
+    Band names are parsed once here instead of for every tile.
+
+    :param band_names: List of band names ("1" to "26"), in band order.
+    :param global_stats_dict: Dictionary containing global statistics for each band.
+    :param tile_size: Size tiles are padded to.
+    :param raw: Only pad the tiles and zero their NaNs, leaving the per-band transforms to load time
+        (see model_pipeline/src/data/normalization.py).
+    :return: TransformPlan.
+    """
+    band_nums = [int(band_name) for band_name in band_names]
+    means = np.array([global_stats_dict[band_name][0] for band_name in band_names], dtype=np.float64)
+    stds = np.array([global_stats_dict[band_name][1] for band_name in band_names], dtype=np.float64)
+
+    binarize = [b for b, num in enumerate(band_nums) if num in BINARIZE_BANDS]
+    fill_zero = [b for b, num in enumerate(band_nums) if num in FILL_ZERO_BANDS]
+    log1p = [b for b, num in enumerate(band_nums) if num in LOG1P_BANDS]
+    standardize = [b for b, num in enumerate(band_nums) if num not in PASSTHROUGH_BANDS and stds[b] != 0]
+    if raw:
+        binarize, fill_zero, log1p, standardize = [], [], [], []
+
+    fill_zero_slices = _to_slices(fill_zero)
+    standardize_slices = _to_slices(standardize)
+
+    return TransformPlan(
+        num_bands=len(band_names),
+        tile_size=tile_size,
+        band_names=list(band_names),
+        raw=raw,
+        binarize_slices=_to_slices(binarize),
+        fill_zero_slices=fill_zero_slices,
+        fill_values=_gather(means, fill_zero_slices),
+        log1p_slices=_to_slices(log1p),
+        standardize_slices=standardize_slices,
+        means=_gather(means, standardize_slices),
+        inv_stds=_gather(1 / np.where(stds != 0, stds, 1), standardize_slices),
+    )
+
+
+def apply_transform_plan(tile, plan, out=None):
+    """
+    Pad a tile to the plan's tile size and apply the compiled per-band transforms in place.
+
+    The transforms are, in order: NaN to zero, binarization, zero-fill with the band mean,
+    log1p and standardization with the global statistics. Bands without a rule are passed through.
+
+    :param tile: Array of shape (bands, rows, cols) with rows, cols <= plan.tile_size.
+    :param plan: TransformPlan from `build_transform_plan`.
+    :param out: Optional float32 array of shape (bands, tile_size, tile_size) to write into.
+    :return: The processed float32 array.
+    """
+    shape = (plan.num_bands, plan.tile_size, plan.tile_size)
+    if out is None:
+        out = np.empty(shape, dtype=np.float32)
+
+    rows, cols = tile.shape[1:]
+    out[:, :rows, :cols] = tile
+    out[:, rows:, :] = 0
+    out[:, :rows, cols:] = 0
+
+    np.nan_to_num(out, copy=False)
+
+    for s in plan.binarize_slices:
+        view = out[s]
+        view[...] = view > 0
+
+    for s, fill in zip(plan.fill_zero_slices, plan.fill_values):
+        view = out[s]
+        np.copyto(view, fill, where=(view == 0))
+
+    for s in plan.log1p_slices:
+        np.log1p(out[s], out=out[s])
+
+    for s, mean, inv_std in zip(plan.standardize_slices, plan.means, plan.inv_stds):
+        view = out[s]
+        view -= mean
+        view *= inv_std
+
+    return out
+
+
+def process_bands_in_tile(tile, band_names, global_stats_dict):
+    """
+    Reference implementation of the per-band transforms, processing one band at a time in float64.
+
+    Kept to check `apply_transform_plan` against (see utility/check_transform_plan.py).
+
+    :param tile: A numpy array representing the tile.
+    :param band_names: List of band names.
+    :param global_stats_dict: Dictionary containing global statistics for each band.
+    :return: Processed numpy array.
+    """
+    processed_bands = []
+    num_bands = tile.shape[0]
+
+    # Pad tile to standard size if required
+    if tile.shape[1:] != (256, 256):
+        pad_rows = 256 - tile.shape[1]
+        pad_cols = 256 - tile.shape[2]
+        tile = np.pad(tile, ((0, 0), (0, pad_rows), (0, pad_cols)), mode='constant')
+
+    for b in range(num_bands):
+        band_name = band_names[b]
+        band = tile[b, :, :]
+        mean, std, _, _, _ = global_stats_dict[band_name]
+
+        band = np.nan_to_num(band)
+        band_name_int = int(band_name)
+
+        if 7 <= band_name_int < 10:
+            band = (band > 0).astype(np.float64)
+
+        if (7 <= band_name_int < 13) or (19 <= band_name_int < 26):
+            processed_bands.append(band)
+            continue
+
+        if 13 <= band_name_int < 16:
+            band[band == 0] = mean
+
+        if (band_name_int == 26) or (1 <= band_name_int < 4):
+            band = np.log1p(band)
+
+        if std != 0:
+            band = (band - mean) / std
+
+        processed_bands.append(band)
+
+    return np.array(processed_bands)
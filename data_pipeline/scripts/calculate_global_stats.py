@@ -1,5 +1,9 @@
 import os
+import json
+import uuid
+import shutil
 import argparse
+import hashlib
 import numpy as np
 import rasterio
 from rasterio.windows import Window
@@ -7,110 +11,641 @@ from rasterio.features import geometry_mask
 import geopandas as gpd
 from shapely.geometry import box
 import pickle
+import glob
+from functools import partial
 from tqdm import tqdm
-from concurrent.futures import ProcessPoolExecutor
+from fingerprint import file_fingerprint, params_fingerprint
+from windows import plan_windows, windowed_imap, block_shape
 
-def process_window(file_path, window, nodata, geometries=None):
+# Name of the single stats artifact written in multi-band mode
+GLOBAL_STATS_FILE = 'global_stats.pkl'
+
+# Sub-directory of the output directory holding rasterized cutline masks
+MASK_CACHE_DIR = 'cutline_masks'
+
+# Sub-directory of the output directory holding per-window partial aggregates
+PARTIALS_DIR = 'partials'
+
+# File of a partials directory recording the raster (path and fingerprint) its partials belong to
+PARTIALS_SOURCE_FILE = 'source.json'
+
+# Single artifact holding the value sketches of every band in multi-band mode
+GLOBAL_SKETCH_FILE = 'global_sketch.npz'
+
+# Relative accuracy of the log-bucketed value sketch, and the range of magnitudes it resolves.
+# Magnitudes below SKETCH_MIN_VALUE fall in the zero bucket, those above SKETCH_MAX_VALUE in the last bucket.
+SKETCH_ALPHA = 0.01
+SKETCH_MIN_VALUE = 1e-9
+SKETCH_MAX_VALUE = 1e12
+SKETCH_GAMMA = (1 + SKETCH_ALPHA) / (1 - SKETCH_ALPHA)
+_SKETCH_K_MIN = int(np.ceil(np.log(SKETCH_MIN_VALUE) / np.log(SKETCH_GAMMA)))
+_SKETCH_K_MAX = int(np.ceil(np.log(SKETCH_MAX_VALUE) / np.log(SKETCH_GAMMA)))
+_SKETCH_K_COUNT = _SKETCH_K_MAX - _SKETCH_K_MIN + 1
+# Bins are ordered by value: negative buckets (largest magnitude first), zero, positive buckets
+SKETCH_BINS = 2 * _SKETCH_K_COUNT + 1
+
+# Memory-mapped cutline masks opened by this (worker) process, keyed by path
+_open_masks = {}
+
+# Raster read by this (worker) process, kept open across its windows by `open_raster`
+_open_raster = None
+
+# Number of bytes of a window read at once by `process_window`, across all bands
+READ_BUDGET_BYTES = 64 * 2 ** 20
+
+
+def empty_moments(num_bands):
     """
-    Process a given window from a raster file and return statistics.
+    Create an empty set of per-band partial moments.
 
     Args:
-        file_path (str): Path to the raster file.
-        window (Window): Window object to process from the raster.
-        nodata (float): Value indicating no data in the raster.
-        geometries (list, optional): List of geometries for masking. Defaults to None.
+        num_bands (int): Number of bands to track.
 
     Returns:
-        tuple: Comprising of sum of values, sum of squared values, number of valid data points, min value and max value.
+        tuple: Comprising of count, mean, M2 (sum of squared deviations), min value and max value arrays.
     """
+    return (np.zeros(num_bands, dtype=np.int64),
+            np.zeros(num_bands, dtype=np.float64),
+            np.zeros(num_bands, dtype=np.float64),
+            np.full(num_bands, np.inf),
+            np.full(num_bands, -np.inf))
+
+
+def merge_moments(a, b):
+    """
+    Merge two sets of per-band partial moments using the parallel Welford/Chan update.
+
+    Args:
+        a (tuple): Partial moments as returned by `empty_moments` or `process_window`.
+        b (tuple): Partial moments to merge into `a`.
+
+    Returns:
+        tuple: The combined partial moments.
+    """
+    n_a, mean_a, m2_a, min_a, max_a = a
+    n_b, mean_b, m2_b, min_b, max_b = b
+
+    n = n_a + n_b
+    safe_n = np.where(n > 0, n, 1)
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (n_b / safe_n)
+    m2 = m2_a + m2_b + delta ** 2 * (n_a * (n_b / safe_n))
+
+    return n, mean, m2, np.minimum(min_a, min_b), np.maximum(max_a, max_b)
+
+
+def finalize_moments(moments):
+    """
+    Convert per-band partial moments into mean and (population) standard deviation.
+
+    Args:
+        moments (tuple): Partial moments.
+
+    Returns:
+        tuple: Comprising of count, mean, standard deviation, min value and max value arrays.
+    """
+    n, mean, m2, min_val, max_val = moments
+    safe_n = np.where(n > 0, n, 1)
+    std_dev = np.sqrt(m2 / safe_n)
+    mean = np.where(n > 0, mean, np.nan)
+    std_dev = np.where(n > 0, std_dev, np.nan)
+    return n, mean, std_dev, min_val, max_val
+
+
+def block_moments(data, valid):
+    """
+    Compute per-band partial moments of a block of data.
+
+    Args:
+        data (np.ndarray): Array of shape (bands, rows, cols).
+        valid (np.ndarray): Boolean array of the same shape marking valid pixels.
+
+    Returns:
+        tuple: Partial moments of the valid pixels of each band.
+    """
+    data = data.reshape(data.shape[0], -1)
+    valid = valid.reshape(valid.shape[0], -1)
+
+    # Masked reductions, so the only full-size temporary is the squared deviation
+    n = np.count_nonzero(valid, axis=1)
+    safe_n = np.where(n > 0, n, 1)
+    mean = np.add.reduce(data, axis=1, where=valid) / safe_n
+    deviation = data - mean[:, None]
+    deviation *= deviation
+    m2 = np.add.reduce(deviation, axis=1, where=valid)
+    min_val = np.minimum.reduce(data, axis=1, where=valid, initial=np.inf)
+    max_val = np.maximum.reduce(data, axis=1, where=valid, initial=-np.inf)
+
+    return n, mean, m2, min_val, max_val
+
+
+def sketch_bins(values):
+    """
+    Map values to the bins of the fixed log-bucketed value sketch.
+
+    Args:
+        values (np.ndarray): Array of values.
+
+    Returns:
+        np.ndarray: Bin index of each value.
+    """
+    magnitude = np.abs(values)
+    with np.errstate(divide='ignore'):
+        k = np.ceil(np.log(np.clip(magnitude, SKETCH_MIN_VALUE, SKETCH_MAX_VALUE)) / np.log(SKETCH_GAMMA))
+    k = k.astype(np.int64) - _SKETCH_K_MIN
+
+    bins = np.where(values > 0, _SKETCH_K_COUNT + 1 + k, _SKETCH_K_COUNT - 1 - k)
+    return np.where(magnitude < SKETCH_MIN_VALUE, _SKETCH_K_COUNT, bins)
+
+
+def sketch_bin_values():
+    """
+    Get the representative value of every bin of the value sketch.
+
+    Returns:
+        np.ndarray: Array of length SKETCH_BINS, within SKETCH_ALPHA relative error of any value in the bin.
+    """
+    k = np.arange(_SKETCH_K_MIN, _SKETCH_K_MAX + 1)
+    positive = 2 * SKETCH_GAMMA ** k / (SKETCH_GAMMA + 1)
+    return np.concatenate([-positive[::-1], [0.0], positive])
+
+
+def block_sketch(data, valid):
+    """
+    Compute the per-band value sketch of a block of data.
+
+    The sketch is a fixed-bin histogram over log-spaced buckets, so sketches of different
+    windows, files or ranks are merged by simply adding them.
+
+    Args:
+        data (np.ndarray): Array of shape (bands, rows, cols).
+        valid (np.ndarray): Boolean array of the same shape marking valid pixels.
+
+    Returns:
+        np.ndarray: Array of shape (bands, SKETCH_BINS) with the bin counts of each band.
+    """
+    return np.stack([np.bincount(sketch_bins(data[b][valid[b]]), minlength=SKETCH_BINS)
+                     for b in range(data.shape[0])])
+
+
+def sparse_sketch(sketch):
+    """
+    Convert a dense value sketch to its non-zero (band, bin, count) entries.
+
+    Sketches are mostly empty, so windows keep only these entries in memory and on disk.
+
+    Args:
+        sketch (np.ndarray): Array of shape (bands, SKETCH_BINS) of bin counts.
+
+    Returns:
+        tuple: Int32 band and bin indexes and int64 counts of the non-zero bins.
+    """
+    bands, bins = np.nonzero(sketch)
+    return bands.astype(np.int32), bins.astype(np.int32), sketch[bands, bins]
+
+
+def add_sparse_sketch(total, sketch):
+    """
+    Add the entries of a sparse value sketch to a dense one.
+
+    Args:
+        total (np.ndarray): Dense (bands, SKETCH_BINS) sketch, updated in place.
+        sketch (tuple): Sparse sketch as returned by `sparse_sketch`, with each (band, bin) at most once.
+    """
+    bands, bins, counts = sketch
+    total[bands, bins] += counts
+
+
+def sketch_quantile(sketch, q, min_val=-np.inf, max_val=np.inf):
+    """
+    Approximate quantiles of a band from its value sketch.
+
+    Args:
+        sketch (np.ndarray): Bin counts of one band.
+        q (float or list): Quantile(s) in [0, 1].
+        min_val (float, optional): Exact minimum of the band, used to clip the estimate. Defaults to -inf.
+        max_val (float, optional): Exact maximum of the band, used to clip the estimate. Defaults to inf.
+
+    Returns:
+        np.ndarray: Approximate quantile value(s).
+    """
+    cumulative = np.cumsum(sketch)
+    if cumulative[-1] == 0:
+        return np.full(np.shape(q), np.nan)
+
+    rank = np.asarray(q) * (cumulative[-1] - 1)
+    bins = np.searchsorted(cumulative, rank, side='right')
+    return np.clip(sketch_bin_values()[bins], min_val, max_val)
+
+
+def cached_percentile(band_name, pickle_dir, q):
+    """
+    Look up approximate percentiles of a band from the stats cache, without reading the raster.
+
+    Args:
+        band_name (str): Name of the band, i.e. the file number (or band number in multi-band mode).
+        pickle_dir (str): Directory containing the cached statistics.
+        q (float or list): Percentile(s) in [0, 100].
+
+    Returns:
+        np.ndarray: Approximate percentile value(s).
+    """
+    sketch_path = os.path.join(pickle_dir, f"{band_name}_sketch.npy")
+    stats_path = os.path.join(pickle_dir, f"{band_name}.pkl")
+
+    if os.path.exists(sketch_path) and os.path.exists(stats_path):
+        sketch = np.load(sketch_path)
+        with open(stats_path, 'rb') as cache_file:
+            _, _, min_val, max_val, _ = pickle.load(cache_file)
+    elif os.path.exists(os.path.join(pickle_dir, GLOBAL_SKETCH_FILE)):
+        with np.load(os.path.join(pickle_dir, GLOBAL_SKETCH_FILE)) as sketches:
+            sketch = sketches[band_name]
+        with open(os.path.join(pickle_dir, GLOBAL_STATS_FILE), 'rb') as cache_file:
+            _, _, min_val, max_val, _ = pickle.load(cache_file)[band_name]
+    else:
+        raise FileNotFoundError(f"No cached sketch found for band {band_name} in directory {pickle_dir}")
+
+    return sketch_quantile(sketch, np.asarray(q) / 100, min_val, max_val)
+
+
+def cutline_mask_path(geometries, file_path, cache_dir):
+    """
+    Get the cache path of the rasterized cutline for a raster grid.
+
+    The path is keyed by a hash of the geometries and of the raster's transform, shape and CRS,
+    so rasters sharing a grid share the same mask.
+
+    Args:
+        geometries (list): List of geometries for masking.
+        file_path (str): Path to a raster file on the target grid.
+        cache_dir (str): Directory holding the cached masks.
+
+    Returns:
+        str: Path to the cached mask file.
+    """
+    digest = hashlib.sha1()
+    for geom in geometries:
+        digest.update(geom.wkb)
 
     with rasterio.open(file_path) as src:
-        data = src.read(1, window=window).astype(np.float64)
+        digest.update(repr((tuple(src.transform), src.height, src.width, str(src.crs))).encode())
+
+    return os.path.join(cache_dir, f"cutline_{digest.hexdigest()[:16]}.npy")
+
+
+def rasterize_cutline(geometries, file_path, cache_dir, strip_rows=2048):
+    """
+    Rasterize the cutline geometries once onto the grid of a raster file.
+
+    The mask is bit-packed along the columns (one bit per pixel) and stored as a .npy file that
+    workers memory-map and slice. Rasterization runs strip by strip so the full-resolution mask
+    never has to be held in memory. An existing mask for the same geometries and grid is reused.
+
+    Args:
+        geometries (list): List of geometries for masking.
+        file_path (str): Path to a raster file on the target grid.
+        cache_dir (str): Directory holding the cached masks.
+        strip_rows (int, optional): Number of rows rasterized at a time. Defaults to 2048.
+
+    Returns:
+        str: Path to the cached mask file.
+    """
+    mask_path = cutline_mask_path(geometries, file_path, cache_dir)
+    if os.path.exists(mask_path):
+        return mask_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{mask_path}.{os.getpid()}.tmp.npy"
+
+    with rasterio.open(file_path) as src:
+        height, width = src.height, src.width
+        packed = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                           shape=(height, (width + 7) // 8))
+
+        for row in tqdm(range(0, height, strip_rows), desc='Rasterizing cutline', leave=False):
+            window = Window(0, row, width, min(strip_rows, height - row))
+            strip_box = box(*src.window_bounds(window))
+            strip_geometries = [geom for geom in geometries if strip_box.intersects(geom)]
+
+            if not strip_geometries:
+                packed[row:row + window.height] = 0
+                continue
 
-        if geometries:
-            geom_window = box(*src.window_bounds(window))
-            valid_geometries = [geom for geom in geometries if geom.is_valid]
-            intersected_geometries = [geom_window.intersection(geom) for geom in valid_geometries if geom_window.intersects(geom)]
-            
-            # Ensure only valid intersected geometries are used
-            intersected_geometries = [geom for geom in intersected_geometries if geom.is_valid]
-
-            # Check if intersected geometries list is empty
-            if not intersected_geometries:
-                return np.float64(0), np.float64(0), 0, np.inf, -np.inf
-            
             mask = geometry_mask(
-                intersected_geometries,
+                strip_geometries,
                 transform=src.window_transform(window),
                 invert=True,
-                out_shape=data.shape)
-            data[~mask] = nodata
+                out_shape=(window.height, width))
+            packed[row:row + window.height] = np.packbits(mask, axis=1)
 
-        valid_data = data[data != nodata].astype(np.float64)
-        valid_data = np.nan_to_num(valid_data)
+        packed.flush()
+        del packed
 
-        sum_x = np.sum(valid_data)
-        sum_x2 = np.sum(valid_data**2)
-        n = valid_data.size
-        min_val = np.min(valid_data) if valid_data.size > 0 else np.inf
-        max_val = np.max(valid_data) if valid_data.size > 0 else -np.inf
+    os.replace(tmp_path, mask_path)
+    return mask_path
 
-        return sum_x, sum_x2, n, min_val, max_val
 
+def read_cutline_mask(mask_path, window):
+    """
+    Read the part of a rasterized cutline covering a window.
 
+    Args:
+        mask_path (str): Path to the mask written by `rasterize_cutline`.
+        window (Window): Window to read.
 
+    Returns:
+        np.ndarray: Boolean array of shape (window.height, window.width), True inside the cutline.
+    """
+    if mask_path not in _open_masks:
+        _open_masks[mask_path] = np.load(mask_path, mmap_mode='r')
+    packed = _open_masks[mask_path]
 
-def cache_global_stats(file_path, output_dir, file_num, geometries=None, chunk_size=2048, overwrite=False):
+    row, col = int(window.row_off), int(window.col_off)
+    height, width = int(window.height), int(window.width)
+    first_byte, last_byte = col // 8, (col + width + 7) // 8
+
+    bits = np.unpackbits(packed[row:row + height, first_byte:last_byte], axis=1)
+    offset = col - first_byte * 8
+    return bits[:, offset:offset + width].astype(bool)
+
+
+def partials_path(output_dir, file_path, mask_path=None, indexes=None, chunk_size=2048):
     """
-    Cache global statistics of a given raster file.
+    Get the directory of the per-window partial aggregates of a raster file.
+
+    The directory is keyed by the fingerprint of the file and by everything else that affects
+    the aggregates (cutline mask, bands read and window size), so a changed raster gets a new set
+    of partials while unchanged rasters keep reusing theirs.
 
     Args:
-        file_path (str): Path to the raster file.
         output_dir (str): Directory to save the pickle files.
-        file_num (int): Index number for the file (for naming).
-        geometries (list, optional): List of geometries for masking. Defaults to None.
-        chunk_size (int, optional): Size of the chunks to split the raster into. Defaults to 2048.
-        overwrite (bool, optional): Overwrite existing cache files if present. Defaults to False.
+        file_path (str): Path to the raster file.
+        mask_path (str, optional): Path to the rasterized cutline mask. Defaults to None.
+        indexes (list, optional): 1-based band indexes read. Defaults to the first band.
+        chunk_size (int, optional): Size of the chunks the raster is split into. Defaults to 2048.
+
+    Returns:
+        str: Path to the partials directory.
     """
-    cache_file_path = os.path.join(output_dir, f"{file_num}.pkl")
-    print(f"Processing: {file_path}")
+    key = params_fingerprint(file_fingerprint(file_path), os.path.basename(mask_path or ''),
+                             list(indexes or [1]), chunk_size, SKETCH_ALPHA)
+    return os.path.join(output_dir, PARTIALS_DIR, key[:24])
 
-    if os.path.exists(cache_file_path) and not overwrite:
-        with open(cache_file_path, 'rb') as cache_file:
-            return pickle.load(cache_file)
 
+def prepare_partials(partials_dir, file_path, overwrite=False):
+    """
+    Create the partials directory of a raster file and prune the partials it supersedes.
 
-    sum_x = np.float64(0)
-    sum_x2 = np.float64(0)
-    n = 0
-    n_all = 0
-    min_val = np.inf
-    max_val = -np.inf
+    The partials of earlier versions of the same file (same path, other fingerprint), and those
+    of files that no longer exist, are deleted. Partials of the same file read with other
+    parameters (cutline, bands or window size) are kept.
 
-    with rasterio.open(file_path) as src:
-        num_cols, num_rows = src.shape
-        band_name = src.descriptions[0]
-        nodata = src.nodatavals[0]
+    Args:
+        partials_dir (str): Partials directory of the file, from `partials_path`.
+        file_path (str): Path to the raster file.
+        overwrite (bool, optional): Also delete the partials of the current version. Defaults to False.
+    """
+    source = {'file': os.path.abspath(file_path), 'fingerprint': file_fingerprint(file_path)}
+    for source_file in glob.glob(os.path.join(os.path.dirname(partials_dir), '*', PARTIALS_SOURCE_FILE)):
+        other_dir = os.path.dirname(source_file)
+        if other_dir == partials_dir:
+            continue
+        try:
+            with open(source_file) as f:
+                other = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            continue
+        if not os.path.exists(other['file']) or (other['file'] == source['file']
+                                                 and other['fingerprint'] != source['fingerprint']):
+            shutil.rmtree(other_dir, ignore_errors=True)
 
-    windows = [(i, j, Window(j, i, min(chunk_size, num_cols - j), min(chunk_size, num_rows - i))) for i in range(0, num_rows, chunk_size) for j in range(0, num_cols, chunk_size)]
-    
-    if geometries:
-        valid_geometries = [geom for geom in geometries if geom.is_valid]
+    if overwrite:
+        shutil.rmtree(partials_dir, ignore_errors=True)
+    os.makedirs(partials_dir, exist_ok=True)
+    with open(os.path.join(partials_dir, PARTIALS_SOURCE_FILE), 'w') as f:
+        json.dump(source, f)
 
-    with ProcessPoolExecutor() as executor:
-        results = list(executor.map(process_window, [file_path]*len(windows), [w for _, _, w in windows], [nodata]*len(windows), [valid_geometries]*len(windows)))
 
-    for r in results:
-        sum_x_single, sum_x2_single, n_single, min_val_single, max_val_single = r
-        sum_x += sum_x_single
-        sum_x2 += sum_x2_single
-        n += n_single
-        min_val = min(min_val, min_val_single)
-        max_val = max(max_val, max_val_single)
-    
-    mean = sum_x / n
-    std_dev = np.sqrt((sum_x2 / n) - (mean ** 2))
+def save_partials(partials_dir, windows, writer):
+    """
+    Persist the partial aggregates of newly processed windows as a new part file of a partials directory.
+
+    Part files are only ever added, each holding the windows of one checkpoint, so a checkpoint
+    costs the size of its own windows. Sketches are stored sparsely as (window, band, bin, count).
+
+    Args:
+        partials_dir (str): Partials directory.
+        windows (list): List of (window key, moments, sparse sketch) of the new windows.
+        writer (str): Name of the writing process (e.g. its rank), part of the file name.
+    """
+    moments = [m for _, m, _ in windows]
+    sketches = [sketch for _, _, sketch in windows]
+    name = f"part-{writer}-{uuid.uuid4().hex[:12]}"
+    tmp_path = os.path.join(partials_dir, f"{name}.tmp.npz")
+    np.savez(tmp_path,
+             windows=np.array([key for key, _, _ in windows], dtype=np.int64),
+             n=np.stack([m[0] for m in moments]),
+             mean=np.stack([m[1] for m in moments]),
+             m2=np.stack([m[2] for m in moments]),
+             min=np.stack([m[3] for m in moments]),
+             max=np.stack([m[4] for m in moments]),
+             sketch_window=np.concatenate([np.full(len(sketch[0]), k, dtype=np.int32)
+                                           for k, sketch in enumerate(sketches)]),
+             sketch_band=np.concatenate([sketch[0] for sketch in sketches]),
+             sketch_bin=np.concatenate([sketch[1] for sketch in sketches]),
+             sketch_count=np.concatenate([sketch[2] for sketch in sketches]))
+    os.replace(tmp_path, os.path.join(partials_dir, f"{name}.npz"))
+
 
+def merge_saved_partials(partials_dir, keys, moments, sketch):
+    """
+    Merge the persisted partial aggregates of the given windows into running totals.
+
+    Windows are read part by part and merged as they are read, so no more than one part file is
+    held in memory. A window stored in several parts is merged once.
+
+    Args:
+        partials_dir (str): Partials directory.
+        keys (set): Keys of the windows to merge; windows of other keys are skipped.
+        moments (tuple): Running partial moments.
+        sketch (np.ndarray): Running dense (bands, SKETCH_BINS) sketch, updated in place.
+
+    Returns:
+        tuple: The updated moments and the set of keys of the merged windows.
+    """
+    merged = set()
+    parts = [path for path in glob.glob(os.path.join(partials_dir, 'part-*.npz')) if not path.endswith('.tmp.npz')]
+    for part in sorted(parts):
+        with np.load(part) as f:
+            fields = {name: f[name] for name in f.files}
+        # Sketch entries are stored grouped by window, in window order
+        bounds = np.searchsorted(fields['sketch_window'], np.arange(len(fields['windows']) + 1))
+        for k, key in enumerate(map(tuple, fields['windows'].tolist())):
+            if key not in keys or key in merged:
+                continue
+            merged.add(key)
+            moments = merge_moments(moments, tuple(fields[name][k] for name in ('n', 'mean', 'm2', 'min', 'max')))
+            entries = slice(bounds[k], bounds[k + 1])
+            add_sparse_sketch(sketch, (fields['sketch_band'][entries], fields['sketch_bin'][entries],
+                                       fields['sketch_count'][entries]))
+    return moments, merged
+
+
+def open_raster(file_path):
+    """
+    Get the open dataset of a raster in this process, opening it (and closing the previous one) if needed.
+
+    Used as the initializer of the worker pool, so each worker opens the raster once for all
+    its windows.
+
+    Args:
+        file_path (str): Path to the raster file.
+
+    Returns:
+        rasterio.DatasetReader: The open raster.
+    """
+    global _open_raster
+    if _open_raster is None or _open_raster.name != file_path:
+        if _open_raster is not None:
+            _open_raster.close()
+        _open_raster = rasterio.open(file_path)
+    return _open_raster
+
+
+def process_window(file_path, window, nodata, mask_path=None, indexes=None):
+    """
+    Process a given window from a raster file and return per-band partial moments and value sketches.
+
+    The window is read once across all bands, in strips of whole blocks holding at most
+    READ_BUDGET_BYTES, so each compressed block is decoded once and memory stays bounded
+    whatever the number of bands. Each band of a strip is cast to float64 on its own.
+
+    Args:
+        file_path (str): Path to the raster file.
+        window (Window): Window object to process from the raster.
+        nodata (list): No-data value of each band read.
+        mask_path (str, optional): Path to the rasterized cutline mask. Defaults to None.
+        indexes (list, optional): 1-based band indexes to read. Defaults to the first band.
+
+    Returns:
+        tuple: Comprising of the partial moments (count, mean, M2, min value and max value arrays,
+            one entry per band) and the sparse (bands, SKETCH_BINS) value sketch (see `sparse_sketch`).
+    """
+    indexes = indexes or [1]
+    moments = empty_moments(len(indexes))
+    sketch = np.zeros((len(indexes), SKETCH_BINS), dtype=np.int64)
+
+    mask = None
+    if mask_path:
+        mask = read_cutline_mask(mask_path, window)
+        # Skip reading windows entirely outside the cutline
+        if not mask.any():
+            return moments, sparse_sketch(sketch)
+
+    src = open_raster(file_path)
+    height, width = int(window.height), int(window.width)
+    block_rows = block_shape(src)[0]
+    row_bytes = width * sum(np.dtype(src.dtypes[index - 1]).itemsize for index in indexes)
+    strip_rows = max(1, READ_BUDGET_BYTES // (row_bytes * block_rows)) * block_rows
+
+    for row in range(0, height, strip_rows):
+        rows = min(strip_rows, height - row)
+        strip = src.read(indexes, window=Window(window.col_off, window.row_off + row, width, rows))
+        strip_moments = []
+        for b, value in enumerate(nodata):
+            data = strip[b].astype(np.float64)[None]
+            valid = np.ones(data.shape, dtype=bool) if mask is None else mask[None, row:row + rows].copy()
+            if value is not None:
+                valid &= data != value
+            np.nan_to_num(data, copy=False)
+            strip_moments.append(block_moments(data, valid))
+            sketch[b] += block_sketch(data, valid)[0]
+        moments = merge_moments(moments, tuple(np.concatenate(parts) for parts in zip(*strip_moments)))
+
+    return moments, sparse_sketch(sketch)
+
+
+def window_key(window):
+    """Key identifying a window in the persisted partials."""
+    return int(window.col_off), int(window.row_off), int(window.width), int(window.height)
+
+
+def reduce_windows(file_path, windows, nodata, mask_path=None, indexes=None, partials_dir=None,
+                   checkpoint_every=64, writer=None):
+    """
+    Process all windows of a raster file in parallel and merge their partial moments and sketches.
+
+    If a partials directory is given, windows already persisted in it (by any earlier run,
+    single-node or MPI) are merged from there instead of being read again. Newly processed
+    windows are added to it as a new part file every `checkpoint_every` windows, so an
+    interrupted run resumes where it stopped. Results are merged into running totals as they
+    arrive, so memory does not grow with the number of windows.
+
+    Args:
+        file_path (str): Path to the raster file.
+        windows (list): List of Window objects to merge.
+        nodata (list): No-data value of each band read.
+        mask_path (str, optional): Path to the rasterized cutline mask. Defaults to None.
+        indexes (list, optional): 1-based band indexes to read. Defaults to the first band.
+        partials_dir (str, optional): Partials directory, from `partials_path`. Defaults to None.
+        checkpoint_every (int, optional): Number of windows between checkpoints. Defaults to 64.
+        writer (str, optional): Name of this process in the part files. Defaults to its pid.
+
+    Returns:
+        tuple: The merged partial moments, dense value sketch of all windows, and number of windows read.
+    """
+    indexes = indexes or [1]
+    writer = writer or f"pid{os.getpid()}"
+    moments = empty_moments(len(indexes))
+    sketch = np.zeros((len(indexes), SKETCH_BINS), dtype=np.int64)
+
+    merged = set()
+    if partials_dir:
+        moments, merged = merge_saved_partials(partials_dir, {window_key(w) for w in windows}, moments, sketch)
+    missing = [w for w in windows if window_key(w) not in merged]
+    if not missing:
+        return moments, sketch, 0
+
+    print(f"Reusing {len(windows) - len(missing)} and computing {len(missing)} windows of {file_path}")
+    task = partial(process_window, file_path, nodata=nodata, mask_path=mask_path, indexes=indexes)
+    pending = []
+    results = windowed_imap(task, missing, initializer=open_raster, initargs=(file_path,))
+    for window, (window_moments, window_sketch) in tqdm(zip(missing, results),
+                                                        total=len(missing), desc=os.path.basename(file_path),
+                                                        leave=False):
+        moments = merge_moments(moments, window_moments)
+        add_sparse_sketch(sketch, window_sketch)
+        if partials_dir:
+            pending.append((window_key(window), window_moments, window_sketch))
+            if len(pending) >= checkpoint_every:
+                save_partials(partials_dir, pending, writer)
+                pending = []
+    if pending:
+        save_partials(partials_dir, pending, writer)
+
+    return moments, sketch, len(missing)
+
+
+def write_file_stats(output_dir, file_num, file_path, moments, sketch, band_name, nodata, shape):
+    """
+    Finalize the merged aggregates of a single-band raster, print them and write its cache files.
+
+    Args:
+        output_dir (str): Directory to save the pickle files.
+        file_num (int): Index number for the file (for naming).
+        file_path (str): Path to the raster file.
+        moments (tuple): Merged partial moments of the band.
+        sketch (np.ndarray): Merged (1, SKETCH_BINS) value sketch of the band.
+        band_name (str): Description of the band.
+        nodata (float): No-data value of the band.
+        shape (tuple): Number of rows and columns of the raster.
+
+    Returns:
+        tuple: Comprising of mean, standard deviation, min value, max value and band name.
+    """
+    num_rows, num_cols = shape
+    n, mean, std_dev, min_val, max_val = (v[0] for v in finalize_moments(moments))
+    p1, p50, p99 = sketch_quantile(sketch[0], [0.01, 0.5, 0.99], min_val, max_val)
 
     print(f"File: {file_path}")
     print(f"Shape: {num_rows}x{num_cols}")
@@ -118,17 +653,146 @@ def cache_global_stats(file_path, output_dir, file_num, geometries=None, chunk_s
     print(f"Mean: {mean}")
     print(f"Standard Deviation: {std_dev}")
     print(f"Total valid data points: {n}")
-    print(f"Total data points: {n_all}")
+    print(f"Total data points: {num_rows * num_cols}")
     print(f"Min value: {min_val}")
     print(f"Max value: {max_val}")
-    print(f"Sum of all values: {sum_x}")
-    print(f"Sum of squares of all values: {sum_x2}")
-    
+    print(f"Percentiles (1, 50, 99): {p1}, {p50}, {p99}")
+
+    np.save(os.path.join(output_dir, f"{file_num}_sketch.npy"), sketch[0])
+
+    stats = (mean, std_dev, min_val, max_val, band_name)
+    with open(os.path.join(output_dir, f"{file_num}.pkl"), 'wb') as cache_file:
+        pickle.dump(stats, cache_file)
+    return stats
+
+
+def add_band_stats(global_stats, global_sketch, moments, sketch, descriptions):
+    """
+    Finalize the merged aggregates of every band of a multi-band raster and add them to the
+    global statistics, numbering bands consecutively after those already added.
+
+    Args:
+        global_stats (dict): Band name to (mean, std, min, max, band description), updated in place.
+        global_sketch (dict): Band name to value sketch, updated in place.
+        moments (tuple): Merged partial moments of the raster's bands.
+        sketch (np.ndarray): Merged (bands, SKETCH_BINS) value sketch of the raster's bands.
+        descriptions (list): Description of each band.
+    """
+    n, mean, std_dev, min_val, max_val = finalize_moments(moments)
+    for b in range(len(descriptions)):
+        band_num = len(global_stats) + 1
+        global_stats[str(band_num)] = (mean[b], std_dev[b], min_val[b], max_val[b], descriptions[b])
+        global_sketch[str(band_num)] = sketch[b]
+        print(f"Band {band_num} ({descriptions[b]}): mean={mean[b]}, std={std_dev[b]}, "
+              f"min={min_val[b]}, max={max_val[b]}, valid={n[b]}")
+
+
+def write_multiband_stats(output_dir, global_stats, global_sketch):
+    """
+    Write the statistics and value sketches of all bands to the single multi-band artifacts.
+
+    Args:
+        output_dir (str): Directory to save the stats artifact.
+        global_stats (dict): Band name to (mean, std, min, max, band description).
+        global_sketch (dict): Band name to value sketch.
+    """
+    np.savez(os.path.join(output_dir, GLOBAL_SKETCH_FILE), **global_sketch)
+    with open(os.path.join(output_dir, GLOBAL_STATS_FILE), 'wb') as cache_file:
+        pickle.dump(global_stats, cache_file)
+
+
+def cache_global_stats(file_path, output_dir, file_num, geometries=None, chunk_size=2048, overwrite=False):
+    """
+    Cache global statistics of a given raster file.
+
+    Args:
+        file_path (str): Path to the raster file.
+        output_dir (str): Directory to save the pickle files.
+        file_num (int): Index number for the file (for naming).
+        geometries (list, optional): List of geometries for masking. Defaults to None.
+        chunk_size (int, optional): Target size of the block-aligned chunks to split the raster into. Defaults to 2048.
+        overwrite (bool, optional): Recompute all windows instead of reusing persisted partials. Defaults to False.
+
+    The statistics are always merged from the per-window partials of the file's current content,
+    so only rasters that were added or changed since the last run are read.
+    """
+    print(f"Processing: {file_path}")
+
+    with rasterio.open(file_path) as src:
+        num_rows, num_cols = src.height, src.width
+        band_name = src.descriptions[0]
+        nodata = src.nodatavals[0]
+        windows = plan_windows(src, chunk_size)
+    mask_path = None
+    if geometries:
+        mask_path = rasterize_cutline(geometries, file_path, os.path.join(output_dir, MASK_CACHE_DIR))
+
+    partials_dir = partials_path(output_dir, file_path, mask_path, chunk_size=chunk_size)
+    prepare_partials(partials_dir, file_path, overwrite)
+
+    moments, sketch, _ = reduce_windows(file_path, windows, [nodata], mask_path, partials_dir=partials_dir)
+    return write_file_stats(output_dir, file_num, file_path, moments, sketch, band_name, nodata, (num_rows, num_cols))
+
+
+def cache_global_stats_multiband(file_paths, output_dir, geometries=None, chunk_size=2048, overwrite=False):
+    """
+    Cache global statistics of every band of the given raster files in a single pass per file.
+
+    Each window is read once across all bands. Bands are numbered consecutively from 1 across
+    the input files, matching the band order of the stacked datacube, and all statistics are
+    written to one artifact (`GLOBAL_STATS_FILE`) mapping band name to
+    (mean, std, min, max, band description). The value sketch of every band is written next to it
+    (`GLOBAL_SKETCH_FILE`) for percentile lookups.
+
+    Args:
+        file_paths (list): Paths to the (multi-band) raster files.
+        output_dir (str): Directory to save the stats artifact.
+        geometries (list, optional): List of geometries for masking. Defaults to None.
+        chunk_size (int, optional): Target size of the block-aligned chunks to split the raster into. Defaults to 2048.
+        overwrite (bool, optional): Recompute all windows instead of reusing persisted partials. Defaults to False.
+
+    Returns:
+        dict: Global statistics for each band.
+    """
+    global_stats = {}
+    global_sketch = {}
+
+    for file_path in tqdm(file_paths, desc='Processing files'):
+        with rasterio.open(file_path) as src:
+            indexes = list(src.indexes)
+            descriptions = src.descriptions
+            nodata = list(src.nodatavals)
+            windows = plan_windows(src, chunk_size)
+        mask_path = None
+        if geometries:
+            mask_path = rasterize_cutline(geometries, file_path, os.path.join(output_dir, MASK_CACHE_DIR))
+        partials_dir = partials_path(output_dir, file_path, mask_path, indexes, chunk_size)
+        prepare_partials(partials_dir, file_path, overwrite)
+
+        moments, sketch, _ = reduce_windows(file_path, windows, nodata, mask_path, indexes, partials_dir)
+        add_band_stats(global_stats, global_sketch, moments, sketch, descriptions)
+
+    write_multiband_stats(output_dir, global_stats, global_sketch)
+    return global_stats
 
-    with open(cache_file_path, 'wb') as cache_file:
-        pickle.dump((mean, std_dev, min_val, max_val, band_name), cache_file)
 
-def main(input_files, output_dir, shapefile_path=None, overwrite=False):
+def load_geometries(shapefile_path):
+    """
+    Load the valid geometries of a shapefile to use as a cutline.
+
+    Args:
+        shapefile_path (str): Path to the shapefile, or None.
+
+    Returns:
+        list: List of geometries, or None if no shapefile is given.
+    """
+    if not shapefile_path:
+        return None
+    gdf = gpd.read_file(shapefile_path)
+    return [geom for geom in gdf.geometry.tolist() if geom is not None and geom.is_valid]
+
+
+def main(input_files, output_dir, shapefile_path=None, overwrite=False, multiband=False):
     """
     Main function to process a list of input raster files and cache their global statistics.
 
@@ -136,21 +800,22 @@ def main(input_files, output_dir, shapefile_path=None, overwrite=False):
         input_files (list): List of input .tif files to process.
         output_dir (str): Directory to save the pickle files.
         shapefile_path (str, optional): Path to the shapefile to use as a mask. Defaults to None.
-        overwrite (bool, optional): Overwrite existing cache files if present. Defaults to False.
+        overwrite (bool, optional): Recompute all windows instead of reusing persisted partials. Defaults to False.
+        multiband (bool, optional): Read every band of each file in a single pass and write a single
+            stats artifact. Defaults to False.
     """
     os.makedirs(output_dir, exist_ok=True)  # make sure the output directory exists
     print("Caching global stats...")
 
-    geometries = None
-    if args.shapefile_path:
-        gdf = gpd.read_file(shapefile_path)
-        geometries = gdf.geometry.tolist()
-    
-    print(f"Geometries: {geometries}")
+    geometries = load_geometries(shapefile_path)
+
     print(f"Shapefile path: {shapefile_path}")
-    
-    start_idx = 23
-    for idx, file_path in enumerate(tqdm(input_files[start_idx:]), start=start_idx):
+
+    if multiband:
+        cache_global_stats_multiband(input_files, output_dir, geometries, overwrite=overwrite)
+        return
+
+    for idx, file_path in enumerate(tqdm(input_files)):
         cache_global_stats(file_path, output_dir, idx+1, geometries, overwrite=overwrite)
 
 if __name__ == "__main__":
@@ -158,8 +823,10 @@ if __name__ == "__main__":
     parser.add_argument('--input_files', nargs='+', default=[], help='Input .tif files to process')
     parser.add_argument('--output_dir', default='output', help='Directory to save the pickle files')
     parser.add_argument('--shapefile_path', default=None, help='Path to the shapefile to use as a mask')
-    parser.add_argument('--overwrite', action='store_true', help='Overwrite existing cache files if present')
+    parser.add_argument('--overwrite', action='store_true', help='Recompute all windows instead of reusing persisted partials')
+    parser.add_argument('--multiband', action='store_true',
+                        help='Read all bands of each file in one pass and write a single stats artifact')
     args = parser.parse_args()
 
-    main(args.input_files, args.output_dir, shapefile_path=args.shapefile_path, overwrite=args.overwrite)
-
+    main(args.input_files, args.output_dir, shapefile_path=args.shapefile_path, overwrite=args.overwrite,
+         multiband=args.multiband)
@@ -0,0 +1,205 @@
+import os
+import argparse
+import numpy as np
+import rasterio
+from mpi4py import MPI
+from calculate_global_stats import (MASK_CACHE_DIR, SKETCH_BINS, empty_moments, merge_moments, process_window,
+                                    window_key, rasterize_cutline, partials_path, prepare_partials,
+                                    save_partials, merge_saved_partials, add_sparse_sketch, write_file_stats,
+                                    add_band_stats, write_multiband_stats, load_geometries)
+from windows import plan_windows
+
+# Number of rows of the packed moments: count, mean, M2, min value and max value
+MOMENT_FIELDS = 5
+
+
+def pack_moments(moments):
+    """
+    Pack per-band partial moments into a single float64 array, as reduced by MERGE_MOMENTS.
+
+    Args:
+        moments (tuple): Partial moments as returned by `empty_moments`.
+
+    Returns:
+        np.ndarray: Array of shape (MOMENT_FIELDS, bands). Counts are exact up to 2 ** 53.
+    """
+    return np.stack([np.asarray(field, dtype=np.float64) for field in moments])
+
+
+def unpack_moments(packed):
+    """
+    Unpack moments packed by `pack_moments`.
+
+    Args:
+        packed (np.ndarray): Array of shape (MOMENT_FIELDS, bands).
+
+    Returns:
+        tuple: Partial moments.
+    """
+    return (packed[0].astype(np.int64), packed[1].copy(), packed[2].copy(), packed[3].copy(), packed[4].copy())
+
+
+def _merge_packed_moments(inbuf, inoutbuf, datatype):
+    """Reduction function of MERGE_MOMENTS: merges the packed moments of `inbuf` into `inoutbuf`."""
+    a = np.frombuffer(inbuf, dtype=np.float64).reshape(MOMENT_FIELDS, -1)
+    b = np.frombuffer(inoutbuf, dtype=np.float64).reshape(MOMENT_FIELDS, -1)
+    b[...] = pack_moments(merge_moments(unpack_moments(a), unpack_moments(b)))
+
+
+# Parallel Welford/Chan merge of packed moments. Reductions use a contiguous datatype spanning
+# the whole packed array, so MPI never splits it into separately reduced segments.
+MERGE_MOMENTS = MPI.Op.Create(_merge_packed_moments, commute=True)
+
+
+def allreduce_windows(comm, file_path, windows, nodata, mask_path=None, indexes=None, partials_dir=None,
+                      checkpoint_every=16):
+    """
+    Aggregate a disjoint share of the windows of a raster file on every rank and combine the
+    partial moments and sketches of all ranks with collective reductions.
+
+    Windows are dealt out round-robin, so clustered valid (or cutline) areas are spread over all
+    ranks. Windows found in the persisted partials (of any earlier run, single-node or MPI) are
+    not read again; every rank adds its newly processed windows to the partials directory as
+    part files of its own.
+
+    Args:
+        comm (MPI.Comm): MPI communicator.
+        file_path (str): Path to the raster file.
+        windows (list): List of Window objects covering the raster, identical on every rank.
+        nodata (list): No-data value of each band read.
+        mask_path (str, optional): Path to the rasterized cutline mask. Defaults to None.
+        indexes (list, optional): 1-based band indexes to read. Defaults to the first band.
+        partials_dir (str, optional): Partials directory, from `partials_path`. Defaults to None.
+        checkpoint_every (int, optional): Number of windows between checkpoints. Defaults to 16.
+
+    Returns:
+        tuple: The merged partial moments and value sketch of all windows, on every rank.
+    """
+    rank, size = comm.Get_rank(), comm.Get_size()
+    indexes = indexes or [1]
+
+    moments = empty_moments(len(indexes))
+    sketch = np.zeros((len(indexes), SKETCH_BINS), dtype=np.int64)
+    rank_windows = windows[rank::size]
+    merged = set()
+    if partials_dir:
+        moments, merged = merge_saved_partials(partials_dir, {window_key(w) for w in rank_windows}, moments, sketch)
+
+    missing = [w for w in rank_windows if window_key(w) not in merged]
+    pending = []
+    for window in missing:
+        window_moments, window_sketch = process_window(file_path, window, nodata, mask_path, indexes)
+        moments = merge_moments(moments, window_moments)
+        add_sparse_sketch(sketch, window_sketch)
+        if partials_dir:
+            pending.append((window_key(window), window_moments, window_sketch))
+            if len(pending) >= checkpoint_every:
+                save_partials(partials_dir, pending, f"rank{rank}")
+                pending = []
+    if pending:
+        save_partials(partials_dir, pending, f"rank{rank}")
+
+    computed = comm.reduce(len(missing), op=MPI.SUM, root=0)
+    if rank == 0:
+        print(f"Reused {len(windows) - computed} and computed {computed} windows of {file_path} on {size} ranks")
+
+    packed = pack_moments(moments)
+    merged = np.empty_like(packed)
+    datatype = MPI.DOUBLE.Create_contiguous(packed.size).Commit()
+    try:
+        comm.Allreduce([packed, 1, datatype], [merged, 1, datatype], op=MERGE_MOMENTS)
+    finally:
+        datatype.Free()
+
+    merged_sketch = np.empty_like(sketch)
+    comm.Allreduce(sketch, merged_sketch, op=MPI.SUM)
+
+    return unpack_moments(merged), merged_sketch
+
+
+def prepare_file(comm, file_path, output_dir, geometries, indexes, chunk_size, overwrite):
+    """
+    Rasterize the cutline and prepare the partials directory of a raster file on rank 0, and share them with all ranks.
+
+    Args:
+        comm (MPI.Comm): MPI communicator.
+        file_path (str): Path to the raster file.
+        output_dir (str): Directory to save the pickle files.
+        geometries (list): List of geometries for masking, or None. Only used on rank 0.
+        indexes (list): 1-based band indexes read.
+        chunk_size (int): Target size of the block-aligned chunks to split the raster into.
+        overwrite (bool): Delete the persisted partials of the file.
+
+    Returns:
+        tuple: Path to the cutline mask (or None) and path to the partials directory.
+    """
+    if comm.Get_rank() == 0:
+        mask_path = None
+        if geometries:
+            mask_path = rasterize_cutline(geometries, file_path, os.path.join(output_dir, MASK_CACHE_DIR))
+        partials_dir = partials_path(output_dir, file_path, mask_path, indexes, chunk_size)
+        prepare_partials(partials_dir, file_path, overwrite)
+    else:
+        mask_path, partials_dir = None, None
+    return comm.bcast((mask_path, partials_dir), root=0)
+
+
+def main(input_files, output_dir, shapefile_path=None, overwrite=False, multiband=False, chunk_size=2048):
+    """
+    Compute the global statistics of the input raster files over all MPI ranks and write the same
+    cache files as calculate_global_stats.py.
+
+    Args:
+        input_files (list): List of input .tif files to process.
+        output_dir (str): Directory to save the pickle files.
+        shapefile_path (str, optional): Path to the shapefile to use as a mask. Defaults to None.
+        overwrite (bool, optional): Recompute all windows instead of reusing persisted partials. Defaults to False.
+        multiband (bool, optional): Read every band of each file in a single pass and write a single
+            stats artifact. Defaults to False.
+        chunk_size (int, optional): Target size of the block-aligned chunks to split the raster into. Defaults to 2048.
+    """
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+
+    geometries = None
+    if rank == 0:
+        os.makedirs(output_dir, exist_ok=True)
+        print(f"Caching global stats on {comm.Get_size()} ranks...")
+        geometries = load_geometries(shapefile_path)
+
+    global_stats, global_sketch = {}, {}
+    for idx, file_path in enumerate(input_files):
+        with rasterio.open(file_path) as src:
+            indexes = list(src.indexes) if multiband else [1]
+            descriptions = src.descriptions
+            nodata = list(src.nodatavals) if multiband else [src.nodatavals[0]]
+            shape = (src.height, src.width)
+            windows = plan_windows(src, chunk_size)
+
+        mask_path, partials_dir = prepare_file(comm, file_path, output_dir, geometries,
+                                               None if not multiband else indexes, chunk_size, overwrite)
+        moments, sketch = allreduce_windows(comm, file_path, windows, nodata, mask_path, indexes, partials_dir)
+
+        if rank == 0:
+            if multiband:
+                add_band_stats(global_stats, global_sketch, moments, sketch, descriptions)
+            else:
+                write_file_stats(output_dir, idx + 1, file_path, moments, sketch, descriptions[0], nodata[0], shape)
+
+    if rank == 0 and multiband:
+        write_multiband_stats(output_dir, global_stats, global_sketch)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Process individual .tif files over MPI ranks.')
+    parser.add_argument('--input_files', nargs='+', default=[], help='Input .tif files to process')
+    parser.add_argument('--output_dir', default='output', help='Directory to save the pickle files')
+    parser.add_argument('--shapefile_path', default=None, help='Path to the shapefile to use as a mask')
+    parser.add_argument('--overwrite', action='store_true', help='Recompute all windows instead of reusing persisted partials')
+    parser.add_argument('--multiband', action='store_true',
+                        help='Read all bands of each file in one pass and write a single stats artifact')
+    parser.add_argument('--chunk_size', type=int, default=2048, help='Target size of the windows dealt out to the ranks')
+    args = parser.parse_args()
+
+    main(args.input_files, args.output_dir, shapefile_path=args.shapefile_path, overwrite=args.overwrite,
+         multiband=args.multiband, chunk_size=args.chunk_size)
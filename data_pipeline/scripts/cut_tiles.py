@@ -1,10 +1,15 @@
 import os
 import rasterio
 from rasterio.windows import Window
-from multiprocessing import Pool, cpu_count
 import numpy as np
 from tqdm import tqdm
 import pickle
+from band_transforms import build_transform_plan, apply_transform_plan
+from windows import load_tile_mask, iter_tile_runs, windowed_imap
+from tile_store import plan_shards, build_index, write_store_metadata, shard_name
+from tile_encoding import (ENCODINGS, COMPRESSIONS, build_tile_encoding, storage_dtype, encode_bands,
+                           encode_tile, creation_options, check_raw_encoding)
+from tile_manifest import run_fingerprint, data_checksum, load_manifest, clear_manifest, ManifestWriter
 
 
 def cache_global_stats(band_name, pickle_dir):
@@ -16,110 +21,273 @@ def cache_global_stats(band_name, pickle_dir):
     :return: Global statistics for the band.
     """
     cache_file_path = os.path.join(pickle_dir, f'{band_name}.pkl')
+    global_stats_path = os.path.join(pickle_dir, 'global_stats.pkl')
     if os.path.exists(cache_file_path):
         with open(cache_file_path, 'rb') as cache_file:
             return pickle.load(cache_file)
-    else:
-        raise FileNotFoundError(f"No cached data found for band {band_name} in directory {pickle_dir}")
+    elif os.path.exists(global_stats_path):
+        # Single artifact written by calculate_global_stats.py --multiband
+        with open(global_stats_path, 'rb') as cache_file:
+            global_stats = pickle.load(cache_file)
+        if band_name in global_stats:
+            return global_stats[band_name]
+    raise FileNotFoundError(f"No cached data found for band {band_name} in directory {pickle_dir}")
+
+
+# Per-worker state set up once by `init_worker`: the open input dataset, the transform plan,
+# the tile encoding and the GeoTIFF dtype and creation options
+_worker_src = None
+_worker_plan = None
+_worker_encoding = None
+_worker_profile = None
 
 
-def cut_tile(args):
+def init_worker(input_tif, plan, encoding, profile):
     """
-    Extract a tile from the input TIF file and process its bands based on global statistics.
+    Open the input TIF once per worker process and keep it, with the transform plan and encoding, for all tasks.
 
-    :param args: A tuple containing the arguments required for the operation.
+    :param input_tif: Path to the input TIF file.
+    :param plan: TransformPlan applied to every tile.
+    :param encoding: TileEncoding the tiles are stored with.
+    :param profile: Dtype and creation options of GeoTIFF tiles.
     """
-    i, j, window_size, input_tif, output_file, global_stats_dict, band_names = args
-    window = Window(j * window_size, i * window_size, window_size, window_size)
-    with rasterio.open(input_tif) as src:
-        data = src.read(window=window)
-        processed_data = process_bands_in_tile(data, band_names, global_stats_dict)
-        with rasterio.open(output_file, 'w', driver='GTiff',
+    global _worker_src, _worker_plan, _worker_encoding, _worker_profile
+    _worker_src = rasterio.open(input_tif)
+    _worker_plan = plan
+    _worker_encoding = encoding
+    _worker_profile = profile
+
+
+def read_run(i, js, window_size):
+    """
+    Read the strip of the worker's input covering a run of tiles of one tile row.
+
+    :param i: Tile row.
+    :param js: Sorted tile columns of the run.
+    :param window_size: Size of the window for tiling.
+    :return: Generator of (j, raw tile data) for each tile of the run.
+    """
+    src = _worker_src
+    row_off, col_off = i * window_size, js[0] * window_size
+    strip_window = Window(col_off, row_off,
+                          min((js[-1] + 1) * window_size, src.width) - col_off,
+                          min(window_size, src.height - row_off))
+    strip = src.read(window=strip_window)
+
+    for j in js:
+        start = j * window_size - col_off
+        yield j, strip[:, :, start:start + window_size]
+
+
+def cut_tile_run(args):
+    """
+    Read a strip covering a run of tiles of one tile row, then split, process, encode and save every tile of it.
+
+    :param args: A tuple of (tile row, tile columns, window size, output directory).
+    :return: Tuple of (number of tiles written, list of (tile name, checksum) manifest entries).
+    """
+    i, js, window_size, output_dir = args
+    src = _worker_src
+    row_off = i * window_size
+
+    written = []
+    tile = np.empty((_worker_plan.num_bands, window_size, window_size), dtype=np.float32)
+    for j, data in read_run(i, js, window_size):
+        processed_data = apply_transform_plan(data, _worker_plan, out=tile)
+        encoded_data = encode_bands(processed_data, _worker_encoding, slice(None), _worker_profile['dtype'])
+
+        tile_name = f'tile_{i}_{j}.tif'
+        window = Window(j * window_size, row_off, window_size, window_size)
+        with rasterio.open(os.path.join(output_dir, tile_name), 'w', driver='GTiff',
                            height=window.height, width=window.width,
-                           count=processed_data.shape[0], dtype=str(processed_data.dtype),
+                           count=encoded_data.shape[0],
                            crs=src.crs,
-                           transform=src.window_transform(window)) as new_dataset:
-            new_dataset.write(processed_data)
+                           transform=src.window_transform(window), **_worker_profile) as new_dataset:
+            new_dataset.write(encoded_data)
+            # Datacube band of each channel, and whether the tile still needs normalization at load time
+            new_dataset.descriptions = tuple(_worker_plan.band_names)
+            new_dataset.update_tags(TRANSFORM='raw' if _worker_plan.raw else 'processed')
+            if encoded_data.dtype.kind != 'f':
+                new_dataset.scales = tuple(_worker_encoding.scales)
+                new_dataset.offsets = tuple(_worker_encoding.offsets)
+        written.append((tile_name, data_checksum(encoded_data)))
 
+    return len(written), written
 
-def process_bands_in_tile(tile, band_names, global_stats_dict):
-    """
-    Process and normalize each band in a tile based on global statistics.
 
-    :param tile: A numpy array representing the tile.
-    :param band_names: List of band names.
-    :param global_stats_dict: Dictionary containing global statistics for each band.
-    :return: Processed numpy array.
+def cut_shard(args):
     """
-    processed_bands = []
-    num_bands = tile.shape[0]
+    Process every tile of a shard's runs directly into memory-mapped .npy shards, one per dtype
+    group of the tile encoding.
 
-    # Pad tile to standard size if required
-    if tile.shape[1:] != (256, 256):
-        pad_rows = 256 - tile.shape[1]
-        pad_cols = 256 - tile.shape[2]
-        tile = np.pad(tile, ((0, 0), (0, pad_rows), (0, pad_cols)), mode='constant')
+    The shard files are written under temporary names and renamed once complete.
 
-    for b in range(num_bands):
-        band_name = band_names[b]
-        band = tile[b, :, :]
-        mean, std, _, _, _ = global_stats_dict[band_name]
-        
-        band = np.nan_to_num(band)
-        band_name_int = int(band_name)
+    :param args: A tuple of (shard number, runs of the shard, window size, output directory).
+    :return: Tuple of (number of tiles written, list with the (shard name, checksum) manifest entry),
+        where the checksum covers the files of all groups.
+    """
+    k, runs, window_size, output_dir = args
+    num_tiles = sum(len(js) for _, js in runs)
+    groups = _worker_encoding.groups
+    shard_paths = [os.path.join(output_dir, shard_name(k, g)) for g in range(len(groups))]
+    tmp_paths = [f'{shard_path}.tmp.npy' for shard_path in shard_paths]
 
-        if 7 <= band_name_int < 10:
-            band = (band > 0).astype(np.float64)
+    shards = [np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype,
+                                        shape=(num_tiles, len(bands), window_size, window_size))
+              for tmp_path, (dtype, bands) in zip(tmp_paths, groups)]
+    tile = np.empty((_worker_plan.num_bands, window_size, window_size), dtype=np.float32)
+    offset = 0
+    for i, js in runs:
+        for _, data in read_run(i, js, window_size):
+            processed_data = apply_transform_plan(data, _worker_plan, out=tile)
+            for shard, encoded_data in zip(shards, encode_tile(processed_data, _worker_encoding)):
+                shard[offset] = encoded_data
+            offset += 1
 
-        if (7 <= band_name_int < 13) or (19 <= band_name_int < 26):
-            processed_bands.append(band)
-            continue
+    for shard in shards:
+        shard.flush()
+    checksum = data_checksum(*shards)
+    del shards, shard
+    for tmp_path, shard_path in zip(tmp_paths, shard_paths):
+        os.replace(tmp_path, shard_path)
+    return num_tiles, [(shard_name(k), checksum)]
 
-        if 13 <= band_name_int < 16:
-            band[band == 0] = mean
 
-        if (band_name_int == 26) or (1 <= band_name_int < 4):
-            band = np.log1p(band)
+def read_unit(output_dir, unit, num_groups=1):
+    """
+    Read back the stored data of a written tile or shard.
 
-        if std != 0:
-            band = (band - mean) / std
+    :param output_dir: Directory of the tiles.
+    :param unit: Name of the tile (.tif) or shard (.npy).
+    :param num_groups: Number of dtype groups of the tile encoding, i.e. of files per shard.
+    :return: List of arrays with the unit's data.
+    """
+    if unit.endswith('.npy'):
+        k = int(unit[len('shard_'):-len('.npy')])
+        return [np.load(os.path.join(output_dir, shard_name(k, g)), mmap_mode='r') for g in range(num_groups)]
+    with rasterio.open(os.path.join(output_dir, unit)) as src:
+        return [src.read()]
 
-        processed_bands.append(band)
 
-    return np.array(processed_bands)
+def verify_completed(output_dir, completed, num_groups=1):
+    """
+    Keep only the completed units whose data still matches the checksum in the manifest.
+
+    :param output_dir: Directory of the tiles.
+    :param completed: Dictionary mapping unit name to checksum, as returned by `load_manifest`.
+    :param num_groups: Number of dtype groups of the tile encoding, i.e. of files per shard.
+    :return: Dictionary of the units that passed verification.
+    """
+    verified = {}
+    for unit, checksum in tqdm(completed.items(), desc='Verifying Tiles'):
+        try:
+            if data_checksum(*read_unit(output_dir, unit, num_groups)) == checksum:
+                verified[unit] = checksum
+        except (OSError, ValueError):
+            # Missing or unreadable (e.g. truncated) file: cut again
+            pass
+    return verified
 
 
-def create_tiles_based_on_mask(input_tif, output_dir, mask_file, window_size, pickle_dir, overwrite=False):
+def create_tiles_based_on_mask(input_tif, output_dir, mask_file, window_size, pickle_dir, overwrite=False,
+                               tiles_per_read=16, output_format='tif', tiles_per_shard=512, verify=False,
+                               encoding='float32', compress='none', predictor=None, raw=False):
     """
     Create tiles from an input TIF file based on a specified mask.
 
+    Completed tiles (or shards) are recorded in a manifest in the output directory, together with
+    a checksum of their data and a fingerprint of the input, statistics and tiling parameters.
+    Reruns only cut the tiles that are missing or were written from different inputs.
+
     :param input_tif: Path to the input TIF file.
     :param output_dir: Directory to save the resulting tiles.
-    :param mask_file: Optional mask file to determine tiles to create.
+    :param mask_file: Optional mask (.npy) or sampling plan (.npz) of sample_deforestation.py to determine tiles to create.
     :param window_size: Size of the window for tiling.
     :param pickle_dir: Directory containing pickle files with cached statistics.
-    :param overwrite: Boolean flag to overwrite existing files/folders.
+    :param overwrite: Discard the manifest and cut every tile again.
+    :param tiles_per_read: Maximum number of tiles of a row read with a single strip read.
+    :param output_format: 'tif' to write one GeoTIFF per tile, or 'shards' to write tiles into
+        large .npy shards with an index (see tile_store.py).
+    :param tiles_per_shard: Number of tiles per shard when writing shards.
+    :param verify: Re-read the completed tiles and cut again those not matching their checksum.
+    :param encoding: Storage encoding of the tiles, one of tile_encoding.ENCODINGS. 'float16' is only
+        available for shards.
+    :param compress: GeoTIFF compression, one of tile_encoding.COMPRESSIONS.
+    :param predictor: GeoTIFF predictor. Defaults to the one suited to the tiles' dtype.
+    :param raw: Store raw tiles, only padded and with NaNs zeroed, to be normalized at load time.
+        Requires an exact encoding (tile_encoding.RAW_ENCODINGS).
     """
-    if not os.path.exists(output_dir) or overwrite:
-        os.makedirs(output_dir, exist_ok=True)
-        print(f"Directory {output_dir} does not exist or overwrite is set to True.")
+    if raw:
+        check_raw_encoding(encoding)
+    os.makedirs(output_dir, exist_ok=True)
 
-        mask = np.load(mask_file) if mask_file else np.ones((rasterio.open(input_tif).height // window_size,
-                                                             rasterio.open(input_tif).width // window_size))
+    with rasterio.open(input_tif) as src:
+        height, width = src.height, src.width
+        transform, crs = src.transform, src.crs
+
+    mask = load_tile_mask(mask_file) if mask_file else None
+
+    band_names = [str(i) for i in range(1, 27)]
+    global_stats_dict = {band_name: cache_global_stats(band_name, pickle_dir) for band_name in band_names}
+    plan = build_transform_plan(band_names, global_stats_dict, window_size, raw)
+    tile_encoding = build_tile_encoding(plan, global_stats_dict, band_names, encoding)
+
+    # Tile content only depends on the input, the stats, the window size and the encoding; the
+    # content of a shard also depends on which tiles it groups. Raw runs get their own fingerprint,
+    # leaving those of processed tiles unchanged.
+    raw_params = ('raw',) if raw else ()
+    if output_format == 'shards':
+        profile = None
+        fingerprint = run_fingerprint(input_tif, global_stats_dict, window_size, output_format, encoding,
+                                      tiles_per_read, tiles_per_shard, None if mask is None else data_checksum(mask),
+                                      *raw_params)
+    else:
+        dtype = storage_dtype(tile_encoding)
+        profile = {'dtype': str(dtype), **creation_options(dtype, compress, predictor)}
+        fingerprint = run_fingerprint(input_tif, global_stats_dict, window_size, output_format, encoding,
+                                      compress, predictor, *raw_params)
+
+    if overwrite:
+        clear_manifest(output_dir)
+    completed = load_manifest(output_dir, fingerprint)
+    if verify:
+        completed = verify_completed(output_dir, completed, len(tile_encoding.groups))
+
+    # Runs of tiles are cut in row-major order so consecutive reads hit neighbouring blocks of the input
+    runs = iter_tile_runs(height, width, window_size, mask=mask, full_tiles=True,
+                          max_tiles_per_read=tiles_per_read)
+
+    if output_format == 'shards':
+        shards = plan_shards(runs, tiles_per_shard)
+        todo = [(k, shard_runs) for k, shard_runs in enumerate(shards) if shard_name(k) not in completed]
+        num_tiles = sum(len(js) for _, shard_runs in todo for _, js in shard_runs)
+        tasks = ((k, shard_runs, window_size, output_dir) for k, shard_runs in todo)
+        worker = cut_shard
+    else:
+        todo = [(i, [j for j in js if f'tile_{i}_{j}.tif' not in completed]) for i, js in runs]
+        todo = [(i, js) for i, js in todo if js]
+        num_tiles = sum(len(js) for _, js in todo)
+        tasks = ((i, js, window_size, output_dir) for i, js in todo)
+        worker = cut_tile_run
 
-        num_windows_y, num_windows_x = mask.shape
-        band_names = [str(i) for i in range(1, 27)]
-        global_stats_dict = {band_name: cache_global_stats(band_name, pickle_dir) for band_name in band_names}
+    print(f"{len(completed)} {'shards' if output_format == 'shards' else 'tiles'} already completed, "
+          f"{num_tiles} tiles to cut.")
 
-        tasks = [
-            (i, j, window_size, input_tif, os.path.join(output_dir, f'tile_{i}_{j}.tif'), global_stats_dict, band_names)
-            for i in range(num_windows_y)
-            for j in range(num_windows_x)
-            if mask[i, j] == 1
-        ]
+    manifest = ManifestWriter(output_dir, fingerprint, 'main')
+    try:
+        with tqdm(total=num_tiles, desc='Cutting Tiles') as progress:
+            for tiles_written, entries in windowed_imap(worker, tasks, initializer=init_worker,
+                                                        initargs=(input_tif, plan, tile_encoding, profile)):
+                for unit, checksum in entries:
+                    manifest.record(unit, checksum)
+                progress.update(tiles_written)
+    finally:
+        manifest.close()
 
-        with Pool(processes=cpu_count()) as p:
-            list(tqdm(p.imap_unordered(cut_tile, tasks), total=len(tasks), desc='Cutting Tiles'))
+    if output_format == 'shards':
+        index = build_index(shards, transform, window_size)
+        write_store_metadata(output_dir, index, len(shards), len(band_names), window_size, str(crs), tile_encoding,
+                             band_names, raw)
 
 
 if __name__ == "__main__":
@@ -128,10 +296,23 @@ if __name__ == "__main__":
     parser.add_argument('--input_tif', type=str, help='Input TIF file.')
     parser.add_argument('--output_dir', type=str, help='Output directory to store the tiles.')
     parser.add_argument('--pickle_dir', type=str, help='Directory for pickle files with cached stats.')
-    parser.add_argument('--mask_file', type=str, default=None, help='Optional mask file. If not provided, all tiles will be created.')
+    parser.add_argument('--mask_file', type=str, default=None, help='Optional mask (.npy) or sampling plan (.npz) file. If not provided, all tiles will be created.')
     parser.add_argument('--window_size', type=int, default=256, help='Window size for creating the tiles.')
-    parser.add_argument('--overwrite', action='store_true', help='Overwrite existing files/folders.')
+    parser.add_argument('--overwrite', action='store_true', help='Discard the manifest and cut every tile again.')
+    parser.add_argument('--tiles_per_read', type=int, default=16, help='Maximum number of tiles of a row read at once.')
+    parser.add_argument('--output_format', type=str, default='tif', choices=['tif', 'shards'],
+                        help='Write one GeoTIFF per tile, or large .npy shards with an index.')
+    parser.add_argument('--tiles_per_shard', type=int, default=512, help='Number of tiles per shard.')
+    parser.add_argument('--encoding', type=str, default='float32', choices=ENCODINGS,
+                        help='Storage of the continuous bands; binary bands are stored as uint8 unless float32.')
+    parser.add_argument('--compress', type=str, default='none', choices=COMPRESSIONS, help='GeoTIFF compression.')
+    parser.add_argument('--predictor', type=int, default=None, choices=[1, 2, 3],
+                        help='GeoTIFF predictor. Defaults to 2 for integer and 3 for float tiles.')
+    parser.add_argument('--verify', action='store_true', help='Re-read completed tiles and cut again those not matching their checksum.')
+    parser.add_argument('--raw', action='store_true', help='Store raw tiles, normalized at load time by the model pipeline.')
 
     args = parser.parse_args()
 
-    create_tiles_based_on_mask(args.input_tif, args.output_dir, args.mask_file, args.window_size, args.pickle_dir, args.overwrite)
+    create_tiles_based_on_mask(args.input_tif, args.output_dir, args.mask_file, args.window_size, args.pickle_dir, args.overwrite,
+                               args.tiles_per_read, args.output_format, args.tiles_per_shard, args.verify,
+                               args.encoding, args.compress, args.predictor, args.raw)
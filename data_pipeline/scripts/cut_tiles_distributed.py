@@ -1,10 +1,21 @@
 import os
-import numpy as np
+import time
+import traceback
 import rasterio
 from mpi4py import MPI
-from rasterio.windows import Window
+from collections import deque
 import pickle
+from band_transforms import build_transform_plan
 import argparse
+from windows import load_tile_mask, iter_tile_runs
+from tile_encoding import (GEOTIFF_ENCODINGS, COMPRESSIONS, build_tile_encoding, storage_dtype, creation_options,
+                           check_raw_encoding)
+from tile_manifest import run_fingerprint, load_manifest, clear_manifest, ManifestWriter
+from cut_tiles import init_worker, cut_tile_run
+
+# Message tags of the coordinator/worker protocol
+TAG_REQUEST = 1  # Worker to coordinator: report of the last batch and request for the next one
+TAG_BATCH = 2    # Coordinator to worker: next batch of tiles, or None when all tiles are handed out
 
 def cache_global_stats(band_name, pickle_dir):
     """
@@ -15,129 +26,274 @@ def cache_global_stats(band_name, pickle_dir):
     :return: Tuple containing the cached statistics.
     """
     cache_file_path = os.path.join(pickle_dir, f'{band_name}.pkl')
+    global_stats_path = os.path.join(pickle_dir, 'global_stats.pkl')
     if os.path.exists(cache_file_path):
         with open(cache_file_path, 'rb') as cache_file:
             return pickle.load(cache_file)
-    else:
-        raise FileNotFoundError(f"No cached data found for band {band_name} in directory {pickle_dir}")
+    elif os.path.exists(global_stats_path):
+        # Single artifact written by calculate_global_stats.py --multiband
+        with open(global_stats_path, 'rb') as cache_file:
+            global_stats = pickle.load(cache_file)
+        if band_name in global_stats:
+            return global_stats[band_name]
+    raise FileNotFoundError(f"No cached data found for band {band_name} in directory {pickle_dir}")
 
-def cut_tile(args):
+def wait_for_request(comm, status, last_seen, worker_timeout, poll_interval=0.01):
     """
-    Slice a tile from the given raster file, process its bands, and save to the specified output.
+    Poll for the next worker request, aborting the job if a worker has been silent for too long.
+
+    A worker killed without raising (e.g. out of memory) never sends its next request, so a
+    blocking receive would wait for it forever.
 
-    :param args: Tuple containing parameters necessary for cutting and processing.
+    :param comm: MPI communicator.
+    :param status: MPI.Status filled with the source of the pending request.
+    :param last_seen: Time each working rank last sent a request, by rank.
+    :param worker_timeout: Seconds a rank may take to cut a batch.
+    :param poll_interval: Seconds between two polls.
     """
-    i, j, window_size, input_tif, output_file, global_stats_dict, band_names = args
-    window = Window(j*window_size, i*window_size, window_size, window_size)
-    with rasterio.open(input_tif) as src:
-        data = src.read(window=window)
-        processed_data = process_bands_in_tile(data, band_names, global_stats_dict)
-        
-        with rasterio.open(output_file, 'w', driver='GTiff',
-                           height=window.height, width=window.width,
-                           count=processed_data.shape[0], dtype=str(processed_data.dtype),
-                           crs=src.crs, transform=src.window_transform(window)) as new_dataset:
-            new_dataset.write(processed_data)
-
-def process_bands_in_tile(tile, band_names, global_stats_dict):
+    while not comm.Iprobe(source=MPI.ANY_SOURCE, tag=TAG_REQUEST, status=status):
+        now = time.perf_counter()
+        silent = [rank for rank, seen in last_seen.items() if now - seen > worker_timeout]
+        if silent:
+            print(f"Ranks {silent} sent nothing for {worker_timeout} s, aborting", flush=True)
+            comm.Abort(1)
+        time.sleep(poll_interval)
+
+
+def coordinate(comm, batches, max_retries=2, worker_timeout=None):
+    """
+    Hand out batches of tiles to the worker ranks on demand until every batch is cut.
+
+    Workers ask for a new batch as soon as they finish one, so ranks working on cheap or sparse
+    parts of the mask take more batches. Batches that fail are handed out again, up to `max_retries` times.
+
+    :param comm: MPI communicator; this rank (0) is the coordinator and all other ranks are workers.
+    :param batches: List of (tile row, tile columns) batches.
+    :param max_retries: Number of times a failed batch is retried.
+    :param worker_timeout: Seconds a rank may go without requesting a batch before the job is aborted.
+        Defaults to waiting forever.
+    :return: Tuple of (list of (batch, error) of the batches that failed for good, stats of the coordinator).
+    """
+    pending = deque(batches)
+    attempts, failed = {}, []
+    active_workers = comm.Get_size() - 1
+    stats = {'tiles': 0, 'busy': 0.0, 'idle': 0.0}
+    status = MPI.Status()
+    last_seen = {rank: time.perf_counter() for rank in range(1, comm.Get_size())}
+
+    while active_workers:
+        start = time.perf_counter()
+        if worker_timeout is not None:
+            wait_for_request(comm, status, last_seen, worker_timeout)
+        report = comm.recv(source=MPI.ANY_SOURCE if worker_timeout is None else status.Get_source(),
+                           tag=TAG_REQUEST, status=status)
+        received = time.perf_counter()
+        stats['idle'] += received - start
+        last_seen[status.Get_source()] = received
+
+        if report is not None:
+            batch, error = report
+            if error is not None:
+                key = (batch[0], tuple(batch[1]))
+                attempts[key] = attempts.get(key, 0) + 1
+                if attempts[key] <= max_retries:
+                    pending.append(batch)
+                else:
+                    failed.append((batch, error))
+
+        if pending:
+            comm.send(pending.popleft(), dest=status.Get_source(), tag=TAG_BATCH)
+        else:
+            comm.send(None, dest=status.Get_source(), tag=TAG_BATCH)
+            del last_seen[status.Get_source()]
+            active_workers -= 1
+        stats['busy'] += time.perf_counter() - received
+
+    return failed, stats
+
+
+def work(comm, window_size, output_dir, manifest):
+    """
+    Cut the batches handed out by the coordinator until it has none left.
+
+    :param comm: MPI communicator.
+    :param window_size: Size of the tiles to cut.
+    :param output_dir: Directory to save output tiles.
+    :param manifest: ManifestWriter of this rank.
+    :return: Stats of this rank: tiles cut, time spent cutting and time spent waiting for batches.
+    """
+    stats = {'tiles': 0, 'busy': 0.0, 'idle': 0.0}
+    report = None
+    while True:
+        start = time.perf_counter()
+        comm.send(report, dest=0, tag=TAG_REQUEST)
+        batch = comm.recv(source=0, tag=TAG_BATCH)
+        received = time.perf_counter()
+        stats['idle'] += received - start
+        if batch is None:
+            return stats
+
+        i, js = batch
+        try:
+            tiles_written, entries = cut_tile_run((i, js, window_size, output_dir))
+            for unit, checksum in entries:
+                manifest.record(unit, checksum)
+            stats['tiles'] += tiles_written
+            report = (batch, None)
+        except Exception as e:
+            report = (batch, repr(e))
+        stats['busy'] += time.perf_counter() - received
+
+
+def print_rank_report(all_stats, wall_time):
     """
-    Process bands in a tile according to predefined normalization techniques.
+    Print the throughput and idle time of every rank.
 
-    :param tile: 3D numpy array representing the bands in the tile.
-    :param band_names: List of band names.
-    :param global_stats_dict: Dictionary with global statistics for normalization.
-    :return: Processed 3D numpy array.
+    :param all_stats: List of the stats of every rank, as gathered on the coordinator.
+    :param wall_time: Wall time of the tiling in seconds.
     """
-    processed_bands = []
-    num_bands = tile.shape[0]
-    
-    # Pad the entire tile if its dimensions are not [num_bands, 256, 256]
-    if tile.shape[1:] != (256, 256):
-        pad_rows = 256 - tile.shape[1]
-        pad_cols = 256 - tile.shape[2]
-        tile = np.pad(tile, ((0, 0), (0, pad_rows), (0, pad_cols)), mode='constant')
-    
-    for b in range(num_bands):
-        band_name = band_names[b]  # Get band name
-        band = tile[b, :, :]  # Get band data
-        mean, std, _, _, _ = global_stats_dict[band_name]
-        
-        # Convert NaNs to zero
-        band = np.nan_to_num(band)
-        
-        band_name_int = int(band_name)
-        
-        if 7 <= band_name_int < 10:
-            band = (band > 0).astype(np.float64)
-        
-        if (7 <= band_name_int < 13) or (19 <= band_name_int < 26):
-            processed_bands.append(band)
-            continue
-        
-        if 13 <= band_name_int < 16:
-            # Replace zeros in band with the mean_value
-            band[band == 0] = mean
-        
-        # Apply log transformation if band name is "26" or (1 <= int(band_name) and int(band_name) < 4)
-        if (band_name_int == 26) or (1 <= band_name_int < 4):
-            band = np.log1p(band)  # Apply logarithmic transformation
-        
-        # Apply standardization
-        if std != 0:
-            band = (band - mean) / std
-        
-        processed_bands.append(band)
-    
-    return np.array(processed_bands)
-
-def create_tiles_based_on_mask(input_tif, output_dir, mask_file, window_size, pickle_dir, overwrite=False):
+    print(f"{'rank':>5}{'role':>13}{'tiles':>8}{'tiles/s':>10}{'busy (s)':>10}{'idle (s)':>10}{'idle %':>8}")
+    for rank, stats in enumerate(all_stats):
+        role = 'coordinator' if rank == 0 and len(all_stats) > 1 else 'worker'
+        total = stats['busy'] + stats['idle']
+        print(f"{rank:>5}{role:>13}{stats['tiles']:>8}{stats['tiles'] / max(stats['busy'], 1e-9):>10.1f}"
+              f"{stats['busy']:>10.1f}{stats['idle']:>10.1f}{100 * stats['idle'] / max(total, 1e-9):>8.1f}")
+    num_tiles = sum(stats['tiles'] for stats in all_stats)
+    print(f"{num_tiles} tiles in {wall_time:.1f} s ({num_tiles / max(wall_time, 1e-9):.1f} tiles/s)")
+
+
+def create_tiles_based_on_mask(input_tif, output_dir, mask_file, window_size, pickle_dir, overwrite=False,
+                               encoding='float32', compress='none', predictor=None, tiles_per_batch=16, raw=False,
+                               worker_timeout=None):
     """
     Create tiles from the input raster based on an optional mask. 
     Tiles are processed in parallel using MPI.
 
+    Rank 0 coordinates: it hands out batches of tiles (runs of up to `tiles_per_batch` tiles of a tile
+    row, read with a single strip read) to the other ranks on demand. Each worker keeps the input open
+    for the whole run. With a single rank, rank 0 cuts every batch itself. The run fails if the
+    completed tiles do not match the mask in the end. A rank that raises, or (with `worker_timeout`)
+    a worker that stops requesting batches, aborts the whole job instead of leaving the others waiting.
+
+    Each rank records its completed tiles in its own part of the output directory's manifest
+    (see tile_manifest.py), so reruns only cut the tiles that are missing or stale.
+
+    Example, locally: mpirun -n 4 python cut_tiles_distributed.py --input_tif ... --output_dir ... --pickle_dir ...
+
     :param input_tif: Path to input raster file.
     :param output_dir: Directory to save output tiles.
-    :param mask_file: Optional path to mask file.
+    :param mask_file: Optional path to a mask (.npy) or sampling plan (.npz) file.
     :param window_size: Size of the tiles to cut.
     :param pickle_dir: Directory with cached statistics.
-    :param overwrite: If true, overwrite existing tiles.
+    :param overwrite: If true, discard the manifest and cut every tile again.
+    :param encoding: Storage encoding of the tiles, 'float32' or 'int16' (see tile_encoding.py).
+    :param compress: GeoTIFF compression.
+    :param predictor: GeoTIFF predictor. Defaults to the one suited to the tiles' dtype.
+    :param tiles_per_batch: Maximum number of tiles handed out at once.
+    :param raw: Store raw tiles, only padded and with NaNs zeroed, to be normalized at load time.
+        Requires an exact encoding (tile_encoding.RAW_ENCODINGS).
+    :param worker_timeout: Seconds a worker may take to cut a batch before the job is aborted. Defaults to no limit.
     """
+    if raw:
+        check_raw_encoding(encoding)
     comm = MPI.COMM_WORLD
     rank, size = comm.Get_rank(), comm.Get_size()
 
-    if not os.path.exists(output_dir) or overwrite:
+    with rasterio.open(input_tif) as src:
+        height, width = src.height, src.width
+    mask = load_tile_mask(mask_file) if mask_file else None
+
+    band_names = [str(i) for i in range(1, 27)]
+    global_stats_dict = {band_name: cache_global_stats(band_name, pickle_dir) for band_name in band_names}
+    plan = build_transform_plan(band_names, global_stats_dict, window_size, raw)
+    tile_encoding = build_tile_encoding(plan, global_stats_dict, band_names, encoding)
+    dtype = storage_dtype(tile_encoding)
+    profile = {'dtype': str(dtype), **creation_options(dtype, compress, predictor)}
+
+    # Rank 0 reads the manifest and plans the batches
+    if rank == 0:
         os.makedirs(output_dir, exist_ok=True)
+        fingerprint = run_fingerprint(input_tif, global_stats_dict, window_size, 'tif', encoding, compress, predictor,
+                                      *(('raw',) if raw else ()))
+        if overwrite:
+            clear_manifest(output_dir)
+        completed = load_manifest(output_dir, fingerprint)
 
-        if mask_file:
-            mask = np.load(mask_file)
+        # Row-major runs, so consecutive batches read neighbouring blocks of the input
+        runs = list(iter_tile_runs(height, width, window_size, mask=mask, full_tiles=True,
+                                   max_tiles_per_read=tiles_per_batch))
+        expected = {f'tile_{i}_{j}.tif' for i, js in runs for j in js}
+        batches = [(i, [j for j in js if f'tile_{i}_{j}.tif' not in completed]) for i, js in runs]
+        batches = [(i, js) for i, js in batches if js]
+        print(f"{len(expected) - sum(len(js) for _, js in batches)} tiles already completed, "
+              f"{sum(len(js) for _, js in batches)} tiles to cut in {len(batches)} batches on {max(size - 1, 1)} ranks.")
+    else:
+        fingerprint = None
+    fingerprint = comm.bcast(fingerprint, root=0)
+
+    comm.Barrier()
+    wall_start = time.perf_counter()
+    manifest = ManifestWriter(output_dir, fingerprint, f'rank_{rank}')
+    try:
+        if size == 1:
+            init_worker(input_tif, plan, tile_encoding, profile)
+            stats = {'tiles': 0, 'busy': 0.0, 'idle': 0.0}
+            failed = []
+            for i, js in batches:
+                start = time.perf_counter()
+                tiles_written, entries = cut_tile_run((i, js, window_size, output_dir))
+                for unit, checksum in entries:
+                    manifest.record(unit, checksum)
+                stats['tiles'] += tiles_written
+                stats['busy'] += time.perf_counter() - start
+        elif rank == 0:
+            failed, stats = coordinate(comm, batches, worker_timeout=worker_timeout)
         else:
-            with rasterio.open(input_tif) as src:
-                mask = np.ones((src.height // window_size, src.width // window_size))
-
-        band_names = [str(i) for i in range(1, 27)]
-        global_stats_dict = {band_name: cache_global_stats(band_name, pickle_dir) for band_name in band_names}
-        
-        tasks = [
-            (i, j, window_size, input_tif, os.path.join(output_dir, f'tile_{i}_{j}.tif'), global_stats_dict, band_names)
-            for i in range(mask.shape[0])
-            for j in range(mask.shape[1])
-            if mask[i, j]
-        ]
-        tasks_per_core = len(tasks) // size
-        start_idx, end_idx = rank * tasks_per_core, rank * tasks_per_core + tasks_per_core
-        
-        # Iterate over tasks and run cut_tile
-        for task in tasks[start_idx:end_idx]:
-            cut_tile(task)
+            init_worker(input_tif, plan, tile_encoding, profile)
+            stats = work(comm, window_size, output_dir, manifest)
+    except Exception:
+        if size > 1:
+            # The other ranks would wait for this one forever: keep its manifest and end the job
+            traceback.print_exc()
+            manifest.close()
+            comm.Abort(1)
+        raise
+    finally:
+        manifest.close()
+
+    all_stats = comm.gather(stats, root=0)
+    if rank == 0:
+        print_rank_report(all_stats, time.perf_counter() - wall_start)
+
+        # Every tile of the mask must now be in the manifest
+        missing = expected - set(load_manifest(output_dir, fingerprint))
+        for batch, error in failed:
+            print(f"Batch {batch} failed: {error}")
+        if missing:
+            raise RuntimeError(f"{len(missing)} of the {len(expected)} tiles of the mask are missing, "
+                               f"e.g. {sorted(missing)[:5]}")
+        print(f"All {len(expected)} tiles of the mask are completed.")
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Create tiles from a TIF file based on a mask.')
     parser.add_argument('--input_tif', type=str, help='Input TIF file.')
     parser.add_argument('--output_dir', type=str, help='Output directory to store the tiles.')
     parser.add_argument('--pickle_dir', type=str, help='Directory for pickle files with cached stats.')
-    parser.add_argument('--mask_file', type=str, default=None, help='Optional mask file.')
+    parser.add_argument('--mask_file', type=str, default=None, help='Optional mask (.npy) or sampling plan (.npz) file.')
     parser.add_argument('--window_size', type=int, default=256, help='Tile size.')
-    parser.add_argument('--overwrite', action='store_true', help='Overwrite existing tiles.')
+    parser.add_argument('--overwrite', action='store_true', help='Discard the manifest and cut every tile again.')
+    parser.add_argument('--encoding', type=str, default='float32', choices=GEOTIFF_ENCODINGS,
+                        help='Storage of the continuous bands; binary bands are stored as uint8 unless float32.')
+    parser.add_argument('--compress', type=str, default='none', choices=COMPRESSIONS, help='GeoTIFF compression.')
+    parser.add_argument('--predictor', type=int, default=None, choices=[1, 2, 3],
+                        help='GeoTIFF predictor. Defaults to 2 for integer and 3 for float tiles.')
+    parser.add_argument('--tiles_per_batch', type=int, default=16, help='Maximum number of tiles handed out at once.')
+    parser.add_argument('--raw', action='store_true', help='Store raw tiles, normalized at load time by the model pipeline.')
+    parser.add_argument('--worker_timeout', type=float, default=None,
+                        help='Seconds a worker may take to cut a batch before the job is aborted. Defaults to no limit.')
 
     args = parser.parse_args()
-    create_tiles_based_on_mask(args.input_tif, args.output_dir, args.mask_file, args.window_size, args.pickle_dir, args.overwrite)
+    create_tiles_based_on_mask(args.input_tif, args.output_dir, args.mask_file, args.window_size, args.pickle_dir, args.overwrite,
+                               args.encoding, args.compress, args.predictor, args.tiles_per_batch, args.raw,
+                               args.worker_timeout)
@@ -0,0 +1,44 @@
+import os
+import hashlib
+
+
+def file_fingerprint(file_path, num_samples=16, sample_size=1 << 16):
+    """
+    Compute a cheap fingerprint of a (large) file.
+
+    The fingerprint hashes the file size, its modification time (in ns) and `num_samples` evenly
+    spaced chunks of the file (including its first and last bytes), costing a handful of reads
+    instead of a full pass over the file. The modification time catches edits outside the sampled
+    chunks, which the samples alone would miss. The tradeoff is that a file copied or touched
+    without changing its content gets a new fingerprint, so results keyed on it (stats partials,
+    tile manifests, stage stamps) are recomputed: a wasted pass, never a stale result.
+
+    :param file_path: Path to the file.
+    :param num_samples: Number of chunks to sample from the file.
+    :param sample_size: Size of each sampled chunk in bytes.
+    :return: Hex digest identifying the file content.
+    """
+    stat = os.stat(file_path)
+    size = stat.st_size
+    digest = hashlib.sha1(f'{size}:{stat.st_mtime_ns}'.encode())
+
+    with open(file_path, 'rb') as f:
+        if size <= num_samples * sample_size:
+            digest.update(f.read())
+        else:
+            step = (size - sample_size) // (num_samples - 1)
+            for k in range(num_samples):
+                f.seek(k * step)
+                digest.update(f.read(sample_size))
+
+    return digest.hexdigest()
+
+
+def params_fingerprint(*params):
+    """
+    Compute a fingerprint of a set of (repr-able) parameters.
+
+    :param params: Parameters to hash.
+    :return: Hex digest identifying the parameters.
+    """
+    return hashlib.sha1(repr(params).encode()).hexdigest()
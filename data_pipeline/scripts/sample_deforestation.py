@@ -1,57 +1,204 @@
+import os
 import numpy as np
 import rasterio
 from rasterio.windows import Window
 import argparse
 import math
+from tqdm import tqdm
+from windows import windowed_imap
 
 
-def generate_mask(input_files, output_mask, window_size):
+def fraction_path(output_mask):
+    """
+    Get the path of the per-tile deforestation fraction saved next to a mask.
+
+    :param output_mask: Path of the mask.
+    :return: Path of the fraction array.
+    """
+    root, ext = os.path.splitext(output_mask)
+    return f'{root}_fraction{ext or ".npy"}'
+
+
+def block_counts(condition, window_size):
+    """
+    Count the pixels where a condition holds in each tile of a strip.
+
+    The strip is padded to whole tiles and reduced with a reshape into (tile rows, window size,
+    tile columns, window size) blocks, so no Python loop runs over the tiles.
+
+    :param condition: Boolean array of shape (rows, cols).
+    :param window_size: Tile size in pixels.
+    :return: Int64 counts of shape (tile rows, tile columns).
+    """
+    rows, cols = math.ceil(condition.shape[0] / window_size), math.ceil(condition.shape[1] / window_size)
+    padded = np.zeros((rows * window_size, cols * window_size), dtype=bool)
+    padded[:condition.shape[0], :condition.shape[1]] = condition
+    return padded.reshape(rows, window_size, cols, window_size).sum(axis=(1, 3), dtype=np.int64)
+
+
+def strip_tile_counts(args):
+    """
+    Read a strip of whole tile rows of a file and count, in each of its tiles, the pixels equal to 1
+    and the valid (not no-data) pixels.
+
+    :param args: Tuple of (input file, first tile row, number of tile rows, window size).
+    :return: Tuple of (input file, first tile row, positive counts, valid counts), the counts being
+        int64 arrays of shape (tile rows read, tile columns).
+    """
+    input_file, tile_row, num_tile_rows, window_size = args
+    with rasterio.open(input_file) as src:
+        row_off = tile_row * window_size
+        height = min(num_tile_rows * window_size, src.height - row_off)
+        strip = src.read(1, window=Window(0, row_off, src.width, height))
+        nodata = src.nodata
+
+    valid = ~np.isnan(strip) if strip.dtype.kind == 'f' else np.ones(strip.shape, dtype=bool)
+    if nodata is not None:
+        valid &= strip != nodata
+    return input_file, tile_row, block_counts(strip == 1, window_size), block_counts(valid, window_size)
+
+
+def tile_pixel_counts(height, width, window_size):
+    """
+    Count the pixels of every tile of a grid, smaller for the partial tiles at the right and bottom edges.
+
+    :param height: Raster height in pixels.
+    :param width: Raster width in pixels.
+    :param window_size: Tile size in pixels.
+    :return: Int64 array of shape (tile rows, tile columns).
+    """
+    rows = np.minimum(window_size, height - np.arange(0, height, window_size))
+    cols = np.minimum(window_size, width - np.arange(0, width, window_size))
+    return np.outer(rows, cols).astype(np.int64)
+
+
+def generate_mask(input_files, output_mask, window_size, tile_rows_per_read=1):
     """
     Generate a mask from a list of input TIF files.
 
-    :param input_files: List of paths to input TIF files.
+    A tile is in the mask if any of its pixels equals 1 in any of the input files. Files are read
+    in strips of whole tile rows, with all (file, strip) pairs processed in parallel. Next to the
+    mask, the per-tile deforestation fraction is saved (see `fraction_path`): the share of the
+    tile's pixels equal to 1, summed over the input files and clipped to 1. For yearly
+    deforestation layers, where a pixel is deforested in at most one year, this is the share of
+    the tile deforested over all years.
+
+    :param input_files: List of paths to input TIF files, all on the same grid.
     :param output_mask: Path to save the generated mask.
     :param window_size: Window size for processing the TIFs.
+    :param tile_rows_per_read: Number of tile rows read at once per file.
+    :return: Tuple of (boolean mask, float32 fraction, boolean validity), all of shape
+        (tile rows, tile columns). A tile is valid if it has data in any of the input files.
     """
-    # Initialize masks as None
-    masks = None
+    with rasterio.open(input_files[0]) as src:
+        img_height, img_width = src.height, src.width
+    print(f"Image size: {img_height} rows x {img_width} cols")
 
-    for input_file in input_files:
-        # Open the tiff file
+    num_windows_y, num_windows_x = math.ceil(img_height / window_size), math.ceil(img_width / window_size)
+    print(f"Number of windows: {num_windows_y} rows x {num_windows_x} cols")
+
+    for input_file in input_files[1:]:
         with rasterio.open(input_file) as src:
-            img_width, img_height = src.shape
-            print(f"Image size: {img_height} rows x {img_width} cols")
-
-            num_windows_x = math.ceil(img_width / window_size)
-            num_windows_y = math.ceil(img_height / window_size)
-            print(f"Number of windows: {num_windows_y} rows x {num_windows_x} cols")
-
-            if masks is None:
-                masks = np.zeros((num_windows_y, num_windows_x), dtype=bool)
-
-            mean = 0
-            anomalies = 0
-
-            for i in range(num_windows_y):
-                for j in range(num_windows_x):
-                    window = Window(j * window_size, i * window_size, window_size, window_size)
-                    data = src.read(1, window=window)
-
-                    if data.size == 0:
-                        anomalies += 1
-                        continue
-                    
-                    mask_condition = data == 1
-                    masks[i, j] |= np.any(mask_condition)
-                    if masks[i, j]:
-                        mean += np.mean(mask_condition)
-
-            print(f"Number of anomalies: {anomalies}")
-            print(f"Sum: {mean}")
-            print(f"Normalized Mean: {mean / np.sum(masks)}")
-            print(f"Mask 1's Ratio: {np.sum(masks) / np.size(masks)}")
+            if (src.height, src.width) != (img_height, img_width):
+                raise ValueError(f"{input_file} is {src.height}x{src.width}, expected {img_height}x{img_width}")
+
+    counts = {input_file: np.zeros((num_windows_y, num_windows_x), dtype=np.int64) for input_file in input_files}
+    valid = np.zeros((num_windows_y, num_windows_x), dtype=bool)
+    tasks = [(input_file, i, tile_rows_per_read, window_size)
+             for input_file in input_files for i in range(0, num_windows_y, tile_rows_per_read)]
+
+    for input_file, i, strip_counts, valid_counts in tqdm(windowed_imap(strip_tile_counts, tasks), total=len(tasks),
+                                                          desc='Reducing strips'):
+        counts[input_file][i:i + strip_counts.shape[0]] = strip_counts
+        valid[i:i + valid_counts.shape[0]] |= valid_counts > 0
+
+    pixels = tile_pixel_counts(img_height, img_width, window_size)
+    masks = np.zeros((num_windows_y, num_windows_x), dtype=bool)
+    total = np.zeros((num_windows_y, num_windows_x), dtype=np.int64)
+    for input_file in input_files:
+        masks |= counts[input_file] > 0
+        total += counts[input_file]
+        print(f"{input_file}: {np.count_nonzero(counts[input_file])} tiles with deforestation")
+    fraction = np.minimum(total / pixels, 1).astype(np.float32)
+
+    print(f"Normalized Mean: {fraction[masks].mean() if masks.any() else 0}")
+    print(f"Mask 1's Ratio: {np.sum(masks) / np.size(masks)}")
 
     np.save(output_mask, masks)
+    np.save(fraction_path(output_mask), fraction)
+    return masks, fraction, valid
+
+
+def build_sampling_plan(fraction, valid, negative_fraction=0.1, strategy='random', block_size=16, seed=0):
+    """
+    Build a tile sampling plan keeping every positive tile and a fraction of the negative ones.
+
+    Positive tiles have a non-zero deforestation fraction; negative tiles have none but do have data.
+    With the 'random' strategy, negatives are drawn uniformly over the whole grid. With 'spatial',
+    the grid is split into blocks of block_size x block_size tiles and each block contributes the
+    same fraction of its negatives, so the kept negatives cover the whole area evenly.
+
+    Every kept tile gets a sampling weight equal to its inverse inclusion probability (1 for
+    positives, available / kept negatives of its stratum for negatives), so weighted losses or
+    metrics over the sampled tiles estimate those over all tiles. The negatives of a stratum too
+    small to keep any tile are left out of the estimate.
+
+    :param fraction: Per-tile deforestation fraction, as returned by `generate_mask`.
+    :param valid: Per-tile validity, as returned by `generate_mask`.
+    :param negative_fraction: Fraction of the negative tiles to keep.
+    :param strategy: 'random' or 'spatial'.
+    :param block_size: Size in tiles of the spatial strata.
+    :param seed: Random seed.
+    :return: Dictionary of (tile rows, tile columns) arrays: 'mask' (uint8, 1 for kept tiles),
+        'weight' (float32, 0 for dropped tiles), 'fraction' and 'positive'.
+    """
+    rng = np.random.default_rng(seed)
+    positive = fraction > 0
+    negative = valid & ~positive
+
+    if strategy == 'random':
+        strata = np.zeros(fraction.shape, dtype=np.int64)
+    elif strategy == 'spatial':
+        rows, cols = np.indices(fraction.shape)
+        strata = (rows // block_size) * math.ceil(fraction.shape[1] / block_size) + cols // block_size
+    else:
+        raise ValueError(f"Unknown sampling strategy {strategy}, expected 'random' or 'spatial'")
+
+    keep = positive.copy()
+    weight = positive.astype(np.float32)
+    flat_strata = strata[negative]
+    flat_indices = np.flatnonzero(negative)
+    for stratum in np.unique(flat_strata):
+        candidates = flat_indices[flat_strata == stratum]
+        # Stochastic rounding keeps the expected number of kept negatives exact for small strata
+        expected = negative_fraction * len(candidates)
+        num_kept = int(expected) + (rng.random() < expected - int(expected))
+        if num_kept == 0:
+            continue
+        kept = rng.choice(candidates, num_kept, replace=False)
+        keep.flat[kept] = True
+        weight.flat[kept] = len(candidates) / num_kept
+
+    print(f"Sampling plan: {positive.sum()} positive and {keep.sum() - positive.sum()} of {negative.sum()} "
+          f"negative tiles kept ({keep.sum()} of {valid.sum()} valid tiles)")
+    return {
+        'mask': keep.astype(np.uint8),
+        'weight': weight,
+        'fraction': fraction.astype(np.float32),
+        'positive': positive,
+    }
+
+
+def save_sampling_plan(output_plan, plan, window_size, **params):
+    """
+    Save a sampling plan. cut_tiles.py accepts it as --mask_file and only cuts the kept tiles.
+
+    :param output_plan: Path of the .npz plan.
+    :param plan: Plan as returned by `build_sampling_plan`.
+    :param window_size: Tile size the plan's grid refers to.
+    :param params: Sampling parameters recorded in the plan.
+    """
+    np.savez(output_plan, window_size=window_size, params=repr(params), **plan)
 
 
 if __name__ == "__main__":
@@ -59,7 +206,19 @@ if __name__ == "__main__":
     parser.add_argument('--input_files', type=str, nargs='+', help='List of input TIF files.')
     parser.add_argument('--output_mask', type=str, help='Output file to save the mask.')
     parser.add_argument('--window_size', type=int, default=256, help='Window size for processing the TIFs.')
+    parser.add_argument('--tile_rows_per_read', type=int, default=1, help='Number of tile rows read at once per file.')
+    parser.add_argument('--output_plan', type=str, default=None,
+                        help='Output .npz sampling plan keeping all positive and a fraction of the negative tiles.')
+    parser.add_argument('--negative_fraction', type=float, default=0.1, help='Fraction of the negative tiles to keep.')
+    parser.add_argument('--strategy', type=str, default='random', choices=['random', 'spatial'],
+                        help='Draw negatives over the whole grid, or evenly from blocks of tiles.')
+    parser.add_argument('--block_size', type=int, default=16, help='Size in tiles of the spatial strata.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the sampling plan.')
 
     args = parser.parse_args()
 
-    generate_mask(args.input_files, args.output_mask, args.window_size)
+    masks, fraction, valid = generate_mask(args.input_files, args.output_mask, args.window_size, args.tile_rows_per_read)
+    if args.output_plan:
+        plan = build_sampling_plan(fraction, valid, args.negative_fraction, args.strategy, args.block_size, args.seed)
+        save_sampling_plan(args.output_plan, plan, args.window_size, negative_fraction=args.negative_fraction,
+                           strategy=args.strategy, block_size=args.block_size, seed=args.seed)
@@ -1,77 +1,243 @@
 import os
 import glob
-import subprocess
+import uuid
 import argparse
-from tqdm import tqdm
+from functools import partial
+from contextlib import contextmanager
+from task_graph import Task, run_graph
 
-def reproject_and_resample_tif(tif_file, output_file, dst_crs, pixel_size, target_extent, overwrite):
+CREATION_OPTIONS = ['-co', 'COMPRESS=DEFLATE', '-co', 'BIGTIFF=YES', '-co', 'ZLEVEL=1']
+
+# Creation options of the single-pass COG outputs
+COG_OPTIONS = ['COMPRESS=DEFLATE', 'LEVEL=1', 'BIGTIFF=YES', 'BLOCKSIZE=512']
+
+
+def warp_tuning(gdal_threads, warp_memory):
+    """
+    Get the gdalwarp options that speed it up without changing its output.
+
+    :param gdal_threads: Number of threads used for warping and compression.
+    :param warp_memory: Working memory of gdalwarp in MB.
+    :return: List of gdalwarp options.
+    """
+    return ['-multi', '-wo', f'NUM_THREADS={gdal_threads}', '-co', f'NUM_THREADS={gdal_threads}',
+            '-wm', str(warp_memory), '--config', 'GDAL_CACHEMAX', str(warp_memory)]
+
+
+# Sidecar files of a shapefile that affect the cutline: attributes, index, projection and encoding
+SHAPEFILE_SIDECARS = ['.shx', '.dbf', '.prj', '.cpg']
+
+
+def shapefile_inputs(shapefile):
+    """
+    Get the files making up a shapefile, to list as task inputs.
+
+    :param shapefile: Path of the .shp file.
+    :return: The .shp file followed by its existing sidecar files.
+    """
+    root = os.path.splitext(shapefile)[0]
+    sidecars = [root + ext for ext in SHAPEFILE_SIDECARS]
+    return [shapefile, *[path for path in sidecars if os.path.exists(path)]]
+
+
+def merge_task(name, tif_files, merged_tif):
+    """
+    Merge multiple TIF files into one.
+    """
+    return Task(name, merged_tif, tif_files, ['gdal_merge.py', '-o', merged_tif, *tif_files])
+
+
+def reproject_and_resample_task(name, tif_file, output_file, dst_crs, pixel_size, target_extent, deps, tuning):
     """
     Reproject and resample a given TIF file.
     """
-    if overwrite or not os.path.exists(output_file):
-        gdalwarp_cmd = [
-            'gdalwarp', '-overwrite', '-t_srs', dst_crs, '-tr', str(pixel_size), str(pixel_size), '-r', 'near',
-            '-te', *map(str, target_extent), '-tap', '-of', 'GTiff', '-co', 'COMPRESS=DEFLATE', 
-            '-co', 'BIGTIFF=YES', '-co', 'ZLEVEL=1', tif_file, output_file
-        ]
-        subprocess.check_call(gdalwarp_cmd)
+    cmd = [
+        'gdalwarp', '-overwrite', '-t_srs', dst_crs, '-tr', str(pixel_size), str(pixel_size), '-r', 'near',
+        '-te', *map(str, target_extent), '-tap', '-of', 'GTiff', *CREATION_OPTIONS, tif_file, output_file
+    ]
+    return Task(name, output_file, [tif_file], cmd, deps, tuning)
 
-def cut_tif(input_tif, output_tif, shapefile, overwrite):
+
+def cut_task(name, input_tif, output_tif, shapefile, deps, tuning):
     """
     Cut the TIF file based on a shapefile.
     """
-    if overwrite or not os.path.exists(output_tif):
-        gdalwarp_cmd = [
-            'gdalwarp', '-overwrite', '-cutline', shapefile, '-crop_to_cutline', '-of', 'GTiff',
-            '-co', 'COMPRESS=DEFLATE', '-co', 'BIGTIFF=YES', '-co', 'ZLEVEL=1',
-            input_tif, output_tif
-        ]
-        subprocess.check_call(gdalwarp_cmd)
+    cmd = [
+        'gdalwarp', '-overwrite', '-cutline', shapefile, '-crop_to_cutline', '-of', 'GTiff', *CREATION_OPTIONS,
+        input_tif, output_tif
+    ]
+    return Task(name, output_tif, [input_tif, *shapefile_inputs(shapefile)], cmd, deps, tuning)
+
 
-def merge_tifs(tif_files, merged_tif, overwrite):
+@contextmanager
+def thread_config(gdal, options):
     """
-    Merge multiple TIF files into one.
+    Set GDAL config options for the calling thread only, as the `--config` options of a command.
+
+    Unlike `gdal.SetConfigOption`, this does not leak into warps run concurrently by other
+    `run_graph` workers. The previous values are restored on exit.
+
+    :param gdal: The osgeo.gdal module.
+    :param options: Mapping of config option names to values.
     """
-    if overwrite or not os.path.exists(merged_tif):
-        gdal_merge_cmd = ['gdal_merge.py', '-o', merged_tif, *tif_files]
-        subprocess.check_call(gdal_merge_cmd)
+    previous = {key: gdal.GetThreadLocalConfigOption(key, None) for key in options}
+    for key, value in options.items():
+        gdal.SetThreadLocalConfigOption(key, str(value))
+    try:
+        yield
+    finally:
+        for key, value in previous.items():
+            gdal.SetThreadLocalConfigOption(key, value)
+
 
-def process_dir(input_dir, output_dir, shapefile, dst_crs, pixel_size, target_extent, overwrite):
+def warp_single_pass(tif_files, output_dir, shapefile, dst_crs, pixel_size, target_extent, gdal_threads=1,
+                     warp_memory=512, keep_intermediates=False):
     """
-    Process directory containing TIF files: merge, reproject, resample, and cut.
+    Merge, reproject, resample and cut TIF files in one pass, writing a single tiled, compressed COG.
+
+    The inputs are mosaicked by a VRT (kept in memory), warped onto the target-aligned `pixel_size`
+    grid of `target_extent` by a warped VRT, and cut from it with the options of the cut stage.
+    This gives the grid of the merge, reproject and cut stages, including when the cutline extends
+    past the target extent, while only cut.tif is materialized. With `keep_intermediates`, the VRT
+    is written as merged.vrt and the reprojected raster as reprojected_and_resampled.tif, for debugging.
+
+    :param tif_files: Input TIF files.
+    :param output_dir: Directory of the outputs; the result is cut.tif.
+    :param shapefile: Shapefile to cut the TIFs to.
+    :param dst_crs: Destination CRS.
+    :param pixel_size: Pixel size of the output.
+    :param target_extent: Target extent [xmin, ymin, xmax, ymax] of the intermediate reprojected raster.
+    :param gdal_threads: Number of threads used for warping and compression.
+    :param warp_memory: Working memory and block cache of the warp in MB.
+    :param keep_intermediates: Also write the intermediate rasters.
+    """
+    from osgeo import gdal
+    gdal.UseExceptions()
+
+    vrt_path = os.path.join(output_dir, 'merged.vrt') if keep_intermediates else f'/vsimem/{uuid.uuid4().hex}.vrt'
+    reprojected_path = (os.path.join(output_dir, 'reprojected_and_resampled.tif') if keep_intermediates
+                        else f'/vsimem/{uuid.uuid4().hex}.vrt')
+    tuning = dict(multithread=True, warpMemoryLimit=warp_memory * 2 ** 20, warpOptions=[f'NUM_THREADS={gdal_threads}'])
+    vrt = reprojected = None
+    with thread_config(gdal, {'GDAL_CACHEMAX': warp_memory}):
+        try:
+            vrt = gdal.BuildVRT(vrt_path, tif_files)
+            reprojected = gdal.Warp(reprojected_path, vrt, format='GTiff' if keep_intermediates else 'VRT',
+                                    dstSRS=dst_crs, xRes=pixel_size, yRes=pixel_size, resampleAlg='near',
+                                    outputBounds=target_extent, targetAlignedPixels=True,
+                                    creationOptions=CREATION_OPTIONS[1::2] if keep_intermediates else None, **tuning)
+            gdal.Warp(os.path.join(output_dir, 'cut.tif'), reprojected, format='COG', cutlineDSName=shapefile,
+                      cropToCutline=True, creationOptions=[*COG_OPTIONS, f'NUM_THREADS={gdal_threads}'], **tuning)
+        finally:
+            reprojected = vrt = None
+            for path in (reprojected_path, vrt_path):
+                if not keep_intermediates and gdal.VSIStatL(path) is not None:
+                    gdal.Unlink(path)
+
+
+def single_pass_task(name, tif_files, output_dir, shapefile, dst_crs, pixel_size, target_extent, gdal_threads,
+                     warp_memory, keep_intermediates):
+    """
+    Build the task running `warp_single_pass` on a directory's TIF files.
     """
-    tif_files = glob.glob(os.path.join(input_dir, '*.tif'))
-    
-    os.makedirs(output_dir, exist_ok=True)
-    
+    cmd = ['warp_single_pass', dst_crs, pixel_size, list(target_extent or []), *COG_OPTIONS, *tif_files]
+    fn = partial(warp_single_pass, tif_files, output_dir, shapefile, dst_crs, pixel_size, target_extent,
+                 gdal_threads, warp_memory, keep_intermediates)
+    return Task(name, os.path.join(output_dir, 'cut.tif'), [*tif_files, *shapefile_inputs(shapefile)], cmd, fn=fn)
+
+
+def dir_tasks(input_dir, output_dir, label, shapefile, dst_crs, pixel_size, target_extent, gdal_threads, warp_memory,
+              single_pass=False, keep_intermediates=False):
+    """
+    Build the tasks processing a directory containing TIF files: merge, reproject, resample, and cut.
+
+    :param input_dir: Directory of the raw TIF files.
+    :param output_dir: Directory of the stage outputs.
+    :param label: Prefix of the task names, e.g. 'forest/2015'.
+    :param shapefile: Shapefile to cut the TIFs to.
+    :param dst_crs: Destination CRS.
+    :param pixel_size: Pixel size of the reprojected TIFs.
+    :param target_extent: Target extent [xmin, ymin, xmax, ymax].
+    :param gdal_threads: Number of threads of each warp.
+    :param warp_memory: Working memory of each warp in MB.
+    :param single_pass: Run all stages as one in-process warp (see `warp_single_pass`).
+    :param keep_intermediates: In single-pass mode, also write the intermediate rasters.
+    :return: List of the three Tasks (or the single-pass Task), in dependency order; empty if the
+        directory has no TIF files.
+    """
+    tif_files = sorted(glob.glob(os.path.join(input_dir, '*.tif')))
+    if not tif_files:
+        print(f"No TIF files in {input_dir}, skipping")
+        return []
+    if single_pass:
+        return [single_pass_task(f'{label}/warp', tif_files, output_dir, shapefile, dst_crs, pixel_size, target_extent,
+                                 gdal_threads, warp_memory, keep_intermediates)]
+
+    tuning = warp_tuning(gdal_threads, warp_memory)
     merged_tif = os.path.join(output_dir, 'merged.tif')
-    merge_tifs(tif_files, merged_tif, overwrite)
+    reprojected_tif = os.path.join(output_dir, 'reprojected_and_resampled.tif')
+    cut_tif = os.path.join(output_dir, 'cut.tif')
 
-    reprojected_and_resampled_tif = os.path.join(output_dir, 'reprojected_and_resampled.tif')
-    reproject_and_resample_tif(merged_tif, reprojected_and_resampled_tif, dst_crs, pixel_size, target_extent, overwrite)
+    merge = merge_task(f'{label}/merge', tif_files, merged_tif)
+    reproject = reproject_and_resample_task(f'{label}/reproject', merged_tif, reprojected_tif, dst_crs, pixel_size,
+                                            target_extent, [merge.name], tuning)
+    cut = cut_task(f'{label}/cut', reprojected_tif, cut_tif, shapefile, [reproject.name], tuning)
+    return [merge, reproject, cut]
 
-    cut_tif_file = os.path.join(output_dir, 'cut.tif')
-    cut_tif(reprojected_and_resampled_tif, cut_tif_file, shapefile, overwrite)
 
-def main(root_dir, output_dir, years, shapefile, dst_crs, pixel_size, target_extent, overwrite, preprocess_static):
+def feature_name(dir_path):
     """
-    Main function to process directories of TIF files based on year and other conditions.
+    Get the feature name of a '<feature>_<year>' or '<feature>_static' directory.
+    """
+    return "_".join(os.path.basename(dir_path).split('_')[:-1])
+
+
+def build_tasks(root_dir, output_dir, years, shapefile, dst_crs, pixel_size, target_extent, preprocess_static,
+                **kwargs):
     """
-    for year in tqdm(years, desc='Processing years'):
-        year_dirs = glob.glob(os.path.join(root_dir, f'*_{year}'))
+    Build the task graph over feature x year x stage. Static features are processed once, whatever the years.
 
-        for year_dir in year_dirs:
+    :param kwargs: Passed on to `dir_tasks`.
+    :return: List of Tasks.
+    """
+    tasks = []
+    for year in years:
+        for year_dir in sorted(glob.glob(os.path.join(root_dir, f'*_{year}'))):
             if os.path.isdir(year_dir):
-                dir_name_parts = os.path.basename(year_dir).split('_')
-                feature_name = "_".join(dir_name_parts[:-1])
-                process_dir(year_dir, f'{output_dir}/Dynamic/{feature_name}/{year}', shapefile, dst_crs, pixel_size, target_extent, overwrite)
+                feature = feature_name(year_dir)
+                tasks += dir_tasks(year_dir, f'{output_dir}/Dynamic/{feature}/{year}', f'{feature}/{year}',
+                                   shapefile, dst_crs, pixel_size, target_extent, **kwargs)
+
+    if preprocess_static:
+        for static_dir in sorted(glob.glob(os.path.join(root_dir, '*_static'))):
+            if os.path.isdir(static_dir):
+                feature = feature_name(static_dir)
+                tasks += dir_tasks(static_dir, f'{output_dir}/Static/{feature}', f'{feature}/static',
+                                   shapefile, dst_crs, pixel_size, target_extent, **kwargs)
+    return tasks
+
+
+def main(root_dir, output_dir, years, shapefile, dst_crs, pixel_size, target_extent, overwrite, preprocess_static,
+         max_workers=4, gdal_threads=None, warp_memory=512, single_pass=False, keep_intermediates=False):
+    """
+    Main function to process directories of TIF files based on year and other conditions.
+
+    Every (feature, year) directory goes through the merge, reproject and cut stages, or through a
+    single in-process warp with `single_pass`. Stages of different directories run concurrently,
+    up to `max_workers` at once. A stage is skipped when its output was produced from inputs and
+    parameters with the same hash (see task_graph.py).
+    """
+    gdal_threads = gdal_threads or max(1, os.cpu_count() // max_workers)
+    tasks = build_tasks(root_dir, output_dir, years, shapefile, dst_crs, pixel_size, target_extent,
+                        preprocess_static, gdal_threads=gdal_threads, warp_memory=warp_memory,
+                        single_pass=single_pass, keep_intermediates=keep_intermediates)
+    print(f"{len(tasks)} tasks on {max_workers} workers with {gdal_threads} GDAL threads each")
 
-        if preprocess_static:
-            static_dirs = glob.glob(os.path.join(root_dir, '*_static'))
-            for static_dir in static_dirs:
-                dir_name_parts = os.path.basename(static_dir).split('_')
-                feature_name = "_".join(dir_name_parts[:-1])
-                process_dir(static_dir, f'{output_dir}/Static/{feature_name}', shapefile, dst_crs, pixel_size, target_extent, overwrite)
+    status = run_graph(tasks, max_workers=max_workers, overwrite=overwrite)
+    counts = {s: list(status.values()).count(s) for s in ('ran', 'skipped', 'failed', 'blocked')}
+    print(", ".join(f"{count} {s}" for s, count in counts.items()))
+    if counts['failed'] or counts['blocked']:
+        raise RuntimeError(f"{counts['failed']} tasks failed and {counts['blocked']} could not run")
 
 
 if __name__ == "__main__":
@@ -83,9 +249,19 @@ if __name__ == "__main__":
     parser.add_argument('--pixel_size', type=int, default=30, help='Pixel size for the reprojected TIFs.')
     parser.add_argument('--target_extent', type=float, nargs='+', help='Target extent for all rasters [xmin, ymin, xmax, ymax].')
     parser.add_argument('--years', type=int, nargs='+', default=[], help='Years to process.')
-    parser.add_argument('--overwrite', action='store_true', help='Overwrite existing files/folders.')
+    parser.add_argument('--overwrite', action='store_true', help='Rerun every stage, even if its inputs are unchanged.')
     parser.add_argument('--preprocess_static', action='store_true', help='Preprocess static features.')
+    parser.add_argument('--max_workers', type=int, default=4, help='Maximum number of stages running at once.')
+    parser.add_argument('--gdal_threads', type=int, default=None,
+                        help='Threads of each gdalwarp. Defaults to the CPUs divided by --max_workers.')
+    parser.add_argument('--warp_memory', type=int, default=512, help='Working memory and block cache of each gdalwarp in MB.')
+    parser.add_argument('--single_pass', action='store_true',
+                        help='Merge, reproject and cut each directory in one in-process warp, writing a COG.')
+    parser.add_argument('--keep_intermediates', action='store_true',
+                        help='With --single_pass, also write merged.vrt and reprojected_and_resampled.tif.')
 
     args = parser.parse_args()
 
-    main(args.root_dir, args.output_dir, args.years, args.shapefile, args.dst_crs, args.pixel_size, args.target_extent, args.overwrite, args.preprocess_static)
+    main(args.root_dir, args.output_dir, args.years, args.shapefile, args.dst_crs, args.pixel_size, args.target_extent,
+         args.overwrite, args.preprocess_static, args.max_workers, args.gdal_threads, args.warp_memory,
+         args.single_pass, args.keep_intermediates)
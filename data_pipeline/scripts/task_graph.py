@@ -0,0 +1,143 @@
+import os
+import json
+import subprocess
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from fingerprint import file_fingerprint, params_fingerprint
+
+# Suffix of the stamp file written next to a task's output
+STAMP_SUFFIX = '.stamp'
+
+# A command producing one output file. `cmd` is hashed into the stamp together with the content of
+# `inputs`; `tuning` holds options inserted after the program name that do not change the output
+# (e.g. thread counts), so changing them does not invalidate earlier outputs. `deps` lists the names
+# of the tasks producing the inputs. If `fn` is set, the task runs in-process by calling it instead,
+# and `cmd` only describes the call (function name and output-affecting parameters) for the stamp.
+Task = namedtuple('Task', ['name', 'output', 'inputs', 'cmd', 'deps', 'tuning', 'fn'], defaults=[(), (), None])
+
+
+def stamp_path(output):
+    """
+    Get the path of the stamp file of a task output.
+
+    :param output: Path of the output file.
+    :return: Path of the stamp file.
+    """
+    return output + STAMP_SUFFIX
+
+
+def task_stamp(task):
+    """
+    Hash the inputs of a task: the fingerprint of its input files and its command.
+
+    Input files are fingerprinted by size, modification time and sampled content (see
+    `fingerprint.file_fingerprint`), so rewriting an upstream output reruns the tasks downstream of it.
+
+    :param task: Task whose inputs all exist.
+    :return: Hex digest identifying the task inputs.
+    """
+    return params_fingerprint(list(task.cmd), [file_fingerprint(path) for path in task.inputs])
+
+
+def is_fresh(task, stamp):
+    """
+    Check whether a task output exists and was produced from the same inputs.
+
+    :param task: Task.
+    :param stamp: Current stamp of the task, from `task_stamp`.
+    :return: True if the task can be skipped.
+    """
+    if not os.path.exists(task.output) or not os.path.exists(stamp_path(task.output)):
+        return False
+    with open(stamp_path(task.output)) as f:
+        try:
+            return json.load(f)['stamp'] == stamp
+        except (json.JSONDecodeError, KeyError):
+            return False
+
+
+def run_task(task, overwrite=False, env=None):
+    """
+    Run a task unless its output is fresh, and stamp the output on success.
+
+    The stamp is removed before running and only written once the command succeeded, so an
+    interrupted run is redone next time.
+
+    :param task: Task whose dependencies completed.
+    :param overwrite: Run the task even if its output is fresh.
+    :param env: Environment of the command. Defaults to the current environment.
+    :return: True if the command ran, False if the task was skipped.
+    """
+    stamp = task_stamp(task)
+    if not overwrite and is_fresh(task, stamp):
+        return False
+
+    if os.path.exists(stamp_path(task.output)):
+        os.remove(stamp_path(task.output))
+    os.makedirs(os.path.dirname(task.output) or '.', exist_ok=True)
+    if task.fn is not None:
+        task.fn()
+    else:
+        subprocess.run([task.cmd[0], *task.tuning, *task.cmd[1:]], check=True, env=env,
+                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    with open(stamp_path(task.output), 'w') as f:
+        json.dump({'stamp': stamp, 'cmd': list(task.cmd)}, f)
+    return True
+
+
+def run_graph(tasks, max_workers=4, overwrite=False, env=None):
+    """
+    Run a graph of tasks with bounded concurrency, each task starting as soon as its dependencies completed.
+
+    Tasks are commands (e.g. GDAL tools) or in-process calls releasing the GIL (e.g. GDAL warps),
+    so they run on threads. A failed task does not stop the others; the tasks depending on it are
+    not run.
+
+    :param tasks: List of Tasks with unique names.
+    :param max_workers: Maximum number of tasks running at once.
+    :param overwrite: Run every task even if its output is fresh.
+    :param env: Environment of the commands. Defaults to the current environment.
+    :return: Dictionary mapping task name to 'ran', 'skipped', 'failed' or 'blocked'.
+    """
+    by_name = {task.name: task for task in tasks}
+    if len(by_name) != len(tasks):
+        raise ValueError("Task names must be unique")
+    for task in tasks:
+        unknown = [dep for dep in task.deps if dep not in by_name]
+        if unknown:
+            raise ValueError(f"Task {task.name} depends on unknown tasks {unknown}")
+
+    status = {}
+    waiting = list(tasks)
+    with ThreadPoolExecutor(max_workers) as executor:
+        running = {}
+        while waiting or running:
+            for task in list(waiting):
+                if any(status.get(dep) in ('failed', 'blocked') for dep in task.deps):
+                    status[task.name] = 'blocked'
+                    waiting.remove(task)
+                    print(f"[{len(status)}/{len(tasks)}] {task.name}: blocked")
+                elif all(status.get(dep) in ('ran', 'skipped') for dep in task.deps):
+                    running[executor.submit(run_task, task, overwrite, env)] = task
+                    waiting.remove(task)
+
+            if not running:
+                if waiting:
+                    # Only tasks on a dependency cycle are left
+                    raise ValueError(f"Dependency cycle between tasks {[task.name for task in waiting]}")
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                try:
+                    status[task.name] = 'ran' if future.result() else 'skipped'
+                except subprocess.CalledProcessError as e:
+                    status[task.name] = 'failed'
+                    print(f"{task.name} failed with exit code {e.returncode}:\n{e.output.decode(errors='replace')}")
+                except Exception as e:
+                    status[task.name] = 'failed'
+                    print(f"{task.name} failed: {e!r}")
+                print(f"[{len(status)}/{len(tasks)}] {task.name}: {status[task.name]}")
+
+    return status
@@ -0,0 +1,186 @@
+import numpy as np
+from collections import namedtuple
+from band_transforms import PASSTHROUGH_BANDS, apply_transform_plan
+
+# Encodings of the continuous bands. Binary and small integer bands are stored as uint8 by every
+# encoding except float32, which keeps the processed tiles unchanged.
+ENCODINGS = ['float32', 'float16', 'int16']
+
+# Encodings raw tiles (cut_tiles.py --raw) can be stored with. The load-time normalization tests
+# raw values against 0 (binarization, zero-fill), which only exact storage preserves: quantized
+# int16 does not decode 0 to 0, and uint8 rounds fractional raw values.
+RAW_ENCODINGS = ['float32']
+
+# Encodings single GeoTIFF tiles can be stored with; float16 tiles need shards (see storage_dtype)
+GEOTIFF_ENCODINGS = ['float32', 'int16']
+
+# GeoTIFF creation options selectable for the tiles
+COMPRESSIONS = ['none', 'deflate', 'lzw', 'zstd']
+
+# Tile encoding. Each band is stored as round((value - offset) / scale) for integer dtypes and as
+# value for float dtypes (scale 1, offset 0). `groups` lists the (dtype, band indexes) of the bands
+# sharing a dtype, in band order of their first band.
+TileEncoding = namedtuple('TileEncoding', ['name', 'dtypes', 'scales', 'offsets', 'groups'])
+
+
+def transformed_ranges(plan, global_stats_dict, band_names):
+    """
+    Get the range of each band after the transform plan, from the global min and max of the raw bands.
+
+    Every transform of the plan is monotonic, except for the zero-fill which maps 0 to the band mean,
+    so the transformed range is spanned by the transformed min, the value just above it, the max and 0
+    (the value of NaN and padding pixels).
+
+    :param plan: TransformPlan applied to the tiles.
+    :param global_stats_dict: Dictionary containing global statistics for each band.
+    :param band_names: List of band names, in band order.
+    :return: Tuple of (low, high) float64 arrays.
+    """
+    mins = np.array([global_stats_dict[band_name][2] for band_name in band_names], dtype=np.float32)
+    maxs = np.array([global_stats_dict[band_name][3] for band_name in band_names], dtype=np.float32)
+    probe = np.stack([mins, np.nextafter(mins, np.float32(np.inf)), maxs, np.zeros_like(mins)], axis=1)[:, None, :]
+    transformed = apply_transform_plan(probe, plan)[:, 0, :4].astype(np.float64)
+    return transformed.min(axis=1), transformed.max(axis=1)
+
+
+def build_tile_encoding(plan, global_stats_dict, band_names, encoding='float32'):
+    """
+    Choose the storage dtype, scale and offset of every band of the processed tiles.
+
+    With 'float16' or 'int16', binary and small integer bands (7-12 and 19-25, if their global range
+    fits) are stored exactly as uint8, and continuous bands as float16 or as int16 quantized linearly
+    over their transformed global range. Values outside the global range (e.g. pixels outside the
+    cutline used for the statistics) saturate at its ends.
+
+    :param plan: TransformPlan applied to the tiles.
+    :param global_stats_dict: Dictionary containing global statistics for each band.
+    :param band_names: List of band names, in band order.
+    :param encoding: One of ENCODINGS.
+    :return: TileEncoding.
+    """
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unknown encoding {encoding}, expected one of {ENCODINGS}")
+
+    num_bands = len(band_names)
+    scales, offsets = np.ones(num_bands), np.zeros(num_bands)
+    if encoding == 'float32':
+        dtypes = [np.dtype(np.float32)] * num_bands
+    else:
+        low, high = transformed_ranges(plan, global_stats_dict, band_names)
+        dtypes = []
+        for b, band_name in enumerate(band_names):
+            if int(band_name) in PASSTHROUGH_BANDS and low[b] >= 0 and high[b] <= 255:
+                dtypes.append(np.dtype(np.uint8))
+            elif encoding == 'float16':
+                dtypes.append(np.dtype(np.float16))
+            else:
+                dtypes.append(np.dtype(np.int16))
+                # Map the range onto [-32767, 32767]
+                offsets[b] = (high[b] + low[b]) / 2
+                scales[b] = (high[b] - low[b]) / 65534 if high[b] > low[b] else 1.0
+
+    groups = {}
+    for b, dtype in enumerate(dtypes):
+        groups.setdefault(dtype, []).append(b)
+
+    return TileEncoding(
+        name=encoding,
+        dtypes=dtypes,
+        scales=scales,
+        offsets=offsets,
+        groups=[(dtype, np.array(bands)) for dtype, bands in groups.items()],
+    )
+
+
+def check_raw_encoding(encoding):
+    """
+    Check that raw tiles can be stored with an encoding.
+
+    :param encoding: One of ENCODINGS.
+    """
+    if encoding not in RAW_ENCODINGS:
+        raise ValueError(f"Raw tiles must be stored exactly, use one of {RAW_ENCODINGS} instead of {encoding}")
+
+
+def storage_dtype(encoding):
+    """
+    Get the single dtype a GeoTIFF tile is written with: the smallest dtype holding every band's
+    encoded values. Integer bands keep their scale and offset in the GeoTIFF metadata.
+
+    :param encoding: TileEncoding.
+    :return: Numpy dtype.
+    """
+    dtype = np.result_type(*[dtype for dtype, _ in encoding.groups])
+    if dtype == np.float16:
+        raise ValueError("GeoTIFF tiles cannot be written as float16, use the int16 encoding or shards")
+    return dtype
+
+
+def encode_bands(tile, encoding, bands, dtype):
+    """
+    Encode some bands of a processed tile.
+
+    :param tile: Processed float32 array of shape (bands, rows, cols).
+    :param encoding: TileEncoding.
+    :param bands: Band indexes (or slice) to encode.
+    :param dtype: Dtype to store the bands with.
+    :return: Array of shape (len(bands), rows, cols).
+    """
+    dtype = np.dtype(dtype)
+    data = tile[bands]
+    if dtype.kind == 'f':
+        return data.astype(dtype)
+
+    scales = encoding.scales[bands].astype(np.float32)[:, None, None]
+    offsets = encoding.offsets[bands].astype(np.float32)[:, None, None]
+    info = np.iinfo(dtype)
+    quantized = np.rint((data - offsets) / scales)
+    # Signed dtypes use a symmetric range, as set up by `build_tile_encoding`
+    np.clip(quantized, -info.max if info.min < 0 else 0, info.max, out=quantized)
+    return quantized.astype(dtype)
+
+
+def encode_tile(tile, encoding):
+    """
+    Encode a processed tile into one array per dtype group.
+
+    :param tile: Processed float32 array of shape (bands, rows, cols).
+    :param encoding: TileEncoding.
+    :return: List of arrays, one per group of `encoding.groups`.
+    """
+    return [encode_bands(tile, encoding, bands, dtype) for dtype, bands in encoding.groups]
+
+
+def decode_tile(data, scales, offsets):
+    """
+    Decode a tile stored with per-band scales and offsets back to float32.
+
+    :param data: Stored array of shape (bands, rows, cols).
+    :param scales: Per-band scales.
+    :param offsets: Per-band offsets.
+    :return: Float32 array; `data` itself if it needs no decoding.
+    """
+    scales, offsets = np.asarray(scales, dtype=np.float32), np.asarray(offsets, dtype=np.float32)
+    if data.dtype == np.float32 and np.all(scales == 1) and np.all(offsets == 0):
+        return data
+    out = data.astype(np.float32)
+    out *= scales[:, None, None]
+    out += offsets[:, None, None]
+    return out
+
+
+def creation_options(dtype, compress='none', predictor=None):
+    """
+    Get the GeoTIFF creation options for the tiles.
+
+    :param dtype: Storage dtype of the tiles.
+    :param compress: One of COMPRESSIONS.
+    :param predictor: TIFF predictor (1: none, 2: horizontal, 3: floating point). Defaults to
+        2 for integer and 3 for float dtypes when compressing.
+    :return: Dictionary of creation options.
+    """
+    if compress == 'none':
+        return {}
+    if predictor is None:
+        predictor = 3 if np.dtype(dtype).kind == 'f' else 2
+    return {'compress': compress, 'predictor': predictor}
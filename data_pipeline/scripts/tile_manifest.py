@@ -0,0 +1,125 @@
+import os
+import json
+import glob
+import hashlib
+from fingerprint import file_fingerprint, params_fingerprint
+
+# Sub-directory of the tiles' output directory holding the manifest parts
+MANIFEST_DIR = 'manifest'
+
+
+def run_fingerprint(input_tif, global_stats_dict, *params):
+    """
+    Fingerprint the inputs of a tiling run: the input raster content, the global statistics and
+    any parameter affecting the written tiles.
+
+    :param input_tif: Path to the input TIF file.
+    :param global_stats_dict: Dictionary containing global statistics for each band.
+    :param params: Other parameters affecting the output (window size, output format, ...).
+    :return: Hex digest identifying the run inputs.
+    """
+    stats = sorted((band_name, tuple(map(str, stats))) for band_name, stats in global_stats_dict.items())
+    return params_fingerprint(file_fingerprint(input_tif), stats, params)
+
+
+def data_checksum(*arrays):
+    """
+    Checksum the content of one or more arrays.
+
+    :param arrays: Numpy arrays.
+    :return: Hex digest of the array bytes.
+    """
+    digest = hashlib.sha1()
+    for array in arrays:
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def output_stat(output_dir, unit):
+    """
+    Get the size and modification time of a unit's output file, identifying the version written.
+
+    :param output_dir: Output directory of the tiles.
+    :param unit: Name of the tile or shard, relative to the output directory.
+    :return: Tuple of (size, mtime_ns), or None if the file does not exist.
+    """
+    try:
+        stat = os.stat(os.path.join(output_dir, unit))
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def load_manifest(output_dir, fingerprint):
+    """
+    Load the completed units (tiles or shards) of a tiling run from all manifest parts.
+
+    The newest entry of each unit across all parts (by the recorded modification time of its
+    output) describes the file on disk, whichever run or MPI rank wrote it. A unit is completed if
+    that entry was recorded under the current fingerprint and the file still has the recorded
+    size and modification time. So a tile overwritten by a run with other inputs is cut again
+    when a run with the original inputs resumes, and a file changed since it was recorded is
+    cut again too.
+
+    :param output_dir: Output directory of the tiles.
+    :param fingerprint: Fingerprint of the current run, from `run_fingerprint`.
+    :return: Dictionary mapping unit name to checksum.
+    """
+    newest = {}
+    for part in sorted(glob.glob(os.path.join(output_dir, MANIFEST_DIR, '*.jsonl'))):
+        with open(part) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Partially written last line of a crashed run
+                    continue
+                # Entries without a recorded stat predate it and never match an output
+                mtime_ns = entry.get('mtime_ns', -1)
+                if entry['unit'] not in newest or mtime_ns >= newest[entry['unit']].get('mtime_ns', -1):
+                    newest[entry['unit']] = entry
+
+    return {unit: entry['checksum'] for unit, entry in newest.items()
+            if entry['fingerprint'] == fingerprint and 'mtime_ns' in entry
+            and output_stat(output_dir, unit) == (entry['size'], entry['mtime_ns'])}
+
+
+def clear_manifest(output_dir):
+    """
+    Remove all manifest parts of an output directory.
+
+    :param output_dir: Output directory of the tiles.
+    """
+    for part in glob.glob(os.path.join(output_dir, MANIFEST_DIR, '*.jsonl')):
+        os.remove(part)
+
+
+class ManifestWriter:
+    """Append-only writer of one manifest part. Each process (or MPI rank) writes its own part."""
+
+    def __init__(self, output_dir, fingerprint, part_name):
+        """
+        :param output_dir: Output directory of the tiles.
+        :param fingerprint: Fingerprint of the current run, from `run_fingerprint`.
+        :param part_name: Name of this writer's part, e.g. 'main' or 'rank_3'.
+        """
+        os.makedirs(os.path.join(output_dir, MANIFEST_DIR), exist_ok=True)
+        self.output_dir = output_dir
+        self.fingerprint = fingerprint
+        self.file = open(os.path.join(output_dir, MANIFEST_DIR, f'{part_name}.jsonl'), 'a')
+
+    def record(self, unit, checksum):
+        """
+        Record a completed unit, with the size and modification time of its output file as written.
+        The entry is flushed immediately so it survives a crash.
+
+        :param unit: Name of the completed tile or shard, relative to the output directory.
+        :param checksum: Checksum of the unit's data.
+        """
+        size, mtime_ns = output_stat(self.output_dir, unit)
+        self.file.write(json.dumps({'unit': unit, 'checksum': checksum, 'fingerprint': self.fingerprint,
+                                    'size': size, 'mtime_ns': mtime_ns}) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,117 @@
+import os
+import json
+import numpy as np
+
+# Files describing a sharded tile store: metadata (JSON) and the tile index (npz)
+STORE_META_FILE = 'store.json'
+STORE_INDEX_FILE = 'index.npz'
+
+
+def shard_name(shard_num, group=0):
+    """
+    Get the file name of a shard. Shards of tiles with several dtypes (see tile_encoding.py) are
+    split into one file per dtype group; the first group's file carries the shard's plain name.
+
+    :param shard_num: Index of the shard.
+    :param group: Index of the dtype group.
+    :return: File name of the shard.
+    """
+    if group == 0:
+        return f'shard_{shard_num:05d}.npy'
+    return f'shard_{shard_num:05d}_g{group}.npy'
+
+
+def plan_shards(runs, tiles_per_shard):
+    """
+    Group runs of tiles into shards of at most `tiles_per_shard` tiles (a single run longer than
+    that gets a shard of its own). Runs keep their row-major order, so each shard covers a
+    contiguous band of the input raster.
+
+    :param runs: Iterable of (tile row, tile columns) runs, as yielded by `windows.iter_tile_runs`.
+    :param tiles_per_shard: Target number of tiles per shard.
+    :return: List of shards, each a list of runs.
+    """
+    shards, current, count = [], [], 0
+    for i, js in runs:
+        if current and count + len(js) > tiles_per_shard:
+            shards.append(current)
+            current, count = [], 0
+        current.append((i, js))
+        count += len(js)
+    if current:
+        shards.append(current)
+    return shards
+
+
+def build_index(shards, transform, tile_size):
+    """
+    Build the index of a sharded tile store.
+
+    :param shards: List of shards as returned by `plan_shards`.
+    :param transform: Affine transform of the input raster.
+    :param tile_size: Tile size in pixels.
+    :return: Dictionary of arrays: tile row and column, shard number, offset in the shard and
+        the 6 affine coefficients (a, b, c, d, e, f) of each tile's transform.
+    """
+    rows, cols, shard_nums, offsets = [], [], [], []
+    for k, runs in enumerate(shards):
+        offset = 0
+        for i, js in runs:
+            for j in js:
+                rows.append(i)
+                cols.append(j)
+                shard_nums.append(k)
+                offsets.append(offset)
+                offset += 1
+
+    rows, cols = np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64)
+    a, b, c, d, e, f = tuple(transform)[:6]
+    x_off, y_off = cols * tile_size, rows * tile_size
+    transforms = np.stack([np.full(len(rows), a), np.full(len(rows), b), c + a * x_off + b * y_off,
+                           np.full(len(rows), d), np.full(len(rows), e), f + d * x_off + e * y_off], axis=1)
+
+    return {
+        'row': rows,
+        'col': cols,
+        'shard': np.array(shard_nums, dtype=np.int64),
+        'offset': np.array(offsets, dtype=np.int64),
+        'transform': transforms,
+    }
+
+
+def write_store_metadata(output_dir, index, num_shards, num_bands, tile_size, crs, encoding, band_names=None, raw=False):
+    """
+    Write the index and metadata of a sharded tile store. Written last, once all shards exist.
+
+    :param output_dir: Directory of the store.
+    :param index: Index as returned by `build_index`.
+    :param num_shards: Number of shards.
+    :param num_bands: Number of bands per tile.
+    :param tile_size: Tile size in pixels.
+    :param crs: CRS of the tiles, as a string.
+    :param encoding: TileEncoding of the tiles (see tile_encoding.py).
+    :param band_names: Datacube band of each channel, e.g. "1" to "26".
+    :param raw: Whether the tiles are raw (cut_tiles.py --raw), to be normalized at load time.
+    """
+    np.savez(os.path.join(output_dir, STORE_INDEX_FILE), **index)
+    meta = {
+        'shards': [shard_name(k) for k in range(num_shards)],
+        'num_tiles': int(len(index['row'])),
+        'num_bands': int(num_bands),
+        'tile_size': int(tile_size),
+        'dtype': str(encoding.groups[0][0]),
+        'crs': crs,
+        'bands': [int(band_name) for band_name in band_names] if band_names is not None else None,
+        'transform': 'raw' if raw else 'processed',
+        'encoding': {
+            'name': encoding.name,
+            'scales': [float(scale) for scale in encoding.scales],
+            'offsets': [float(offset) for offset in encoding.offsets],
+            'groups': [{'dtype': str(dtype),
+                        'bands': [int(b) for b in bands],
+                        'shards': [shard_name(k, g) for k in range(num_shards)]}
+                       for g, (dtype, bands) in enumerate(encoding.groups)],
+        },
+    }
+    with open(os.path.join(output_dir, STORE_META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
@@ -0,0 +1,173 @@
+import os
+import math
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from rasterio.windows import Window
+
+
+def block_shape(src, band=1):
+    """
+    Get the internal block (tile or strip) shape of a band of an open raster.
+
+    :param src: Open rasterio dataset.
+    :param band: 1-based band index.
+    :return: Tuple of (block rows, block cols).
+    """
+    return tuple(src.block_shapes[band - 1])
+
+
+def aligned_size(size, block, limit):
+    """
+    Round a window size to a multiple of the block size, without going below one block
+    or above the raster size.
+
+    :param size: Requested window size in pixels.
+    :param block: Block size in pixels.
+    :param limit: Raster size in pixels.
+    :return: Block-aligned window size.
+    """
+    return min(max(block, (size // block) * block), limit)
+
+
+def plan_windows(src, chunk_size=2048):
+    """
+    Split an open raster into windows aligned to its internal blocks, ordered for sequential I/O.
+
+    Window sizes are rounded to multiples of the block shape so every compressed block is
+    decompressed by exactly one window. For stripped rasters (blocks spanning the full width)
+    the windows are full-width strips of roughly chunk_size x chunk_size pixels. Windows are
+    returned in row-major order, i.e. the order in which GDAL lays out blocks in the file.
+
+    :param src: Open rasterio dataset.
+    :param chunk_size: Target window size in pixels.
+    :return: List of Window objects covering the raster.
+    """
+    block_rows, block_cols = block_shape(src)
+    height, width = src.height, src.width
+
+    if block_cols >= width:
+        # Stripped layout: read full rows, keeping the window area close to chunk_size ** 2
+        rows = aligned_size(math.ceil(chunk_size * chunk_size / width), block_rows, height)
+        cols = width
+    else:
+        rows = aligned_size(chunk_size, block_rows, height)
+        cols = aligned_size(chunk_size, block_cols, width)
+
+    return [Window(col, row, min(cols, width - col), min(rows, height - row))
+            for row in range(0, height, rows) for col in range(0, width, cols)]
+
+
+def load_tile_mask(mask_file):
+    """
+    Load the tiles to cut from a mask (.npy) or a sampling plan (.npz) of sample_deforestation.py.
+
+    :param mask_file: Path to the mask or plan.
+    :return: Boolean array of shape (tile rows, tile columns).
+    """
+    if mask_file.endswith('.npz'):
+        with np.load(mask_file) as plan:
+            return plan['mask'] == 1
+    return np.load(mask_file) == 1
+
+
+def iter_tile_windows(height, width, tile_size, mask=None, full_tiles=False):
+    """
+    Iterate over the windows of a fixed tile grid in row-major order.
+
+    :param height: Raster height in pixels.
+    :param width: Raster width in pixels.
+    :param tile_size: Tile size in pixels.
+    :param mask: Optional (rows, cols) array; only tiles where it is truthy are yielded.
+    :param full_tiles: If True, drop the partial tiles at the right and bottom edges.
+    :return: Generator of (i, j, Window) tuples, where (i, j) is the tile's row and column.
+    """
+    if mask is not None:
+        num_rows, num_cols = mask.shape
+    elif full_tiles:
+        num_rows, num_cols = height // tile_size, width // tile_size
+    else:
+        num_rows, num_cols = math.ceil(height / tile_size), math.ceil(width / tile_size)
+
+    for i in range(num_rows):
+        for j in range(num_cols):
+            if mask is None or mask[i, j]:
+                yield i, j, Window(j * tile_size, i * tile_size, tile_size, tile_size)
+
+
+def iter_tile_runs(height, width, tile_size, mask=None, full_tiles=False, max_tiles_per_read=16):
+    """
+    Group the tiles of a fixed tile grid into horizontal runs that can be read as one strip window.
+
+    Each run holds tiles of a single tile row whose columns span at most `max_tiles_per_read`
+    tiles, so a whole run is covered by one read of at most tile_size x (max_tiles_per_read * tile_size)
+    pixels. Runs are yielded in row-major order.
+
+    :param height: Raster height in pixels.
+    :param width: Raster width in pixels.
+    :param tile_size: Tile size in pixels.
+    :param mask: Optional (rows, cols) array; only tiles where it is truthy are included.
+    :param full_tiles: If True, drop the partial tiles at the right and bottom edges.
+    :param max_tiles_per_read: Maximum number of tile columns spanned by one run.
+    :return: Generator of (i, js) tuples, where i is the tile row and js the sorted tile columns.
+    """
+    row, run = None, []
+    for i, j, _ in iter_tile_windows(height, width, tile_size, mask=mask, full_tiles=full_tiles):
+        if run and (i != row or j - run[0] >= max_tiles_per_read):
+            yield row, run
+            run = []
+        row = i
+        run.append(j)
+    if run:
+        yield row, run
+
+
+def windowed_imap(fn, items, max_workers=None, max_in_flight=None, initializer=None, initargs=()):
+    """
+    Map a function over items in a process pool, keeping a bounded number of tasks in flight.
+
+    Unlike `Pool.map`/`Executor.map`, items are consumed lazily, so neither the task list nor
+    the pending results have to fit in memory. Results are yielded in the order of the items.
+
+    :param fn: Picklable function called with a single item.
+    :param items: Iterable of items (e.g. windows, or tuples of arguments).
+    :param max_workers: Number of worker processes. Defaults to the number of CPUs.
+    :param max_in_flight: Maximum number of submitted but unconsumed tasks. Defaults to 2 * max_workers.
+    :param initializer: Optional function run once in each worker process.
+    :param initargs: Arguments for the initializer.
+    :return: Generator of results.
+    """
+    max_workers = max_workers or os.cpu_count()
+    max_in_flight = max_in_flight or 2 * max_workers
+    items = iter(items)
+
+    with ProcessPoolExecutor(max_workers, initializer=initializer, initargs=initargs) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= max_in_flight:
+                break
+
+        while pending:
+            result = pending.popleft().result()
+            for item in items:
+                pending.append(executor.submit(fn, item))
+                break
+            yield result
+
+
+def windowed_map_reduce(fn, items, reduce_fn, initial, **kwargs):
+    """
+    Map a function over items in a process pool and fold the results as they arrive.
+
+    :param fn: Picklable function called with a single item.
+    :param items: Iterable of items.
+    :param reduce_fn: Function combining the accumulated value and one result.
+    :param initial: Initial accumulated value.
+    :param kwargs: Passed on to `windowed_imap`.
+    :return: The reduced value.
+    """
+    result = initial
+    for r in windowed_imap(fn, items, **kwargs):
+        result = reduce_fn(result, r)
+    return result
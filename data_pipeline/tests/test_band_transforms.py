@@ -0,0 +1,63 @@
+import os
+import sys
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from band_transforms import build_transform_plan, apply_transform_plan, process_bands_in_tile
+
+BAND_NAMES = [str(i) for i in range(1, 27)]
+NODATA = -9999.0
+
+
+def synthetic_stats(rng):
+    stats = {band_name: (rng.uniform(-5, 50), rng.uniform(0.5, 20), 0.0, 100.0, f'band {band_name}')
+             for band_name in BAND_NAMES}
+    # A constant band is left unstandardized
+    stats['4'] = (3.0, 0.0, 3.0, 3.0, 'band 4')
+    return stats
+
+
+def synthetic_tile(rng, rows=200, cols=230):
+    """Edge tile smaller than the tile size, with NaN, zeros, nodata and negative values in every band."""
+    tile = rng.uniform(0, 100, size=(len(BAND_NAMES), rows, cols)).astype(np.float32)
+    tile[:, rng.random((rows, cols)) < 0.1] = np.nan
+    tile[:, rng.random((rows, cols)) < 0.1] = 0
+    tile[:, rng.random((rows, cols)) < 0.05] = NODATA
+    negative = rng.random((rows, cols)) < 0.1
+    tile[:, negative] = -rng.uniform(0, 0.9, size=negative.sum()).astype(np.float32)
+    return tile
+
+
+def test_plan_matches_reference():
+    rng = np.random.default_rng(0)
+    stats = synthetic_stats(rng)
+    tile = synthetic_tile(rng)
+    plan = build_transform_plan(BAND_NAMES, stats, 256)
+
+    expected = process_bands_in_tile(tile.copy(), BAND_NAMES, stats)
+    actual = apply_transform_plan(tile, plan)
+
+    assert actual.dtype == np.float32 and actual.shape == (26, 256, 256)
+    np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-5, equal_nan=True)
+
+
+def test_plan_matches_reference_on_a_band_subset():
+    rng = np.random.default_rng(1)
+    stats = synthetic_stats(rng)
+    band_names = ['26', '13', '8', '1', '20', '4']
+    tile = synthetic_tile(rng, 256, 256)[[int(band_name) - 1 for band_name in band_names]]
+    plan = build_transform_plan(band_names, stats, 256)
+
+    expected = process_bands_in_tile(tile.copy(), band_names, stats)
+    np.testing.assert_allclose(apply_transform_plan(tile, plan), expected, rtol=1e-5, atol=1e-5, equal_nan=True)
+
+
+def test_raw_plan_only_pads_and_zeroes_nans():
+    rng = np.random.default_rng(2)
+    tile = synthetic_tile(rng)
+    plan = build_transform_plan(BAND_NAMES, synthetic_stats(rng), 256, raw=True)
+
+    actual = apply_transform_plan(tile, plan)
+
+    np.testing.assert_array_equal(actual[:, :200, :230], np.nan_to_num(tile))
+    assert not actual[:, 200:].any() and not actual[:, :, 230:].any()
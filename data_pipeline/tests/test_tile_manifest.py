@@ -0,0 +1,84 @@
+import os
+import sys
+import json
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from tile_manifest import MANIFEST_DIR, load_manifest, ManifestWriter
+
+
+def write_part(output_dir, part_name, entries):
+    os.makedirs(os.path.join(output_dir, MANIFEST_DIR), exist_ok=True)
+    with open(os.path.join(output_dir, MANIFEST_DIR, f'{part_name}.jsonl'), 'a') as f:
+        for unit, checksum, fingerprint, mtime_ns in entries:
+            f.write(json.dumps({'unit': unit, 'checksum': checksum, 'fingerprint': fingerprint,
+                                'size': 0, 'mtime_ns': mtime_ns}) + '\n')
+
+
+def touch(output_dir, *units, mtime_ns=1000):
+    for unit in units:
+        path = os.path.join(output_dir, unit)
+        open(path, 'w').close()
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def cut(output_dir, fingerprint, part_name, units, mtime_ns):
+    """Writes the units and records them as a run of the given fingerprint would."""
+    touch(output_dir, *units, mtime_ns=mtime_ns)
+    writer = ManifestWriter(output_dir, fingerprint, part_name)
+    for unit in units:
+        writer.record(unit, f'{fingerprint}:{unit}')
+    writer.close()
+
+
+def test_newer_entry_in_earlier_part_wins(tmp_path):
+    touch(tmp_path, 'tile_0_0.tif', mtime_ns=2000)
+    touch(tmp_path, 'tile_0_1.tif', mtime_ns=1000)
+    write_part(tmp_path, 'rank_1', [('tile_0_0.tif', 'c0', 'F2', 2000)])
+    write_part(tmp_path, 'rank_3', [('tile_0_0.tif', 'old', 'F1', 1000), ('tile_0_1.tif', 'c1', 'F1', 1000)])
+
+    assert load_manifest(tmp_path, 'F2') == {'tile_0_0.tif': 'c0'}
+    assert load_manifest(tmp_path, 'F1') == {'tile_0_1.tif': 'c1'}
+
+
+def test_newer_entry_in_later_part_wins(tmp_path):
+    touch(tmp_path, 'tile_0_0.tif', mtime_ns=2000)
+    write_part(tmp_path, 'main', [('tile_0_0.tif', 'old', 'F1', 1000)])
+    write_part(tmp_path, 'rank_0', [('tile_0_0.tif', 'c0', 'F2', 2000)])
+
+    assert load_manifest(tmp_path, 'F2') == {'tile_0_0.tif': 'c0'}
+    assert load_manifest(tmp_path, 'F1') == {}
+
+
+def test_tiles_overwritten_by_another_run_are_cut_again(tmp_path):
+    cut(tmp_path, 'A', 'rank_1', ['tile_0_0.tif', 'tile_0_1.tif'], mtime_ns=1000)
+    cut(tmp_path, 'B', 'rank_2', ['tile_0_0.tif'], mtime_ns=2000)
+
+    assert load_manifest(tmp_path, 'A') == {'tile_0_1.tif': 'A:tile_0_1.tif'}
+
+    cut(tmp_path, 'A', 'rank_1', ['tile_0_0.tif'], mtime_ns=3000)
+    assert load_manifest(tmp_path, 'A') == {'tile_0_0.tif': 'A:tile_0_0.tif', 'tile_0_1.tif': 'A:tile_0_1.tif'}
+    assert load_manifest(tmp_path, 'B') == {}
+
+
+def test_files_changed_since_recorded_are_cut_again(tmp_path):
+    cut(tmp_path, 'F', 'main', ['tile_0_0.tif', 'tile_0_1.tif'], mtime_ns=1000)
+    with open(os.path.join(tmp_path, 'tile_0_1.tif'), 'w') as f:
+        f.write('truncated')
+
+    assert load_manifest(tmp_path, 'F') == {'tile_0_0.tif': 'F:tile_0_0.tif'}
+
+
+def test_missing_files_and_truncated_lines_are_skipped(tmp_path):
+    touch(tmp_path, 'tile_0_0.tif')
+    write_part(tmp_path, 'rank_0', [('tile_0_0.tif', 'c0', 'F', 1000), ('tile_0_1.tif', 'c1', 'F', 1000)])
+    with open(os.path.join(tmp_path, MANIFEST_DIR, 'rank_0.jsonl'), 'a') as f:
+        f.write('{"unit": "tile_0_2.ti')
+
+    assert load_manifest(tmp_path, 'F') == {'tile_0_0.tif': 'c0'}
+
+
+def test_writer_parts_are_merged(tmp_path):
+    for rank, unit in enumerate(['tile_0_0.tif', 'tile_1_0.tif']):
+        cut(tmp_path, 'F', f'rank_{rank}', [unit], mtime_ns=1000)
+
+    assert load_manifest(tmp_path, 'F') == {'tile_0_0.tif': 'F:tile_0_0.tif', 'tile_1_0.tif': 'F:tile_1_0.tif'}
@@ -0,0 +1,140 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import rasterio
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from cut_tiles import create_tiles_based_on_mask
+from tile_encoding import decode_tile
+from tile_store import STORE_META_FILE
+
+# (output format, encoding, compression) combinations compared by default
+CONFIGS = [
+    ('tif', 'float32', 'none'),
+    ('tif', 'float32', 'deflate'),
+    ('tif', 'float32', 'zstd'),
+    ('tif', 'int16', 'none'),
+    ('tif', 'int16', 'deflate'),
+    ('tif', 'int16', 'zstd'),
+    ('shards', 'float32', 'none'),
+    ('shards', 'float16', 'none'),
+    ('shards', 'int16', 'none'),
+]
+
+
+def read_tif_tiles(tile_dir):
+    """
+    Read and decode every GeoTIFF tile of a directory.
+
+    :param tile_dir: Directory of the tiles.
+    :return: Dictionary mapping tile name to decoded float32 array.
+    """
+    tiles = {}
+    for name in sorted(f for f in os.listdir(tile_dir) if f.endswith('.tif')):
+        with rasterio.open(os.path.join(tile_dir, name)) as src:
+            tiles[name] = decode_tile(src.read(), src.scales, src.offsets)
+    return tiles
+
+
+def read_store_tiles(store_dir):
+    """
+    Read and decode every tile of a sharded tile store.
+
+    :param store_dir: Directory of the store.
+    :return: Dictionary mapping tile name to decoded float32 array.
+    """
+    with open(os.path.join(store_dir, STORE_META_FILE)) as f:
+        meta = json.load(f)
+    encoding = meta['encoding']
+    with np.load(os.path.join(store_dir, 'index.npz')) as index:
+        rows, cols, shard_nums, offsets = index['row'], index['col'], index['shard'], index['offset']
+
+    tiles, size = {}, meta['tile_size']
+    groups = [[np.load(os.path.join(store_dir, name)) for name in group['shards']] for group in encoding['groups']]
+    for i, j, k, offset in zip(rows, cols, shard_nums, offsets):
+        tile = np.empty((meta['num_bands'], size, size), dtype=np.float32)
+        for group, shards in zip(encoding['groups'], groups):
+            tile[group['bands']] = shards[k][offset]
+        tiles[f'tile_{i}_{j}.tif'] = decode_tile(tile, encoding['scales'], encoding['offsets'])
+    return tiles
+
+
+def directory_size(path):
+    """
+    Get the total size of the tile files of a directory, without manifests and metadata.
+
+    :param path: Directory of the tiles.
+    :return: Size in bytes.
+    """
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path) if f.endswith(('.tif', '.npy')))
+
+
+def benchmark_tile_encodings(input_tif, pickle_dir, num_tiles=100, window_size=256, configs=CONFIGS, seed=0):
+    """
+    Cut the same random tiles with several encodings and compressions, and report the bytes per tile,
+    the read and decode throughput and the maximum decoding error against float32 tiles.
+
+    :param input_tif: Path to the input datacube.
+    :param pickle_dir: Directory containing the cached statistics.
+    :param num_tiles: Number of random tiles to cut.
+    :param window_size: Tile size.
+    :param configs: List of (output format, encoding, compression) combinations.
+    :param seed: Random seed for picking tiles.
+    :return: List of result dictionaries, one per combination.
+    """
+    with rasterio.open(input_tif) as src:
+        grid = (src.height // window_size, src.width // window_size)
+    rng = np.random.default_rng(seed)
+    mask = np.zeros(grid, dtype=np.uint8)
+    mask.flat[rng.choice(mask.size, min(num_tiles, mask.size), replace=False)] = 1
+
+    work_dir = tempfile.mkdtemp(prefix='tile_encodings_')
+    results, reference = [], None
+    try:
+        mask_file = os.path.join(work_dir, 'mask.npy')
+        np.save(mask_file, mask)
+
+        for output_format, encoding, compress in configs:
+            out_dir = os.path.join(work_dir, f'{output_format}_{encoding}_{compress}')
+            create_tiles_based_on_mask(input_tif, out_dir, mask_file, window_size, pickle_dir,
+                                       output_format=output_format, encoding=encoding, compress=compress)
+
+            start = time.perf_counter()
+            tiles = read_store_tiles(out_dir) if output_format == 'shards' else read_tif_tiles(out_dir)
+            elapsed = time.perf_counter() - start
+
+            if reference is None:
+                reference = tiles
+            max_error = max(float(np.abs(tiles[name] - reference[name]).max()) for name in reference)
+            results.append({
+                'format': output_format,
+                'encoding': encoding,
+                'compress': compress,
+                'bytes_per_tile': directory_size(out_dir) / len(tiles),
+                'tiles_per_second': len(tiles) / elapsed,
+                'max_abs_error': max_error,
+            })
+    finally:
+        shutil.rmtree(work_dir)
+
+    print(f"{'format':<8}{'encoding':<10}{'compress':<10}{'MB/tile':>10}{'tiles/s':>10}{'max error':>12}")
+    for r in results:
+        print(f"{r['format']:<8}{r['encoding']:<10}{r['compress']:<10}{r['bytes_per_tile'] / 2 ** 20:>10.2f}"
+              f"{r['tiles_per_second']:>10.1f}{r['max_abs_error']:>12.2e}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the tile encodings and compressions of cut_tiles.py.')
+    parser.add_argument('--input_tif', type=str, help='Input TIF file.')
+    parser.add_argument('--pickle_dir', type=str, help='Directory for pickle files with cached stats.')
+    parser.add_argument('--num_tiles', type=int, default=100, help='Number of random tiles to cut.')
+    parser.add_argument('--window_size', type=int, default=256, help='Tile size.')
+
+    args = parser.parse_args()
+    benchmark_tile_encodings(args.input_tif, args.pickle_dir, args.num_tiles, args.window_size)
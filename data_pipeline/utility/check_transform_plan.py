@@ -0,0 +1,62 @@
+import os
+import sys
+import argparse
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from band_transforms import build_transform_plan, apply_transform_plan, process_bands_in_tile
+from cut_tiles import cache_global_stats
+
+
+def check_transform_plan(input_tif, pickle_dir, num_tiles=50, window_size=256, rtol=1e-5, atol=1e-5, seed=0):
+    """
+    Compare the compiled transform plan against the reference per-band implementation on random tiles.
+
+    :param input_tif: Path to the input datacube.
+    :param pickle_dir: Directory containing the cached statistics.
+    :param num_tiles: Number of random tiles to compare.
+    :param window_size: Tile size.
+    :param rtol: Relative tolerance (the plan runs in float32, the reference in float64).
+    :param atol: Absolute tolerance.
+    :param seed: Random seed for picking tiles.
+    :return: True if every tile matches.
+    """
+    band_names = [str(i) for i in range(1, 27)]
+    global_stats_dict = {band_name: cache_global_stats(band_name, pickle_dir) for band_name in band_names}
+    plan = build_transform_plan(band_names, global_stats_dict, window_size)
+    rng = np.random.default_rng(seed)
+
+    all_match = True
+    with rasterio.open(input_tif) as src:
+        num_rows, num_cols = -(-src.height // window_size), -(-src.width // window_size)
+
+        for _ in range(num_tiles):
+            i, j = rng.integers(num_rows), rng.integers(num_cols)
+            data = src.read(window=Window(j * window_size, i * window_size, window_size, window_size))
+
+            expected = process_bands_in_tile(data.copy(), band_names, global_stats_dict)
+            actual = apply_transform_plan(data, plan)
+
+            close = np.isclose(actual, expected, rtol=rtol, atol=atol)
+            if not close.all():
+                all_match = False
+                bands = sorted({band_names[b] for b in np.nonzero(~close)[0]})
+                print(f"Tile ({i}, {j}): mismatch in bands {bands}, "
+                      f"max abs diff {np.abs(actual - expected).max()}")
+
+    print("All tiles match" if all_match else "Mismatches found")
+    return all_match
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check the compiled band transform plan against the reference implementation.')
+    parser.add_argument('--input_tif', type=str, help='Input TIF file.')
+    parser.add_argument('--pickle_dir', type=str, help='Directory for pickle files with cached stats.')
+    parser.add_argument('--num_tiles', type=int, default=50, help='Number of random tiles to compare.')
+    parser.add_argument('--window_size', type=int, default=256, help='Tile size.')
+
+    args = parser.parse_args()
+    ok = check_transform_plan(args.input_tif, args.pickle_dir, args.num_tiles, args.window_size)
+    sys.exit(0 if ok else 1)
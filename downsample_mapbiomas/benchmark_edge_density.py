@@ -0,0 +1,92 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from downsample import PixelClass, CLASS_RANGES
+from edge_density import compute_edge_density, compute_edge_density_windowed, edge_counts
+
+def write_synthetic_raster(path, height, width, seed=0):
+    """
+    Write a synthetic MapBiomas-like raster: forest patches of various sizes in a non-forest background.
+
+    Args:
+        path (str): Path of the output .tif file.
+        height (int): Raster height in pixels.
+        width (int): Raster width in pixels.
+        seed (int): Random seed.
+
+    Returns:
+        np.ndarray: The written uint16 codes.
+    """
+    rng = np.random.default_rng(seed)
+    forest = CLASS_RANGES[PixelClass.FOREST_COVER][0][0]
+    # Upsampled coarse noise gives patches spanning several grid cells
+    coarse = rng.random((height // 16 + 1, width // 16 + 1)) < 0.5
+    data = np.where(np.kron(coarse, np.ones((16, 16), dtype=bool))[:height, :width], forest, 0).astype(np.uint16)
+    data[rng.random((height, width)) < 0.05] = forest
+
+    with rasterio.open(path, 'w', driver='GTiff', height=height, width=width, count=1, dtype='uint16',
+                       crs='EPSG:3857', transform=from_origin(0, 0, 30, 30), compress='deflate') as dst:
+        dst.write(data, 1)
+    return data
+
+def reference_edge_density(data, grid_size):
+    """
+    Compute the exact edge density of a whole in-memory raster.
+    """
+    low, high = CLASS_RANGES[PixelClass.FOREST_COVER][0]
+    counts = edge_counts((low <= data) & (data < high)).astype(np.int64)
+    rows, cols = data.shape[0] // grid_size, data.shape[1] // grid_size
+    counts = counts[:rows * grid_size, :cols * grid_size].reshape(rows, grid_size, cols, grid_size).sum(axis=(1, 3))
+    return counts / (grid_size * grid_size)
+
+def benchmark_edge_density(height=8000, width=8000, grid_size=200, seed=0):
+    """
+    Compare the strip-parallel and the windowed edge density on a synthetic raster: run time, and
+    largest difference to the exact edge density computed in memory.
+
+    Args:
+        height (int): Raster height in pixels.
+        width (int): Raster width in pixels.
+        grid_size (int): Grid size in pixels.
+        seed (int): Random seed.
+
+    Returns:
+        dict: Run time in seconds and maximum absolute error of each implementation.
+    """
+    work_dir = tempfile.mkdtemp(prefix='edge_density_')
+    results = {}
+    try:
+        raster_file = os.path.join(work_dir, 'synthetic.tif')
+        reference = reference_edge_density(write_synthetic_raster(raster_file, height, width, seed), grid_size)
+
+        for name, fn in [('windowed', compute_edge_density_windowed), ('strips', compute_edge_density)]:
+            output_file = os.path.join(work_dir, f'{name}.tif')
+            start = time.perf_counter()
+            fn(raster_file, output_file, grid_size, PixelClass.FOREST_COVER)
+            elapsed = time.perf_counter() - start
+            with rasterio.open(output_file) as src:
+                error = float(np.abs(src.read(1) - reference).max())
+            results[name] = {'seconds': elapsed, 'max_abs_error': error}
+    finally:
+        shutil.rmtree(work_dir)
+
+    print(f"{'implementation':<16}{'seconds':>10}{'max error':>12}")
+    for name, r in results.items():
+        print(f"{name:<16}{r['seconds']:>10.2f}{r['max_abs_error']:>12.2e}")
+    print(f"Speedup: {results['windowed']['seconds'] / results['strips']['seconds']:.1f}x")
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the edge density implementations on a synthetic raster.')
+    parser.add_argument('--height', type=int, default=8000, help='Raster height in pixels.')
+    parser.add_argument('--width', type=int, default=8000, help='Raster width in pixels.')
+    parser.add_argument('--grid_size', type=int, default=200, help='Grid size in pixels.')
+
+    args = parser.parse_args()
+
+    benchmark_edge_density(args.height, args.width, args.grid_size)
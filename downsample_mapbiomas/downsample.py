@@ -1,3 +1,5 @@
+import os
+import sys
 import argparse
 import numpy as np
 import rasterio
@@ -6,80 +8,213 @@ from rasterio.transform import Affine
 from tqdm import tqdm
 import enum
 
+# Shared window planner lives with the data pipeline scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_pipeline', 'scripts'))
+from windows import windowed_imap
+
 class PixelClass(enum.Enum):
     FOREST_COVER = "forest_cover"
     DEFORESTATION = "deforestation"
 
-def aggregate_raster(raster_file, output_file, window_size, pixel_class: PixelClass):
+# MapBiomas code ranges [low, high) of each pixel class
+CLASS_RANGES = {
+    PixelClass.FOREST_COVER: [(200, 400)],
+    PixelClass.DEFORESTATION: [(400, 500), (600, 700)],
+}
 
+def class_lut(pixel_classes):
     """
-    Aggregate pixel class data into grids in a raster image.
+    Build a lookup table classifying 16-bit MapBiomas codes into several pixel classes at once.
 
     Args:
-        raster_file (str): Path to the raster image file (.tif).
-        output_file (str): Path to the output raster image file (.tif) to store the aggregated data.
-        window_size (int): Size of the window in pixels used for aggregation.
-        pixel_class (PixelClass): The pixel class to aggregate.
+        pixel_classes (list): PixelClass values, at most 8.
 
     Returns:
-        None
+        np.ndarray: uint8 array of 65536 entries, with bit k set for the codes in pixel_classes[k].
+    """
+    if len(pixel_classes) > 8:
+        raise ValueError("At most 8 pixel classes can share a lookup table")
+    lut = np.zeros(1 << 16, dtype=np.uint8)
+    for k, pixel_class in enumerate(pixel_classes):
+        for low, high in CLASS_RANGES[pixel_class]:
+            lut[low:high] |= np.uint8(1 << k)
+    return lut
+
+def classify(data, lut):
+    """
+    Classify raw codes with a lookup table from `class_lut`.
 
-    Raises:
-        FileNotFoundError: If the raster file does not exist.
+    Codes outside the table, such as a negative nodata value or NaN, belong to no class.
+
+    Args:
+        data (np.ndarray): MapBiomas codes.
+        lut (np.ndarray): Lookup table.
+
+    Returns:
+        np.ndarray: uint8 class bitmask of the same shape as data.
+    """
+    if data.dtype in (np.uint8, np.uint16):
+        return lut[data]
+    valid = (data >= 0) & (data < len(lut))
+    if np.issubdtype(data.dtype, np.floating):
+        valid &= data == np.floor(data)
+    codes = np.where(valid, data, 0).astype(np.uint16)
+    return np.where(valid, lut[codes], np.uint8(0))
+
+def block_sums(values, block):
+    """
+    Sum the whole block x block blocks of a 2D array, dropping partial blocks at the edges.
+
+    Args:
+        values (np.ndarray): Array of shape (rows, cols).
+        block (int): Block size.
+
+    Returns:
+        np.ndarray: uint32 array of shape (rows // block, cols // block).
+    """
+    rows, cols = values.shape[0] // block, values.shape[1] // block
+    return values[:rows * block, :cols * block].reshape(rows, block, cols, block).sum(axis=(1, 3), dtype=np.uint32)
+
+def check_grid_sizes(grid_sizes):
+    """
+    Check that grid sizes form a pyramid, each size dividing the next one.
+
+    Args:
+        grid_sizes (list): Grid sizes in pixels.
+
+    Returns:
+        list: The sorted grid sizes.
+    """
+    grid_sizes = sorted(grid_sizes)
+    for finer, coarser in zip(grid_sizes, grid_sizes[1:]):
+        if coarser % finer:
+            raise ValueError(f"Grid sizes must each divide the next one, got {grid_sizes}")
+    return grid_sizes
 
+def aggregate_strip(args):
     """
+    Count the pixels of every class in each cell of every grid size, for one strip of a raster.
 
-    mask_factories = {
-        PixelClass.FOREST_COVER: lambda data: (200 <= data) & (data < 400),
-        PixelClass.DEFORESTATION: lambda data: ((400 <= data) & (data < 500)) | ((600 <= data) & (data < 700)),
-    }
-    generate_mask = mask_factories[pixel_class]
+    The strip is classified with one lookup per pixel and reduced to the finest grid by reshape
+    block sums; each coarser grid is then summed from the finer counts.
+
+    Args:
+        args (tuple): (raster file, first row, number of rows, lookup table, number of classes,
+            sorted grid sizes). The first row is a multiple of the largest grid size.
 
-    # Open the raster file
+    Returns:
+        tuple: (first row, list of uint32 arrays of shape (classes, grid rows, grid cols), one per grid size).
+    """
+    raster_file, row_off, num_rows, lut, num_classes, grid_sizes = args
     with rasterio.open(raster_file) as src:
-        # Calculate the number of windows in each dimension
-        n_windows_x = src.width // window_size
-        n_windows_y = src.height // window_size
+        data = src.read(1, window=Window(0, row_off, src.width, num_rows))
+
+    classes = classify(data, lut)
+    base = np.stack([block_sums((classes >> k) & 1, grid_sizes[0]) for k in range(num_classes)])
+
+    levels = []
+    for grid_size in grid_sizes:
+        factor = grid_size // grid_sizes[0]
+        rows, cols = base.shape[1] // factor, base.shape[2] // factor
+        levels.append(base[:, :rows * factor, :cols * factor]
+                      .reshape(num_classes, rows, factor, cols, factor).sum(axis=(2, 4), dtype=np.uint32))
+    return row_off, levels
+
+def pyramid_output_file(output_file, grid_size, grid_sizes):
+    """
+    Get the output file of one grid size: output_file itself for a single grid size, and
+    <root>_<grid size><ext> otherwise.
+    """
+    if len(grid_sizes) == 1:
+        return output_file
+    root, ext = os.path.splitext(output_file)
+    return f"{root}_{grid_size}{ext or '.tif'}"
+
+def aggregate_raster_pyramid(raster_file, output_file, grid_sizes, pixel_classes, strip_cells=1):
+    """
+    Aggregate several pixel classes into grids of several sizes in a single pass over a raster image.
 
-        aggregated_data = np.zeros((n_windows_y, n_windows_x), dtype='uint32')
+    The raster is read in full-width strips whose height is a multiple of the largest grid size,
+    processed in parallel. Each grid size is written as one raster with a uint32 band of pixel
+    counts per class, the band descriptions being the class names.
 
-        # Loop over the windows in the raster
-        for wx in tqdm(range(n_windows_x), desc=f"Processing file: {raster_file}"):
-            for wy in range(n_windows_y):
-                # Read a window from the raster
-                window = Window(wx * window_size, wy * window_size, window_size, window_size)
-                data = src.read(1, window=window)
+    Args:
+        raster_file (str): Path to the raster image file (.tif).
+        output_file (str): Path to the output raster image file (.tif). With several grid sizes,
+            the grid size is appended to its name (see `pyramid_output_file`).
+        grid_sizes (list): Grid sizes in pixels, each dividing the next one (e.g. 100, 200, 400).
+        pixel_classes (list): The pixel classes to aggregate.
+        strip_cells (int): Height of the strips read at once, in cells of the largest grid size.
 
-                # Generate mask according to pixel class
-                mask = generate_mask(data)
+    Returns:
+        dict: The output file of each grid size.
+    """
+    grid_sizes = check_grid_sizes(grid_sizes)
+    lut = class_lut(pixel_classes)
 
-                # Sum up the pixel class
-                aggregated_data[wy, wx] = np.sum(mask)
+    with rasterio.open(raster_file) as src:
+        height, width, crs, src_transform = src.height, src.width, src.crs, src.transform
+
+    counts = {g: np.zeros((len(pixel_classes), height // g, width // g), dtype=np.uint32) for g in grid_sizes}
+    strip_rows = grid_sizes[-1] * strip_cells
+    tasks = [(raster_file, row, min(strip_rows, height - row), lut, len(pixel_classes), grid_sizes)
+             for row in range(0, height, strip_rows)]
+
+    for row_off, levels in tqdm(windowed_imap(aggregate_strip, tasks), total=len(tasks),
+                                desc=f"Processing file: {raster_file}"):
+        for grid_size, level in zip(grid_sizes, levels):
+            first = row_off // grid_size
+            counts[grid_size][:, first:first + level.shape[1]] = level
+
+    outputs = {}
+    for grid_size in grid_sizes:
+        outputs[grid_size] = pyramid_output_file(output_file, grid_size, grid_sizes)
+        aggregated_data = counts[grid_size]
+        with rasterio.open(outputs[grid_size], 'w', driver='GTiff', height=aggregated_data.shape[1],
+                           width=aggregated_data.shape[2], count=len(pixel_classes), dtype=aggregated_data.dtype,
+                           crs=crs, transform=src_transform * Affine.scale(grid_size)) as dst:
+            dst.write(aggregated_data)
+            dst.descriptions = tuple(pixel_class.value for pixel_class in pixel_classes)
+    return outputs
 
-        # Update the transformation
-        transform = src.transform * Affine.scale(window_size)
+def aggregate_raster(raster_file, output_file, window_size, pixel_class: PixelClass):
 
-    # Write the aggregated data to a new raster file
-    with rasterio.open(output_file, 'w', driver='GTiff', height=aggregated_data.shape[0],
-                       width=aggregated_data.shape[1], count=1, dtype=aggregated_data.dtype,
-                       crs=src.crs, transform=transform) as dst:
-        dst.write(aggregated_data, 1)
+    """
+    Aggregate pixel class data into grids in a raster image.
+
+    Args:
+        raster_file (str): Path to the raster image file (.tif).
+        output_file (str): Path to the output raster image file (.tif) to store the aggregated data.
+        window_size (int): Size of the window in pixels used for aggregation.
+        pixel_class (PixelClass): The pixel class to aggregate.
+
+    Returns:
+        None
+
+    Raises:
+        FileNotFoundError: If the raster file does not exist.
+
+    """
+    aggregate_raster_pyramid(raster_file, output_file, [window_size], [pixel_class])
 
 def main():
     parser = argparse.ArgumentParser(description='Aggregate pixel class data into grids.')
     parser.add_argument('input_file', type=str, help='Path to the input .tif file.')
     parser.add_argument('output_file', type=str, help='Path to the output .tif file.')
-    parser.add_argument('--grid_size', type=int, default=200, help='Grid size in pixels. Default is 200 (for a 6km grid with 30m pixels).')
+    parser.add_argument('--grid_size', type=int, nargs='+', default=[200],
+                        help='Grid sizes in pixels, each dividing the next one. Default is 200 (for a 6km grid with 30m pixels). '
+                             'With several sizes, one output per size is written, named <output>_<size>.tif.')
     parser.add_argument(
-        '--pixel-class', required=True, type=str, choices=[x.value for x in PixelClass],
-        help='Pixel class to aggregate.'
+        '--pixel-class', required=True, type=str, nargs='+', choices=[x.value for x in PixelClass],
+        help='Pixel classes to aggregate, one output band each.'
     )
+    parser.add_argument('--strip_cells', type=int, default=1, help='Height of the strips read at once, in cells of the largest grid.')
 
     args = parser.parse_args()
 
-    aggregate_raster(
-        args.input_file, args.output_file, args.grid_size, PixelClass(args.pixel_class)
+    aggregate_raster_pyramid(
+        args.input_file, args.output_file, args.grid_size, [PixelClass(c) for c in args.pixel_class], args.strip_cells
     )
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
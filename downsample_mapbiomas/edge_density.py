@@ -1,3 +1,5 @@
+import os
+import sys
 import argparse
 import numpy as np
 import rasterio
@@ -6,16 +8,141 @@ from rasterio.transform import Affine
 from scipy import ndimage
 from tqdm import tqdm
 from scipy.ndimage import convolve
-import enum
 
-class PixelClass(enum.Enum):
-    FOREST_COVER = "forest_cover"
-    DEFORESTATION = "deforestation"
+# Shared window planner lives with the data pipeline scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_pipeline', 'scripts'))
+from windows import iter_tile_windows, windowed_imap
+from downsample import PixelClass, class_lut, classify, block_sums
 
-def compute_edge_density(raster_file, output_file, window_size, pixel_class: PixelClass):
-    
+def edge_counts(mask, above=None, below=None):
+    """
+    Count, for every pixel outside the class, its 4-neighbours inside the class.
+
+    Pixels beyond the left and right edges, and above or below the rows when no halo row is
+    given (i.e. beyond the raster), are outside the class.
+
+    Args:
+        mask (np.ndarray): Boolean class mask of shape (rows, cols).
+        above (np.ndarray, optional): Mask of the row just above, or None at the top of the raster.
+        below (np.ndarray, optional): Mask of the row just below, or None at the bottom of the raster.
+
+    Returns:
+        np.ndarray: uint8 array of shape (rows, cols) with values in 0..4.
+    """
+    rows, cols = mask.shape
+    padded = np.zeros((rows + 2, cols + 2), dtype=bool)
+    padded[1:-1, 1:-1] = mask
+    if above is not None:
+        padded[0, 1:-1] = above
+    if below is not None:
+        padded[-1, 1:-1] = below
+
+    outside = ~mask
+    counts = (outside & padded[:-2, 1:-1]).astype(np.uint8)
+    counts += outside & padded[2:, 1:-1]
+    counts += outside & padded[1:-1, :-2]
+    counts += outside & padded[1:-1, 2:]
+    return counts
+
+def read_strip(src, row_off, num_rows):
+    """
+    Read a full-width strip of the first band of an open raster, with a one-row halo above and
+    below it where the raster has one.
+
+    Args:
+        src: Open rasterio dataset.
+        row_off (int): First row of the strip.
+        num_rows (int): Number of rows of the strip.
+
+    Returns:
+        tuple: (rows read, slice of the strip's own rows within them).
+    """
+    top = max(row_off - 1, 0)
+    bottom = min(row_off + num_rows + 1, src.height)
+    return src.read(1, window=Window(0, top, src.width, bottom - top)), slice(row_off - top, row_off - top + num_rows)
+
+def strip_edges(mask, core):
+    """
+    Count the edges of the strip rows of a class mask read by `read_strip`, using its halo rows.
+
+    Args:
+        mask (np.ndarray): Boolean class mask of the rows read.
+        core (slice): The strip's own rows.
+
+    Returns:
+        np.ndarray: uint8 edge counts of the strip rows (see `edge_counts`).
+    """
+    above = mask[core.start - 1] if core.start > 0 else None
+    below = mask[core.stop] if core.stop < mask.shape[0] else None
+    return edge_counts(mask[core], above, below)
+
+def strip_edge_counts(args):
+    """
+    Count the class edges in each grid cell of one strip of a raster.
+
+    The strip is read together with a one-row halo above and below it, so edges between
+    strips are counted exactly as within a strip.
+
+    Args:
+        args (tuple): (raster file, first row, number of rows, lookup table, grid size).
+
+    Returns:
+        tuple: (first row, uint32 edge counts of shape (strip rows // grid size, cols // grid size)).
+    """
+    raster_file, row_off, num_rows, lut, grid_size = args
+    with rasterio.open(raster_file) as src:
+        data, core = read_strip(src, row_off, num_rows)
+    return row_off, block_sums(strip_edges(classify(data, lut).astype(bool), core), grid_size)
+
+def compute_edge_density(raster_file, output_file, window_size, pixel_class: PixelClass, strip_cells=4):
     """
     Compute the forest edge density for a given raster file.
+
+    The edge density of a grid cell is the number of edges between a pixel of the cell outside
+    the class and a 4-neighbour inside the class, divided by the number of pixels in the cell.
+    Neighbours in adjacent cells count, and pixels beyond the raster are outside the class.
+    The raster is read in full-width strips with one-row halos, processed in parallel.
+
+    Args:
+        raster_file (str): Path to the input .tif file.
+        output_file (str): Path to the output .tif file.
+        window_size (int): Grid size in pixels.
+        pixel_class (PixelClass): Pixel class to consider when calculating edge density.
+        strip_cells (int): Height of the strips read at once, in grid cells.
+
+    Returns:
+        np.ndarray: The float64 edge density of shape (height // window_size, width // window_size).
+    """
+    lut = class_lut([pixel_class])
+
+    with rasterio.open(raster_file) as src:
+        height, width, crs = src.height, src.width, src.crs
+        transform = src.transform * Affine.scale(window_size)
+
+    edge_density_data = np.zeros((height // window_size, width // window_size), dtype='float64')
+    strip_rows = window_size * strip_cells
+    tasks = [(raster_file, row, min(strip_rows, (height // window_size) * window_size - row), lut, window_size)
+             for row in range(0, (height // window_size) * window_size, strip_rows)]
+
+    for row_off, counts in tqdm(windowed_imap(strip_edge_counts, tasks), total=len(tasks),
+                                desc=f"Processing file: {raster_file}"):
+        first = row_off // window_size
+        edge_density_data[first:first + counts.shape[0]] = counts / (window_size * window_size)
+
+    with rasterio.open(output_file, 'w', driver='GTiff', height=edge_density_data.shape[0],
+                       width=edge_density_data.shape[1], count=1, dtype=edge_density_data.dtype,
+                       crs=crs, transform=transform) as dst:
+        dst.write(edge_density_data, 1)
+    return edge_density_data
+
+def compute_edge_density_windowed(raster_file, output_file, window_size, pixel_class: PixelClass):
+    
+    """
+    Compute the forest edge density for a given raster file, one window at a time.
+
+    Superseded by `compute_edge_density` and kept as the baseline of benchmark_edge_density.py:
+    each window is padded with pixels outside the class, so edges with the neighbouring
+    windows are not counted.
     This function reads a raster file, applies a mask for a given class and calculates 
     the edge density of the given pixel class, i.e. the ratio of pixel edges to the total 
     number of pixels in a given window. This is computed for each window of 
@@ -46,22 +173,21 @@ def compute_edge_density(raster_file, output_file, window_size, pixel_class: Pix
 
         edge_density_data = np.zeros((n_windows_y, n_windows_x), dtype='float64')
 
-        for wx in tqdm(range(n_windows_x), desc=f"Processing file: {raster_file}"):
-            for wy in range(n_windows_y):
-                window = Window(wx * window_size, wy * window_size, window_size, window_size)
-                data = src.read(1, window=window)
+        tile_windows = iter_tile_windows(src.height, src.width, window_size, full_tiles=True)
+        for wy, wx, window in tqdm(tile_windows, total=n_windows_x * n_windows_y, desc=f"Processing file: {raster_file}"):
+            data = src.read(1, window=window)
 
-                mask = generate_mask(data)
-                padded_cover = np.pad(mask, pad_width=1, mode='constant', constant_values=False)
+            mask = generate_mask(data)
+            padded_cover = np.pad(mask, pad_width=1, mode='constant', constant_values=False)
 
-                edge_count = (~padded_cover[1:-1, 1:-1] & padded_cover[:-2, 1:-1]).sum() + \
-                             (~padded_cover[1:-1, 1:-1] & padded_cover[2:, 1:-1]).sum() + \
-                             (~padded_cover[1:-1, 1:-1] & padded_cover[1:-1, :-2]).sum() + \
-                             (~padded_cover[1:-1, 1:-1] & padded_cover[1:-1, 2:]).sum()
+            edge_count = (~padded_cover[1:-1, 1:-1] & padded_cover[:-2, 1:-1]).sum() + \
+                         (~padded_cover[1:-1, 1:-1] & padded_cover[2:, 1:-1]).sum() + \
+                         (~padded_cover[1:-1, 1:-1] & padded_cover[1:-1, :-2]).sum() + \
+                         (~padded_cover[1:-1, 1:-1] & padded_cover[1:-1, 2:]).sum()
 
-                edge_density = edge_count / (window_size * window_size)
+            edge_density = edge_count / (window_size * window_size)
 
-                edge_density_data[wy, wx] = edge_density
+            edge_density_data[wy, wx] = edge_density
 
         transform = src.transform * Affine.scale(window_size)
 
@@ -79,10 +205,11 @@ def main():
         '--pixel-class', required=True, type=str, choices=[x.value for x in PixelClass],
         help='Pixel class to consider when calculating edge density.'
     )
+    parser.add_argument('--strip_cells', type=int, default=4, help='Height of the strips read at once, in grid cells.')
 
     args = parser.parse_args()
 
-    compute_edge_density(args.input_file, args.output_file, args.grid_size, PixelClass(args.pixel_class))
+    compute_edge_density(args.input_file, args.output_file, args.grid_size, PixelClass(args.pixel_class), args.strip_cells)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,125 @@
+import os
+import sys
+import argparse
+import numpy as np
+import rasterio
+from rasterio.transform import Affine
+from tqdm import tqdm
+
+# Shared window planner lives with the data pipeline scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_pipeline', 'scripts'))
+from windows import windowed_imap
+from downsample import PixelClass, class_lut, classify, block_sums
+from edge_density import read_strip, strip_edges
+
+# Per-year layers, in band order. Cover and deforestation are pixel counts, as written by
+# downsample.py, and edge density is the forest edge density of edge_density.py.
+YEAR_LAYERS = ['forest_cover', 'deforestation', 'edge_density']
+
+def band_names(years):
+    """
+    Get the band names of a multi-year raster: the layers of every year, then the change of every
+    layer between consecutive years.
+
+    Args:
+        years (list): Year labels, in input order.
+
+    Returns:
+        list: Band names, e.g. 'forest_cover_2016' or 'forest_cover_change_2016_2017'.
+    """
+    names = [f'{layer}_{year}' for year in years for layer in YEAR_LAYERS]
+    names += [f'{layer}_change_{y0}_{y1}' for y0, y1 in zip(years, years[1:]) for layer in YEAR_LAYERS]
+    return names
+
+def multi_year_strip(args):
+    """
+    Compute the per-year layers of one strip of every yearly raster, reading the same rows of all years.
+
+    Args:
+        args (tuple): (raster files, first row, number of rows, lookup table, grid size). The
+            lookup table classifies forest cover as bit 0 and deforestation as bit 1.
+
+    Returns:
+        tuple: (first row, float32 array of shape (years, len(YEAR_LAYERS), grid rows, grid cols)).
+    """
+    raster_files, row_off, num_rows, lut, grid_size = args
+    layers = []
+    for raster_file in raster_files:
+        with rasterio.open(raster_file) as src:
+            data, core = read_strip(src, row_off, num_rows)
+        classes = classify(data, lut)
+        forest = (classes & 1).astype(bool)
+        layers.append([
+            block_sums(forest[core], grid_size),
+            block_sums((classes[core] >> 1) & 1, grid_size),
+            block_sums(strip_edges(forest, core), grid_size) / (grid_size * grid_size),
+        ])
+    return row_off, np.asarray(layers, dtype=np.float32)
+
+def process_years(raster_files, output_file, grid_size, years=None, strip_cells=4):
+    """
+    Compute per-year forest cover, deforestation and forest edge density, and their year-over-year
+    changes, from yearly MapBiomas rasters in a single pass.
+
+    Full-width strips of all years are read in lockstep and processed in parallel, each strip
+    with a one-row halo for exact edges. The result is one float32 raster with the bands of
+    `band_names`, named in its band descriptions.
+
+    Args:
+        raster_files (list): Paths to the yearly rasters, in chronological order, all on the same grid.
+        output_file (str): Path to the output .tif file.
+        grid_size (int): Grid size in pixels.
+        years (list, optional): Year labels of the rasters. Defaults to their file names.
+        strip_cells (int): Height of the strips read at once, in grid cells.
+
+    Returns:
+        list: The band names.
+    """
+    years = years or [os.path.splitext(os.path.basename(f))[0] for f in raster_files]
+    if len(years) != len(raster_files):
+        raise ValueError(f"Got {len(years)} years for {len(raster_files)} rasters")
+
+    with rasterio.open(raster_files[0]) as src:
+        height, width, crs = src.height, src.width, src.crs
+        transform = src.transform * Affine.scale(grid_size)
+    for raster_file in raster_files[1:]:
+        with rasterio.open(raster_file) as src:
+            if (src.height, src.width) != (height, width):
+                raise ValueError(f"{raster_file} is {src.height}x{src.width}, expected {height}x{width}")
+
+    lut = class_lut([PixelClass.FOREST_COVER, PixelClass.DEFORESTATION])
+    rows, cols = height // grid_size, width // grid_size
+    per_year = np.zeros((len(raster_files), len(YEAR_LAYERS), rows, cols), dtype=np.float32)
+
+    strip_rows = grid_size * strip_cells
+    tasks = [(raster_files, row, min(strip_rows, rows * grid_size - row), lut, grid_size)
+             for row in range(0, rows * grid_size, strip_rows)]
+    for row_off, layers in tqdm(windowed_imap(multi_year_strip, tasks), total=len(tasks),
+                                desc=f"Processing {len(raster_files)} years"):
+        first = row_off // grid_size
+        per_year[:, :, first:first + layers.shape[2]] = layers
+
+    changes = per_year[1:] - per_year[:-1]
+    data = np.concatenate([per_year.reshape(-1, rows, cols), changes.reshape(-1, rows, cols)])
+    names = band_names(years)
+
+    with rasterio.open(output_file, 'w', driver='GTiff', height=rows, width=cols, count=len(names),
+                       dtype=data.dtype, crs=crs, transform=transform) as dst:
+        dst.write(data)
+        dst.descriptions = tuple(names)
+    return names
+
+def main():
+    parser = argparse.ArgumentParser(description='Downsample yearly MapBiomas rasters into one multi-year, multi-band raster.')
+    parser.add_argument('output_file', type=str, help='Path to the output .tif file.')
+    parser.add_argument('--input_files', type=str, nargs='+', required=True, help='Yearly .tif files, in chronological order.')
+    parser.add_argument('--years', type=str, nargs='+', default=None, help='Year labels of the input files. Defaults to their names.')
+    parser.add_argument('--grid_size', type=int, default=200, help='Grid size in pixels. Default is 200 (for a 6km grid with 30m pixels).')
+    parser.add_argument('--strip_cells', type=int, default=4, help='Height of the strips read at once, in grid cells.')
+
+    args = parser.parse_args()
+
+    process_years(args.input_files, args.output_file, args.grid_size, args.years, args.strip_cells)
+
+if __name__ == '__main__':
+    main()
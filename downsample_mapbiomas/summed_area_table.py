@@ -0,0 +1,254 @@
+import os
+import sys
+import json
+import argparse
+import numpy as np
+import rasterio
+from rasterio.transform import Affine
+from tqdm import tqdm
+
+# Shared window planner lives with the data pipeline scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_pipeline', 'scripts'))
+from windows import windowed_imap
+from downsample import PixelClass, class_lut, classify
+from edge_density import read_strip, strip_edges
+
+# JSON sidecar describing the layers of a summed-area table directory
+SAT_META_FILE = 'sat.json'
+
+def cell_sums(values, cell_size):
+    """
+    Sum a 2D array over cell_size x cell_size cells, the partial cells at the edges included.
+
+    Args:
+        values (np.ndarray): Array of shape (rows, cols).
+        cell_size (int): Cell size in pixels.
+
+    Returns:
+        np.ndarray: uint32 array of shape (ceil(rows / cell_size), ceil(cols / cell_size)).
+    """
+    rows, cols = -(-values.shape[0] // cell_size), -(-values.shape[1] // cell_size)
+    padded = np.zeros((rows * cell_size, cols * cell_size), dtype=values.dtype)
+    padded[:values.shape[0], :values.shape[1]] = values
+    return padded.reshape(rows, cell_size, cols, cell_size).sum(axis=(1, 3), dtype=np.uint32)
+
+def layer_names(pixel_classes, edge_classes):
+    """
+    Get the layer names of a table: one count layer per pixel class and one edge layer per edge class.
+    """
+    return [c.value for c in pixel_classes] + [f'edge_{c.value}' for c in edge_classes]
+
+def strip_cell_counts(args):
+    """
+    Count the pixels of every class and the class edges in each cell of one strip of a raster.
+
+    The strip is read with a one-row halo above and below it, so edges between strips are exact.
+
+    Args:
+        args (tuple): (raster file, first row, number of rows, lookup table, number of pixel classes,
+            bit indexes of the edge classes in the lookup table, cell size).
+
+    Returns:
+        tuple: (first row, uint32 array of shape (layers, cell rows, cell cols)).
+    """
+    raster_file, row_off, num_rows, lut, num_classes, edge_bits, cell_size = args
+    with rasterio.open(raster_file) as src:
+        data, core = read_strip(src, row_off, num_rows)
+
+    classes = classify(data, lut)
+    layers = [cell_sums((classes[core] >> k) & 1, cell_size) for k in range(num_classes)]
+    for k in edge_bits:
+        layers.append(cell_sums(strip_edges(((classes >> k) & 1).astype(bool), core), cell_size))
+    return row_off, np.stack(layers)
+
+def build_summed_area_table(raster_file, output_dir, pixel_classes, edge_classes=(), cell_size=10, strip_cells=64):
+    """
+    Build the summed-area tables of the class counts and class edge counts of a raster.
+
+    Each layer is stored as a memory-mappable uint32 .npy of shape (cell rows + 1, cell cols + 1),
+    where entry [i, j] is the count over cells [0, i) x [0, j), modulo 2 ** 32. Window sums are
+    differences of four entries, so the wraparound cancels out for any window whose count fits
+    in 32 bits, whatever the size of the raster.
+
+    Args:
+        raster_file (str): Path to the MapBiomas raster (.tif).
+        output_dir (str): Directory of the tables and their sat.json sidecar.
+        pixel_classes (list): Pixel classes to count.
+        edge_classes (list): Pixel classes whose edges (see edge_density.py) to count.
+        cell_size (int): Resolution of the tables in pixels; windows are answered in whole cells.
+        strip_cells (int): Height of the strips read at once, in cells.
+
+    Returns:
+        SummedAreaTable: The built tables.
+    """
+    all_classes = list(dict.fromkeys([*pixel_classes, *edge_classes]))
+    lut = class_lut(all_classes)
+    edge_bits = [all_classes.index(c) for c in edge_classes]
+    names = layer_names(pixel_classes, edge_classes)
+
+    with rasterio.open(raster_file) as src:
+        height, width, crs, transform = src.height, src.width, src.crs, src.transform
+    cell_rows, cell_cols = -(-height // cell_size), -(-width // cell_size)
+
+    os.makedirs(output_dir, exist_ok=True)
+    tables = [np.lib.format.open_memmap(os.path.join(output_dir, f'{name}.npy'), mode='w+', dtype=np.uint32,
+                                        shape=(cell_rows + 1, cell_cols + 1)) for name in names]
+    for table in tables:
+        table[0] = 0
+        table[:, 0] = 0
+
+    strip_rows = cell_size * strip_cells
+    tasks = [(raster_file, row, min(strip_rows, height - row), lut, len(pixel_classes), edge_bits, cell_size)
+             for row in range(0, height, strip_rows)]
+    for row_off, counts in tqdm(windowed_imap(strip_cell_counts, tasks), total=len(tasks),
+                                desc=f"Building summed-area tables of {raster_file}"):
+        first = row_off // cell_size
+        # Prefix sums along the columns, then along the rows starting from the last row of the previous strip
+        prefix = np.cumsum(np.cumsum(counts, axis=2, dtype=np.uint32), axis=1, dtype=np.uint32)
+        for table, layer in zip(tables, prefix):
+            table[first + 1:first + 1 + layer.shape[0], 1:] = layer + table[first, 1:]
+
+    for table in tables:
+        table.flush()
+    del tables
+
+    meta = {
+        'source': os.path.abspath(raster_file),
+        'height': height,
+        'width': width,
+        'cell_size': cell_size,
+        'crs': crs.to_wkt() if crs else None,
+        'transform': list(transform)[:6],
+        'layers': names,
+    }
+    with open(os.path.join(output_dir, SAT_META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return SummedAreaTable(output_dir)
+
+class SummedAreaTable:
+    """Memory-mapped summed-area tables of a raster, answering window counts in O(1)."""
+
+    def __init__(self, directory):
+        """
+        Args:
+            directory (str): Directory written by `build_summed_area_table`.
+        """
+        with open(os.path.join(directory, SAT_META_FILE)) as f:
+            self.meta = json.load(f)
+        self.cell_size = self.meta['cell_size']
+        self.height, self.width = self.meta['height'], self.meta['width']
+        self.tables = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+                       for name in self.meta['layers']}
+
+    @property
+    def transform(self):
+        return Affine(*self.meta['transform'])
+
+    def window_pixels(self, row0, col0, row1, col1):
+        """
+        Count the raster pixels of windows given in cells, the windows at the edges being partial.
+
+        Args:
+            row0, col0, row1, col1: Cell bounds [row0, row1) x [col0, col1), as ints or arrays.
+
+        Returns:
+            Number of pixels, as an int or int64 array.
+        """
+        c = self.cell_size
+        rows = np.minimum(np.asarray(row1) * c, self.height) - np.asarray(row0) * c
+        cols = np.minimum(np.asarray(col1) * c, self.width) - np.asarray(col0) * c
+        return rows.astype(np.int64) * cols
+
+    def window_sum(self, layer, row0, col0, row1, col1):
+        """
+        Get the count of a layer over a window of cells [row0, row1) x [col0, col1).
+
+        Args:
+            layer (str): Layer name, e.g. 'forest_cover' or 'edge_forest_cover'.
+            row0, col0, row1, col1 (int): Cell bounds.
+
+        Returns:
+            int: The count.
+        """
+        corners = self.tables[layer][np.ix_([row0, row1], [col0, col1])]
+        # Unsigned array arithmetic wraps around, which cancels the wraparound of the table
+        return int((corners[1:, 1:] - corners[:1, 1:] - corners[1:, :1] + corners[:1, :1])[0, 0])
+
+    def grid(self, layer, grid_cells, offset=(0, 0), density=False):
+        """
+        Get the counts of a layer over a regular grid of non-overlapping windows, with one
+        vectorized lookup per grid corner.
+
+        Args:
+            layer (str): Layer name.
+            grid_cells (int): Window size in cells.
+            offset (tuple): (row, col) offset of the grid origin in cells, to shift the grid.
+            density (bool): Divide the counts by the number of pixels of each window.
+
+        Returns:
+            np.ndarray: int64 counts (or float64 densities) of the whole windows of the grid.
+        """
+        table = self.tables[layer]
+        rows = np.arange(offset[0], table.shape[0], grid_cells)
+        cols = np.arange(offset[1], table.shape[1], grid_cells)
+        corners = table[np.ix_(rows, cols)]
+        counts = (corners[1:, 1:] - corners[:-1, 1:] - corners[1:, :-1] + corners[:-1, :-1]).astype(np.int64)
+        if density:
+            return counts / self.window_pixels(rows[:-1, None], cols[None, :-1], rows[1:, None], cols[None, 1:])
+        return counts
+
+    def write_grid(self, output_file, layer, grid_cells, offset=(0, 0), density=False):
+        """
+        Write the grid of `grid` as a GeoTIFF aligned with the source raster.
+
+        Args:
+            output_file (str): Path to the output .tif file.
+            layer (str): Layer name.
+            grid_cells (int): Window size in cells.
+            offset (tuple): (row, col) offset of the grid origin in cells.
+            density (bool): Write densities instead of counts.
+        """
+        data = self.grid(layer, grid_cells, offset, density)
+        c = self.cell_size
+        transform = self.transform * Affine.translation(offset[1] * c, offset[0] * c) * Affine.scale(grid_cells * c)
+        with rasterio.open(output_file, 'w', driver='GTiff', height=data.shape[0], width=data.shape[1], count=1,
+                           dtype=data.dtype, crs=self.meta['crs'], transform=transform) as dst:
+            dst.write(data, 1)
+            dst.descriptions = (layer,)
+
+def main():
+    parser = argparse.ArgumentParser(description='Build and query summed-area tables of MapBiomas class counts.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build = subparsers.add_parser('build', help='Build the tables of a raster.')
+    build.add_argument('input_file', type=str, help='Path to the input .tif file.')
+    build.add_argument('output_dir', type=str, help='Directory of the tables.')
+    build.add_argument('--pixel-class', type=str, nargs='+', default=[x.value for x in PixelClass],
+                       choices=[x.value for x in PixelClass], help='Pixel classes to count.')
+    build.add_argument('--edge-class', type=str, nargs='*', default=[PixelClass.FOREST_COVER.value],
+                       choices=[x.value for x in PixelClass], help='Pixel classes whose edges to count.')
+    build.add_argument('--cell_size', type=int, default=10, help='Resolution of the tables in pixels.')
+    build.add_argument('--strip_cells', type=int, default=64, help='Height of the strips read at once, in cells.')
+
+    grid = subparsers.add_parser('grid', help='Write the counts or densities of a layer over a grid.')
+    grid.add_argument('table_dir', type=str, help='Directory of the tables.')
+    grid.add_argument('output_file', type=str, help='Path to the output .tif file.')
+    grid.add_argument('--layer', type=str, required=True, help="Layer name, e.g. 'deforestation' or 'edge_forest_cover'.")
+    grid.add_argument('--grid_size', type=int, default=200, help='Grid size in pixels, a multiple of the cell size.')
+    grid.add_argument('--offset', type=int, nargs=2, default=[0, 0], help='Row and column offset of the grid in pixels.')
+    grid.add_argument('--density', action='store_true', help='Write the count divided by the window pixels.')
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build_summed_area_table(args.input_file, args.output_dir, [PixelClass(c) for c in args.pixel_class],
+                                [PixelClass(c) for c in args.edge_class], args.cell_size, args.strip_cells)
+    else:
+        sat = SummedAreaTable(args.table_dir)
+        if args.grid_size % sat.cell_size or any(o % sat.cell_size for o in args.offset):
+            parser.error(f"Grid size and offsets must be multiples of the cell size {sat.cell_size}")
+        sat.write_grid(args.output_file, args.layer, args.grid_size // sat.cell_size,
+                       tuple(o // sat.cell_size for o in args.offset), args.density)
+
+if __name__ == '__main__':
+    main()
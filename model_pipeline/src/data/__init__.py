@@ -1 +1,5 @@
-from .dataloader import get_dataloaders
\ No newline at end of file
+from .dataloader import (
+    get_dataloaders,
+    ablation_batch,
+)
+from .normalization import get_normalizer
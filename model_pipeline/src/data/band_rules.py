@@ -0,0 +1,53 @@
+import os.path as osp
+import pickle
+
+# Per-band rules of the tiler, by 1-based band number of the 26-band datacube. They mirror
+# data_pipeline/scripts/band_transforms.py and must be kept in sync with it.
+BINARIZE_BANDS = range(7, 10)
+PASSTHROUGH_BANDS = list(range(7, 13)) + list(range(19, 26))
+FILL_ZERO_BANDS = range(13, 16)
+LOG1P_BANDS = [1, 2, 3, 26]
+
+# Single statistics artifact written by calculate_global_stats.py --multiband
+GLOBAL_STATS_FILE = "global_stats.pkl"
+
+
+def load_band_stats(band_name, pickle_dir):
+    """
+    Loads the cached global statistics of a band, as cut_tiles.cache_global_stats does
+
+    Args:
+        band_name (str): Band name, i.e. its 1-based datacube band number
+        pickle_dir (str): Directory of the global statistics written by calculate_global_stats.py
+
+    Returns:
+        tuple: Statistics (mean, std, min, max, ...) of the band
+
+    Raises:
+        FileNotFoundError: If pickle_dir holds no statistics for the band
+    """
+    band_file = osp.join(pickle_dir, f"{band_name}.pkl")
+    if osp.exists(band_file):
+        with open(band_file, "rb") as f:
+            return pickle.load(f)
+    global_file = osp.join(pickle_dir, GLOBAL_STATS_FILE)
+    if osp.exists(global_file):
+        with open(global_file, "rb") as f:
+            global_stats = pickle.load(f)
+        if band_name in global_stats:
+            return global_stats[band_name]
+    raise FileNotFoundError(f"No cached data found for band {band_name} in directory {pickle_dir}")
+
+
+def load_global_stats(pickle_dir, bands):
+    """
+    Loads the cached global statistics of datacube bands
+
+    Args:
+        pickle_dir (str): Directory of the global statistics written by calculate_global_stats.py
+        bands (list): 1-based datacube bands
+
+    Returns:
+        dict: Statistics (mean, std, min, max, ...) by band name
+    """
+    return {str(band): load_band_stats(str(band), pickle_dir) for band in bands}
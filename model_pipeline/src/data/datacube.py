@@ -0,0 +1,76 @@
+import os
+import math
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from tqdm import tqdm
+
+
+def window_name(row, col):
+    """Returns the name of the window at the given pixel offset, as given to save_prediction"""
+    return f"window_{row}_{col}.tif"
+
+
+def parse_window_name(name, size):
+    """Returns the rasterio Window of a name built by window_name"""
+    row, col = (int(part) for part in os.path.splitext(name)[0].split("_")[1:])
+    return Window(col, row, size, size)
+
+
+def window_origins(height, width, patch_size, stride):
+    """Returns the (row, col) pixel offsets of the whole patch_size windows on a stride grid, as an (N, 2) array"""
+    rows, cols = np.arange(0, height - patch_size + 1, stride), np.arange(0, width - patch_size + 1, stride)
+    return np.stack(np.meshgrid(rows, cols, indexing="ij"), axis=-1).reshape(-1, 2)
+
+
+def window_counts(y_file, num_years, patch_size, stride, strip_rows=1024):
+    """
+    Counts the deforested and labelled pixels of every patch_size window on a stride grid of a
+    label raster, in one strip-wise pass
+
+    The raster is reduced to cells of gcd(patch_size, stride) pixels, whose summed-area table
+    gives the count of any window. A pixel is deforested if it is 1 in any of the first
+    num_years bands, and labelled if it is neither -1 nor nodata in one of them.
+
+    Args:
+        y_file (str): Label raster, on the grid of the datacube
+        num_years (int): Number of label bands
+        patch_size (int): Window size in pixels
+        stride (int): Distance between window origins in pixels
+        strip_rows (int, optional): Approximate height of the strips read at once. Defaults to 1024.
+
+    Returns:
+        tuple: (origins, positives, labelled): int64 arrays of shape (N, 2) with the (row, col)
+        pixel offset of each window, and of shape (N,) with its counts
+    """
+    cell = math.gcd(patch_size, stride)
+    with rasterio.open(y_file) as src:
+        height, width, nodata = src.height, src.width, src.nodata
+        rows, cols = height // cell, width // cell
+        positives = np.zeros((rows + 1, cols + 1), dtype=np.int64)
+        labelled = np.zeros((rows + 1, cols + 1), dtype=np.int64)
+
+        step = cell * max(1, strip_rows // cell)
+        for row_off in tqdm(range(0, rows * cell, step), desc="Counting labels of the windows"):
+            num_rows = min(step, rows * cell - row_off)
+            labels = src.read(list(range(1, num_years + 1)), window=Window(0, row_off, cols * cell, num_rows))
+            valid = labels != -1
+            if nodata is not None:
+                valid &= labels != nodata
+            first = row_off // cell + 1
+            for counts, mask in ((positives, (labels == 1).any(axis=0)), (labelled, valid.any(axis=0))):
+                counts[first:first + num_rows // cell, 1:] = (
+                    mask.reshape(num_rows // cell, cell, cols, cell).sum(axis=(1, 3)))
+
+    for counts in (positives, labelled):
+        np.cumsum(counts, axis=0, out=counts)
+        np.cumsum(counts, axis=1, out=counts)
+
+    origins = window_origins(height, width, patch_size, stride)
+    r0, c0 = origins[:, 0] // cell, origins[:, 1] // cell
+    r1, c1 = r0 + patch_size // cell, c0 + patch_size // cell
+
+    def window_sums(sat):
+        return sat[r1, c1] - sat[r0, c1] - sat[r1, c0] + sat[r0, c0]
+
+    return origins, window_sums(positives), window_sums(labelled)
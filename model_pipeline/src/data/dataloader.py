@@ -1,23 +1,81 @@
+import os
 import torch
-import rasterio
 import glob
+import rasterio
+import numpy as np
 import os.path as osp
 from tqdm import tqdm
+from rasterio.windows import Window
 from torch.utils.data import Dataset, DataLoader, random_split
 
+from .tile_store import TileStore
+from .manifest import load_manifest, default_manifest_path
+from .tile_cache import TileCache
+from .tile_reader import get_reader, worker_init_fn
+from .datacube import window_name, window_origins, window_counts
+from .band_rules import load_global_stats
+from .normalization import BandNormalizer
+
+
+def ablation_batch(x, data_description):
+    """Creates batch of images with one feature replaced by its baseline value in each, after the original image"""
+    layer_num = 0
+    batch = torch.zeros((len(data_description)+1, *x.shape), dtype=x.dtype, device=x.device)
+    batch[0] = x.clone()
+    for i, layer in enumerate(data_description):
+        x_copy = x.clone()
+        for j in range(layer[1]):
+            x_copy[layer_num+j] = layer[2+j]
+        batch[i+1] = x_copy
+        layer_num += layer[1]
+    return batch
+
 
 class Biomass_Dataset(Dataset):
     """Custom dataset class for the data of a single participant."""
 
-    def __init__(self, x_path, y_path=None, return_info=False, num_years=1, feature_ablation=False, data_description=None): 
-        """Constructor function to initiate the dataset object."""
+    def __init__(self, x_path, y_path=None, return_info=False, num_years=1, feature_ablation=False, data_description=None,
+                 manifest=True, manifest_path=None, max_open_files=64, preload=False, preload_dir=None,
+                 preload_dtype="float16", preload_budget_mb=None):
+        """
+        Constructor function to initiate the dataset object.
+
+        With manifest (default), the file list, tile shapes and ground truth positives are loaded
+        from a cached manifest (see manifest.py), rebuilt only when the tile directories changed.
+        Tiles are read through the TileReader of the process (see tile_reader.py), which keeps up
+        to max_open_files tiles open.
+
+        With preload, the tiles are decoded once into a memory-mapped preload_dtype array (see
+        tile_cache.py) stored in preload_dir (default: next to the manifest) and shared by the
+        dataloader workers. Tiles beyond preload_budget_mb are read from disk.
+        """
         self.x_path = x_path
         self.y_path = y_path
         self.return_info = return_info
         self.num_years = num_years
         self.feature_ablation = feature_ablation
         self.band_stats = data_description
-        
+        self.max_open_files = max_open_files
+        self.manifest = None
+        self.cache = None
+
+        if preload and not manifest:
+            raise ValueError("Preloading tiles requires the dataset manifest")
+
+        if manifest:
+            self.manifest = load_manifest(x_path, y_path, manifest_path)
+            keep = self.manifest["has_label"] if self.y_path is not None else slice(None)
+            self.files = self.manifest["files"][keep].tolist()
+            self.shapes = self.manifest["shapes"][keep]
+            self.positives = self.manifest["positives"][keep]
+            if preload:
+                cache_path = default_manifest_path(x_path, y_path).replace(".npz", f".preload-{preload_dtype}.npy")
+                if preload_dir is not None:
+                    cache_path = osp.join(preload_dir, osp.basename(cache_path))
+                self.cache = TileCache(cache_path, x_path, self.files, self.shapes, self.manifest["fingerprint"],
+                                       y_path, num_years, preload_dtype, preload_budget_mb)
+            return
+
         # Get file names of all the files in the directory ending in *.tif
         self.files = []
         for file in tqdm(glob.glob(osp.join(self.x_path, "*.tif"))):
@@ -30,39 +88,201 @@ class Biomass_Dataset(Dataset):
     def __len__(self):
         return len(self.files)
 
+    def read_x(self, idx):
+        """Reads the input tile at the given index as a float32 tensor, decoding compact encodings"""
+        if self.cache is not None and idx in self.cache:
+            return self.cache.read_x(idx)
+        return get_reader(self.max_open_files).read(osp.join(self.x_path, self.files[idx]))
+
+    def read_y(self, idx):
+        """Reads the ground truth bands of the tile at the given index as a float32 tensor"""
+        if self.cache is not None and idx in self.cache:
+            return self.cache.read_y(idx, self.num_years)
+        return get_reader(self.max_open_files).read(osp.join(self.y_path, self.files[idx]),
+                                                    range(1, self.num_years + 1))
+
+    def tile_layout(self):
+        """
+        Returns the datacube bands of the tile channels and their transform ("raw" or "processed"),
+        as recorded by cut_tiles.py in the band descriptions and TRANSFORM tag of the tiles; None
+        for what older tiles do not record
+        """
+        with rasterio.open(osp.join(self.x_path, self.files[0])) as src:
+            descriptions, transform = src.descriptions, src.tags().get("TRANSFORM")
+        bands = [int(d) for d in descriptions] if all(d and d.isdigit() for d in descriptions) else None
+        return bands, transform
+
+    def close(self):
+        """Closes the tiles kept open by the reader of this process"""
+        get_reader(self.max_open_files).close()
+
     def __getitem__(self, idx):
-        x = rasterio.open(osp.join(self.x_path, self.files[idx])).read()
-        x = torch.from_numpy(x).float()
+        y = self.read_y(idx) if self.y_path is not None else None
+        return self.make_sample(self.read_x(idx), y, self.files[idx])
+
+    def make_sample(self, x, y, name):
+        """Builds the sample returned by the dataset from an input tile, its ground truth (or None) and its name"""
+        x = torch.as_tensor(x, dtype=torch.float32)
 
-        # Create batch of images with one band missing
         if self.feature_ablation:
-            layer_num = 0
-            batch = torch.zeros((len(self.band_stats)+1, *x.shape))
-            batch[0] = x.clone()
-            for i, layer in enumerate(self.band_stats):
-                x_copy = x.clone()
-                for j in range(layer[1]):
-                    x_copy[layer_num+j] = layer[2+j]
-                batch[i+1] = x_copy
-                layer_num += layer[1]
-            x = batch
-
-        y = torch.zeros(1)
-        if self.y_path is not None:
-            y = rasterio.open(osp.join(self.y_path, self.files[idx]))
-            y = y.read([i for i in range(1, self.num_years + 1)])
-            y = torch.from_numpy(y).float()
+            x = ablation_batch(x, self.band_stats)
+
+        y = torch.zeros(1) if y is None else torch.as_tensor(y, dtype=torch.float32)
 
         if self.return_info:
-            return x, y, self.files[idx]
+            return x, y, name
         else:
             return x, y
 
 
+class Sharded_Dataset(Biomass_Dataset):
+    """Dataset reading input tiles from a sharded tile store (cut_tiles.py --output_format shards)."""
+
+    def __init__(self, x_path, y_path=None, return_info=False, num_years=1, feature_ablation=False, data_description=None,
+                 manifest=True, manifest_path=None, max_open_files=64, preload=False, preload_dir=None,
+                 preload_dtype="float16", preload_budget_mb=None):
+        """
+        Constructor function to initiate the dataset object. y_path may be a tile store or a directory of tiles.
+        The store index already lists the tiles, so manifest and manifest_path are not used, and the
+        shards are already memory-mapped, so the preload options are not used either.
+        """
+        self.x_path = x_path
+        self.y_path = y_path
+        self.return_info = return_info
+        self.num_years = num_years
+        self.feature_ablation = feature_ablation
+        self.band_stats = data_description
+        self.max_open_files = max_open_files
+        self.cache = None
+
+        self.x_store = TileStore(x_path)
+        self.y_store = TileStore(y_path) if TileStore.is_store(y_path) else None
+
+        # Keep the tiles which have a ground truth, listing a ground truth directory once
+        if self.y_path is None:
+            labelled = None
+        elif self.y_store is not None:
+            labelled = self.y_store.positions
+        else:
+            labelled = set(os.listdir(self.y_path))
+        self.files = [file for file in self.x_store.names if labelled is None or file in labelled]
+
+    def tile_layout(self):
+        """Returns the datacube bands of the tile channels and their transform, from the store metadata"""
+        return self.x_store.meta.get("bands"), self.x_store.meta.get("transform")
+
+    def read_x(self, idx):
+        return self.x_store.read(self.files[idx])
+
+    def read_y(self, idx):
+        if self.y_store is None:
+            return super().read_y(idx)
+        return self.y_store.read(self.files[idx])[:self.num_years]
+
+
+class Datacube_Dataset(Biomass_Dataset):
+    """Dataset reading windows directly from a multi-band datacube and its label raster, without cut tiles."""
+
+    def __init__(self, x_path, y_path=None, return_info=False, num_years=1, feature_ablation=False, data_description=None,
+                 patch_size=256, stride=None, sampling="grid", samples_per_epoch=None, positive_weight=10.0,
+                 bands=None, pickle_dir=None, max_open_files=64):
+        """
+        Constructor function to initiate the dataset object. x_path is the datacube and y_path the
+        label raster on the same grid.
+
+        Windows of patch_size pixels are taken on a grid of origins stride pixels apart (default:
+        patch_size), keeping only windows with labelled pixels when y_path is given. With sampling
+        "grid", the dataset holds every such window. With "random", each sample is a window drawn
+        with weight positive_weight if it contains deforestation and 1 otherwise, its origin
+        jittered by up to stride pixels; an epoch holds samples_per_epoch samples (default: the
+        number of windows).
+
+        bands are the 1-based datacube bands read (default: all). With pickle_dir, the windows are
+        transformed like cut_tiles.py tiles using the global statistics cached there.
+        """
+        if sampling not in ("grid", "random"):
+            raise ValueError(f"Unknown sampling {sampling}, expected 'grid' or 'random'")
+        self.x_path = x_path
+        self.y_path = y_path
+        self.return_info = return_info
+        self.num_years = num_years
+        self.feature_ablation = feature_ablation
+        self.band_stats = data_description
+        self.max_open_files = max_open_files
+        self.cache = None
+        self.patch_size = patch_size
+        self.stride = stride or patch_size
+        self.sampling = sampling
+
+        with rasterio.open(x_path) as src:
+            self.height, self.width = src.height, src.width
+            self.bands = list(bands) if bands is not None else list(src.indexes)
+        self.normalizer = None
+        if pickle_dir is not None:
+            self.normalizer = BandNormalizer(self.bands, load_global_stats(pickle_dir, self.bands))
+
+        if y_path is not None:
+            self.origins, positives, labelled = window_counts(y_path, num_years, patch_size, self.stride)
+            keep = labelled > 0
+            self.origins, self.positives = self.origins[keep], positives[keep]
+            weights = np.where(self.positives > 0, positive_weight, 1.0)
+        else:
+            self.origins = window_origins(self.height, self.width, patch_size, self.stride)
+            self.positives = np.zeros(len(self.origins), dtype=np.int64)
+            weights = np.ones(len(self.origins))
+        # Cumulative weights, so a window is drawn by one binary search instead of a pass over all windows
+        self.cum_weights = np.cumsum(weights)
+        self.samples_per_epoch = samples_per_epoch or len(self.origins)
+        self.files = [window_name(row, col) for row, col in self.origins]
+
+    def __len__(self):
+        return len(self.origins) if self.sampling == "grid" else self.samples_per_epoch
+
+    def tile_layout(self):
+        """Returns the datacube bands read and whether the windows are transformed with pickle_dir"""
+        return self.bands, "raw" if self.normalizer is None else "processed"
+
+    def window(self, idx):
+        """Returns the (row, col) origin of a sample, drawn from the torch RNG (seeded per worker) when sampling randomly"""
+        if self.sampling == "grid":
+            return tuple(int(v) for v in self.origins[idx])
+        target = float(torch.rand(1, dtype=torch.float64)) * self.cum_weights[-1]
+        k = min(int(np.searchsorted(self.cum_weights, target, side="right")), len(self.cum_weights) - 1)
+        row, col = self.origins[k]
+        jitter = torch.randint(0, self.stride, (2,))
+        return (min(int(row + jitter[0]), self.height - self.patch_size),
+                min(int(col + jitter[1]), self.width - self.patch_size))
+
+    def read_window(self, path, indexes, row, col):
+        """Reads a window of a raster through the handles kept open by the reader of this process"""
+        src = get_reader(self.max_open_files).handles.get(path)
+        out = torch.empty((len(indexes), self.patch_size, self.patch_size), dtype=torch.float32)
+        src.read(indexes, window=Window(col, row, self.patch_size, self.patch_size), out=out.numpy())
+        return out
+
+    def __getitem__(self, idx):
+        row, col = self.window(idx)
+        x = self.read_window(self.x_path, self.bands, row, col)
+        if self.normalizer is not None:
+            x = self.normalizer(x)
+        y = None
+        if self.y_path is not None:
+            y = self.read_window(self.y_path, list(range(1, self.num_years + 1)), row, col)
+        return self.make_sample(x, y, window_name(row, col))
+
+
+def get_dataset_class(args):
+    """Returns the dataset class for the configured data format ("tif", "shards" or "datacube")"""
+    return {
+        "shards": Sharded_Dataset,
+        "datacube": Datacube_Dataset,
+    }.get(args["data"].get("format", "tif"), Biomass_Dataset)
+
+
 def get_dataloaders(args):
 
     if args["engine"]["mode"] == "train":
-        trainval_dataset = Biomass_Dataset(
+        trainval_dataset = get_dataset_class(args)(
             **args["data"]["dataset"],
             num_years = args["modelling"]["model"]["out_channels"]
         )
@@ -70,27 +290,28 @@ def get_dataloaders(args):
         train_size = len(trainval_dataset) - val_size
         train_dataset, val_dataset = random_split(trainval_dataset, [train_size, val_size])
         return {
-            "train": DataLoader(train_dataset, **args["data"]["dataloader"]),
-            "val": DataLoader(val_dataset, **args["data"]["dataloader"]),
+            "train": DataLoader(train_dataset, worker_init_fn=worker_init_fn, **args["data"]["dataloader"]),
+            "val": DataLoader(val_dataset, worker_init_fn=worker_init_fn, **args["data"]["dataloader"]),
         }
 
     elif args["engine"]["mode"] == "test":
-        test_dataset = Biomass_Dataset(
+        test_dataset = get_dataset_class(args)(
             **args["data"]["dataset"],
             num_years = args["modelling"]["model"]["out_channels"]
         )
         return {
-            "test": DataLoader(test_dataset, **args["data"]["dataloader"]),
+            "test": DataLoader(test_dataset, worker_init_fn=worker_init_fn, **args["data"]["dataloader"]),
         }
 
     elif args["engine"]["mode"] == "feature_ablation":
-        test_dataset = Biomass_Dataset(
+        # Baselines are normalized values, so with raw tiles the engine ablates after normalizing
+        test_dataset = get_dataset_class(args)(
             **args["data"]["dataset"],
             num_years = args["modelling"]["model"]["out_channels"],
-            feature_ablation = True, 
+            feature_ablation = not args["data"].get("normalization"),
             data_description = args['data']['data_description']
         )
         args["data"]["dataloader"]["batch_size"] = 1
         return {
-            "test": DataLoader(test_dataset, **args["data"]["dataloader"])
+            "test": DataLoader(test_dataset, worker_init_fn=worker_init_fn, **args["data"]["dataloader"])
         }
\ No newline at end of file
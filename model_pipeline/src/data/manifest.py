@@ -0,0 +1,123 @@
+import os
+import os.path as osp
+import glob
+import hashlib
+import numpy as np
+import rasterio
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+
+MANIFEST_VERSION = 1
+
+
+def default_manifest_path(x_path, y_path=None):
+    """
+    Returns the default manifest path of a tile directory and ground truth directory: a file next
+    to the tile directory, since writing into it would change its fingerprint
+    """
+    y_key = hashlib.sha1(osp.abspath(y_path).encode()).hexdigest()[:8] if y_path is not None else "nolabel"
+    return f"{osp.normpath(x_path)}.manifest-{y_key}.npz"
+
+
+def directory_fingerprint(*paths):
+    """
+    Fingerprints tile directories with a few stat calls, without listing them
+
+    A directory's modification time changes whenever tiles are added, removed or renamed in it.
+    Tiles rewritten in place by cut_tiles.py append to the tiler's manifest parts, whose
+    modification times are included as well.
+
+    Args:
+        paths (str): Tile directories, or None
+
+    Returns:
+        str: Hex digest identifying the state of the directories
+    """
+    digest = hashlib.sha1(str(MANIFEST_VERSION).encode())
+    for path in paths:
+        if path is None:
+            digest.update(b"none")
+            continue
+        stat = os.stat(path)
+        digest.update(f"{osp.abspath(path)}:{stat.st_ino}:{stat.st_mtime_ns}".encode())
+        for part in sorted(glob.glob(osp.join(path, "manifest", "*.jsonl"))):
+            part_stat = os.stat(part)
+            digest.update(f"{part}:{part_stat.st_size}:{part_stat.st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+
+def _tile_entry(args):
+    """Reads the metadata of a tile and counts the deforested pixels of its ground truth"""
+    x_path, y_path, file = args
+    with rasterio.open(osp.join(x_path, file)) as src:
+        shape, dtype = (src.count, src.height, src.width), src.dtypes[0]
+
+    y_file = osp.join(y_path, file) if y_path is not None else None
+    if y_file is None or not osp.exists(y_file):
+        return shape, dtype, False, 0
+    with rasterio.open(y_file) as src:
+        return shape, dtype, True, int(np.count_nonzero(src.read() == 1))
+
+
+def build_manifest(x_path, y_path=None, num_threads=16):
+    """
+    Scans a tile directory and its ground truth directory
+
+    Tiles are opened on a thread pool, so the latency of a network filesystem is overlapped.
+
+    Args:
+        x_path (str): Directory of the input tiles
+        y_path (str, optional): Directory of the ground truth tiles. Defaults to None.
+        num_threads (int, optional): Number of tiles opened concurrently. Defaults to 16.
+
+    Returns:
+        dict: Arrays "files", "shapes" (N, 3), "dtypes", "has_label" and "positives" (deforested
+        pixels of the ground truth, over all its bands), and the "fingerprint" of the directories
+    """
+    fingerprint = directory_fingerprint(x_path, y_path)
+    files = sorted(osp.basename(file) for file in glob.glob(osp.join(x_path, "*.tif")))
+    with ThreadPoolExecutor(num_threads) as executor:
+        entries = list(tqdm(executor.map(_tile_entry, [(x_path, y_path, file) for file in files]),
+                            total=len(files), desc="Building dataset manifest"))
+
+    return {
+        "files": np.array(files, dtype=str),
+        "shapes": np.array([entry[0] for entry in entries], dtype=np.int64).reshape(-1, 3),
+        "dtypes": np.array([entry[1] for entry in entries], dtype=str),
+        "has_label": np.array([entry[2] for entry in entries], dtype=bool),
+        "positives": np.array([entry[3] for entry in entries], dtype=np.int64),
+        "fingerprint": fingerprint,
+    }
+
+
+def load_manifest(x_path, y_path=None, manifest_path=None, rebuild=False):
+    """
+    Loads the cached manifest of a tile directory, rebuilding it if the directories changed
+
+    Args:
+        x_path (str): Directory of the input tiles
+        y_path (str, optional): Directory of the ground truth tiles. Defaults to None.
+        manifest_path (str, optional): Path of the cached manifest. Defaults to default_manifest_path(x_path, y_path).
+        rebuild (bool, optional): Rebuild the manifest even if it is up to date. Defaults to False.
+
+    Returns:
+        dict: The manifest, see build_manifest
+    """
+    manifest_path = manifest_path or default_manifest_path(x_path, y_path)
+    fingerprint = directory_fingerprint(x_path, y_path)
+
+    if not rebuild and osp.exists(manifest_path):
+        with np.load(manifest_path) as cached:
+            if str(cached["fingerprint"]) == fingerprint:
+                return {key: cached[key] for key in cached.files}
+        print("Dataset manifest is stale, rebuilding it")
+
+    manifest = build_manifest(x_path, y_path)
+    try:
+        # Written under a temporary name and renamed, so concurrent runs never read a partial manifest
+        tmp_path = f"{manifest_path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, **manifest)
+        os.replace(tmp_path, manifest_path)
+    except OSError as e:
+        print(f"Could not cache the dataset manifest at {manifest_path}: {e}")
+    return manifest
@@ -0,0 +1,84 @@
+import numpy as np
+import torch
+
+from .band_rules import BINARIZE_BANDS, PASSTHROUGH_BANDS, FILL_ZERO_BANDS, LOG1P_BANDS, load_global_stats
+
+
+class BandNormalizer(torch.nn.Module):
+    """
+    Per-band transforms of cut_tiles.py applied to batches of raw tiles (cut_tiles.py --raw) on their device
+
+    The rules are those of band_rules.py, applied in the order of cut_tiles.py: NaN to zero,
+    binarization, zero-fill with the band mean, log1p and standardization with the global
+    statistics. Each rule is one masked tensor op over all the bands of a batch.
+    """
+
+    def __init__(self, bands, global_stats_dict):
+        """
+        Args:
+            bands (list): 1-based datacube bands of the tile channels, in channel order
+            global_stats_dict (dict): Statistics (mean, std, ...) by band name, see load_global_stats
+        """
+        super().__init__()
+        bands = np.asarray(list(bands))
+        means = np.array([global_stats_dict[str(band)][0] for band in bands], dtype=np.float64)
+        stds = np.array([global_stats_dict[str(band)][1] for band in bands], dtype=np.float64)
+        standardize = ~np.isin(bands, PASSTHROUGH_BANDS) & (stds != 0)
+
+        def channels(values, dtype=torch.float32):
+            return torch.as_tensor(np.asarray(values), dtype=dtype)[:, None, None]
+
+        self.register_buffer("binarize", channels(np.isin(bands, BINARIZE_BANDS), torch.bool))
+        self.register_buffer("fill_zero", channels(np.isin(bands, FILL_ZERO_BANDS), torch.bool))
+        self.register_buffer("fill_values", channels(means))
+        self.register_buffer("log1p", channels(np.isin(bands, LOG1P_BANDS), torch.bool))
+        self.register_buffer("means", channels(np.where(standardize, means, 0)))
+        self.register_buffer("inv_stds", channels(np.where(standardize, 1 / np.where(stds != 0, stds, 1), 1)))
+
+    def forward(self, x):
+        """
+        Args:
+            x (torch.Tensor): Raw tiles of shape (..., bands, rows, cols)
+
+        Returns:
+            torch.Tensor: Normalized float32 tiles of the same shape
+        """
+        x = torch.nan_to_num(x.float())
+        x = torch.where(self.binarize, (x > 0).float(), x)
+        x = torch.where(self.fill_zero & (x == 0), self.fill_values, x)
+        x = torch.where(self.log1p, torch.log1p(x), x)
+        return (x - self.means) * self.inv_stds
+
+
+def get_normalizer(args, dataset):
+    """
+    Returns the BandNormalizer of args["data"]["normalization"] on args["device"], or None when the
+    tiles were normalized by the tiler
+
+    The normalization section holds the "pickle_dir" of the global statistics. The datacube bands
+    of the tile channels are those recorded with the tiles (see tile_layout of the datasets), or
+    the "bands" of the section for tiles which do not record them.
+
+    Args:
+        args (dict): Configuration
+        dataset (torch.utils.data.Dataset): Dataset of the dataloader, possibly a random_split Subset
+
+    Raises:
+        ValueError: If the tiles are already normalized, or their bands are unknown
+    """
+    config = args["data"].get("normalization")
+    if not config:
+        return None
+
+    dataset = getattr(dataset, "dataset", dataset)
+    bands, transform = dataset.tile_layout()
+    if transform == "processed":
+        raise ValueError("The tiles are already normalized (cut without --raw, or a datacube with pickle_dir); "
+                         "remove data.normalization or use raw tiles")
+    if bands is None:
+        bands = config.get("bands")
+    elif config.get("bands") is not None and list(config["bands"]) != list(bands):
+        raise ValueError(f"normalization.bands {config['bands']} do not match the bands of the tiles {bands}")
+    if bands is None:
+        raise ValueError("The tiles do not record their datacube bands, set data.normalization.bands")
+    return BandNormalizer(bands, load_global_stats(config["pickle_dir"], bands)).to(args["device"])
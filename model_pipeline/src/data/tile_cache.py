@@ -0,0 +1,170 @@
+import os
+import json
+import zlib
+import os.path as osp
+import numpy as np
+import torch
+import rasterio
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+
+from .tile_store import decode_tile
+
+
+def _read_tile(args):
+    """Reads and decodes an input tile and the first bands of its ground truth"""
+    x_file, y_file, num_years = args
+    with rasterio.open(x_file) as src:
+        x = decode_tile(src.read(), src.scales, src.offsets)
+    if y_file is None:
+        return x, None
+    with rasterio.open(y_file) as src:
+        return x, src.read(list(range(1, num_years + 1)))
+
+
+def _fits(y_tile, dtype):
+    """Whether every value of a ground truth tile, nodata included, is stored exactly as dtype"""
+    if y_tile.size == 0 or np.can_cast(y_tile.dtype, dtype):
+        return True
+    info = np.iinfo(dtype)
+    return bool(y_tile.min() >= info.min and y_tile.max() <= info.max and np.array_equal(y_tile, np.round(y_tile)))
+
+
+class TileCache:
+    """
+    Decoded tiles preloaded into one memory-mapped array, shared by every dataloader worker
+
+    The array is a .npy file mapped by each process, so the workers and the datasets of a
+    random_split read the same pages instead of holding copies. Placing it in /dev/shm keeps it
+    in shared memory; elsewhere the page cache holds it once read. Ground truth is stored as int8,
+    or int16 when a value does not fit.
+    """
+
+    def __init__(self, path, x_path, files, shapes, fingerprint, y_path=None, num_years=1, dtype="float16",
+                 budget_mb=None, num_threads=16):
+        """
+        Loads the cache at path, building it if it is missing or was built from other tiles
+
+        Args:
+            path (str): Path of the cached input array; the ground truth and metadata are stored next to it
+            x_path (str): Directory of the input tiles
+            files (list): Tile file names, in dataset order
+            shapes (np.ndarray): Shapes (bands, rows, cols) of the tiles, from the dataset manifest
+            fingerprint (str): Fingerprint of the tile directories, from the dataset manifest
+            y_path (str, optional): Directory of the ground truth tiles. Defaults to None.
+            num_years (int, optional): Number of ground truth bands cached. Defaults to 1.
+            dtype (str, optional): Dtype of the cached inputs. Defaults to "float16".
+            budget_mb (float, optional): Memory budget of the cache in MB. Defaults to None (no limit).
+            num_threads (int, optional): Number of tiles read concurrently while building. Defaults to 16.
+        """
+        self.path = path
+        self.y_file = f"{osp.splitext(path)[0]}.y.npy"
+        self.meta_file = f"{osp.splitext(path)[0]}.json"
+
+        # The tiles of the most common shape fitting in the budget are cached, in dataset order; slots
+        # maps each dataset index to its position in the cache, or -1 for the tiles read from disk
+        shapes = np.asarray(shapes).reshape(-1, 3)
+        shape, cached = (0, 0, 0), np.zeros(0, dtype=np.int64)
+        if len(shapes):
+            unique, inverse, counts = np.unique(shapes, axis=0, return_inverse=True, return_counts=True)
+            shape = tuple(int(s) for s in unique[counts.argmax()])
+            cached = np.flatnonzero(inverse.ravel() == counts.argmax())
+        tile_bytes = np.prod(shape) * np.dtype(dtype).itemsize
+        if y_path is not None:
+            tile_bytes += num_years * shape[1] * shape[2]
+        if budget_mb is not None and tile_bytes:
+            cached = cached[:int(budget_mb * 2 ** 20 // tile_bytes)]
+        count = len(cached)
+        self.slots = np.full(len(files), -1, dtype=np.int64)
+        self.slots[cached] = np.arange(count)
+
+        self.meta = {
+            "fingerprint": str(fingerprint),
+            "files": len(files),
+            "count": count,
+            "tiles": zlib.crc32(cached.tobytes()),
+            "shape": list(shape),
+            "dtype": str(np.dtype(dtype)),
+            "num_years": num_years if y_path is not None else 0,
+        }
+        self.count = count
+
+        if self._load_meta() != self.meta:
+            self._build(x_path, [files[i] for i in cached], y_path, num_years, num_threads)
+        self.x = self.y = None
+
+    def _load_meta(self):
+        if not (osp.exists(self.meta_file) and osp.exists(self.path)):
+            return None
+        with open(self.meta_file) as f:
+            return json.load(f)
+
+    def _build(self, x_path, files, y_path, num_years, num_threads):
+        """Decodes the tiles into temporary arrays, renamed once complete so a partial cache is never used"""
+        pid = os.getpid()
+        x_tmp = f"{self.path}.{pid}.tmp"
+        x = np.lib.format.open_memmap(x_tmp, mode="w+", dtype=self.meta["dtype"],
+                                      shape=(self.count, *self.meta["shape"]))
+        y = None
+        if y_path is not None:
+            y_tmp = f"{self.y_file}.{pid}.tmp"
+            y = np.lib.format.open_memmap(y_tmp, mode="w+", dtype=np.int8,
+                                          shape=(self.count, num_years, *self.meta["shape"][1:]))
+
+        tasks = [(osp.join(x_path, file), osp.join(y_path, file) if y_path is not None else None, num_years)
+                 for file in files]
+        with ThreadPoolExecutor(num_threads) as executor:
+            for i, (x_tile, y_tile) in enumerate(tqdm(executor.map(_read_tile, tasks), total=len(tasks),
+                                                      desc=f"Preloading {len(tasks)} tiles")):
+                x[i] = x_tile
+                if y is not None:
+                    if not _fits(y_tile, y.dtype):
+                        if y.dtype == np.int16 or not _fits(y_tile, np.int16):
+                            raise ValueError(f"Ground truth of {tasks[i][1]} has values in "
+                                             f"[{y_tile.min()}, {y_tile.max()}], which int16 cannot store")
+                        y = self._widen_labels(y, y_tmp, i)
+                    y[i] = y_tile
+
+        x.flush()
+        del x
+        os.replace(x_tmp, self.path)
+        if y is not None:
+            y.flush()
+            del y
+            os.replace(y_tmp, self.y_file)
+        with open(self.meta_file, "w") as f:
+            json.dump(self.meta, f)
+
+    def _widen_labels(self, y, y_tmp, count):
+        """Copies the first count ground truth tiles of the int8 array y into a new int16 array at y_tmp"""
+        wide_tmp = f"{y_tmp}.int16"
+        wide = np.lib.format.open_memmap(wide_tmp, mode="w+", dtype=np.int16, shape=y.shape)
+        wide[:count] = y[:count]
+        del y
+        os.replace(wide_tmp, y_tmp)
+        return wide
+
+    def _open(self):
+        # Mapped lazily, so each worker maps the file itself instead of receiving a pickled copy
+        if self.x is None:
+            self.x = np.load(self.path, mmap_mode="r")
+            if self.meta["num_years"]:
+                self.y = np.load(self.y_file, mmap_mode="r")
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["x"] = state["y"] = None
+        return state
+
+    def __contains__(self, idx):
+        return self.slots[idx] >= 0
+
+    def read_x(self, idx):
+        """Returns the cached input tile at the given dataset index as a float32 tensor"""
+        self._open()
+        return torch.from_numpy(self.x[self.slots[idx]].astype(np.float32))
+
+    def read_y(self, idx, num_years):
+        """Returns the first num_years cached ground truth bands at the given dataset index as a float32 tensor"""
+        self._open()
+        return torch.from_numpy(self.y[self.slots[idx], :num_years].astype(np.float32))
@@ -0,0 +1,125 @@
+import numpy as np
+import torch
+import rasterio
+from collections import OrderedDict
+from multiprocessing import util
+
+# Reader of the current process, created by worker_init_fn in DataLoader workers or on first use
+_reader = None
+
+
+class HandleCache:
+    """Bounded LRU of open rasterio datasets."""
+
+    def __init__(self, max_open=64):
+        """
+        Args:
+            max_open (int, optional): Maximum number of datasets kept open. Defaults to 64.
+        """
+        self.max_open = max_open
+        self._handles = OrderedDict()
+
+    def get(self, path):
+        """Returns the open dataset of a path, opening it and closing the least recently used one if needed"""
+        src = self._handles.get(path)
+        if src is not None:
+            self._handles.move_to_end(path)
+            return src
+        src = rasterio.open(path)
+        self._handles[path] = src
+        if len(self._handles) > self.max_open:
+            _, oldest = self._handles.popitem(last=False)
+            oldest.close()
+        return src
+
+    def close(self):
+        """Closes every open dataset"""
+        while self._handles:
+            _, src = self._handles.popitem()
+            src.close()
+
+    def __len__(self):
+        return len(self._handles)
+
+
+class TileReader:
+    """Reads GeoTIFF tiles through a HandleCache into reused buffers, returning float32 tensors."""
+
+    def __init__(self, max_open=64):
+        """
+        Args:
+            max_open (int, optional): Maximum number of tiles kept open. Defaults to 64.
+        """
+        self.handles = HandleCache(max_open)
+        self._buffers = {}
+
+    def _buffer(self, shape, dtype):
+        key = (shape, dtype)
+        if key not in self._buffers:
+            self._buffers[key] = np.empty(shape, dtype=dtype)
+        return self._buffers[key]
+
+    def read(self, path, indexes=None):
+        """
+        Reads the bands of a tile, decoding compact encodings as tile_store.decode_tile does
+
+        Float32 tiles are read directly into the returned tensor; other tiles are read into a
+        buffer reused across calls and decoded into the returned tensor, so each sample
+        allocates only its output.
+
+        Args:
+            path (str): Path of the tile
+            indexes (list, optional): 1-based band indexes. Defaults to all bands.
+
+        Returns:
+            torch.Tensor: Float32 tensor of shape (bands, rows, cols)
+        """
+        src = self.handles.get(path)
+        indexes = list(indexes) if indexes is not None else list(src.indexes)
+        shape = (len(indexes), src.height, src.width)
+        scales = np.asarray([src.scales[i - 1] for i in indexes], dtype=np.float32)
+        offsets = np.asarray([src.offsets[i - 1] for i in indexes], dtype=np.float32)
+        dtype = np.dtype(src.dtypes[indexes[0] - 1])
+
+        out = torch.empty(shape, dtype=torch.float32)
+        data = out.numpy()
+        if dtype == np.float32:
+            src.read(indexes, out=data)
+        else:
+            buffer = self._buffer(shape, dtype)
+            src.read(indexes, out=buffer)
+            data[...] = buffer
+        if np.any(scales != 1) or np.any(offsets != 0):
+            data *= scales[:, None, None]
+            data += offsets[:, None, None]
+        return out
+
+    def close(self):
+        """Closes every open tile and releases the buffers"""
+        self.handles.close()
+        self._buffers.clear()
+
+
+def get_reader(max_open=64):
+    """Returns the TileReader of the current process, creating it on first use"""
+    global _reader
+    if _reader is None:
+        _reader = TileReader(max_open)
+        # Closes the handles when the process (e.g. a DataLoader worker) exits normally
+        util.Finalize(_reader, _reader.close, exitpriority=10)
+    return _reader
+
+
+def worker_init_fn(worker_id):
+    """
+    DataLoader worker_init_fn giving each worker its own TileReader
+
+    Handles inherited from the parent process are not shared with it: the worker starts with an
+    empty cache sized by the dataset's max_open_files.
+    """
+    global _reader
+    dataset = torch.utils.data.get_worker_info().dataset
+    # random_split wraps the dataset in a Subset
+    dataset = getattr(dataset, "dataset", dataset)
+    _reader = None
+    get_reader(getattr(dataset, "max_open_files", 64))
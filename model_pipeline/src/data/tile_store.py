@@ -0,0 +1,111 @@
+import os.path as osp
+import json
+import numpy as np
+
+
+def decode_tile(data, scales, offsets):
+    """
+    Decodes a tile stored with per-band scales and offsets (cut_tiles.py --encoding) to float32
+
+    Args:
+        data (np.ndarray): Stored array of shape (bands, rows, cols)
+        scales (sequence): Per-band scales
+        offsets (sequence): Per-band offsets
+
+    Returns:
+        np.ndarray: Float32 array; `data` itself if it needs no decoding
+    """
+    scales, offsets = np.asarray(scales, dtype=np.float32), np.asarray(offsets, dtype=np.float32)
+    if data.dtype == np.float32 and np.all(scales == 1) and np.all(offsets == 0):
+        return data
+    out = data.astype(np.float32)
+    out *= scales[:, None, None]
+    out += offsets[:, None, None]
+    return out
+
+
+class TileStore:
+    """Reader for the sharded tile stores written by cut_tiles.py --output_format shards."""
+
+    META_FILE = "store.json"
+    INDEX_FILE = "index.npz"
+
+    def __init__(self, path):
+        """
+        Load the metadata and index of a store. Shards are memory-mapped lazily on first access,
+        so every DataLoader worker maps them in its own process. Stores written with a compact
+        encoding hold one shard file per dtype group, which are decoded back to float32 on read.
+
+        Args:
+            path (str): Directory of the store
+        """
+        self.path = path
+        with open(osp.join(path, self.META_FILE)) as f:
+            self.meta = json.load(f)
+        with np.load(osp.join(path, self.INDEX_FILE)) as index:
+            self.index = {k: index[k] for k in index.files}
+        self._shards = {}
+
+        # Stores written before encodings were added hold a single float32 group
+        encoding = self.meta.get("encoding")
+        if encoding is None:
+            encoding = {
+                "scales": [1.0] * self.meta["num_bands"],
+                "offsets": [0.0] * self.meta["num_bands"],
+                "groups": [{"dtype": self.meta["dtype"], "bands": list(range(self.meta["num_bands"])),
+                            "shards": self.meta["shards"]}],
+            }
+        self.groups = encoding["groups"]
+        self.scales = np.asarray(encoding["scales"], dtype=np.float32)
+        self.offsets = np.asarray(encoding["offsets"], dtype=np.float32)
+        self.raw = (len(self.groups) == 1 and self.groups[0]["dtype"] == "float32"
+                    and np.all(self.scales == 1) and np.all(self.offsets == 0))
+
+        # Tiles are named like the GeoTIFF tiles so stores and tile directories can be matched
+        self.names = [f"tile_{i}_{j}.tif" for i, j in zip(self.index["row"], self.index["col"])]
+        self.positions = {name: k for k, name in enumerate(self.names)}
+
+    @staticmethod
+    def is_store(path):
+        """Checks whether a path is a sharded tile store"""
+        return path is not None and osp.exists(osp.join(path, TileStore.META_FILE))
+
+    def __len__(self):
+        return len(self.names)
+
+    def _shard(self, shard_num, group=0):
+        key = (shard_num, group)
+        if key not in self._shards:
+            # Copy-on-write mapping: reads are zero-copy and the returned views are writable
+            self._shards[key] = np.load(osp.join(self.path, self.groups[group]["shards"][shard_num]), mmap_mode="c")
+        return self._shards[key]
+
+    def read(self, name):
+        """
+        Returns a tile, as a zero-copy view for float32 stores
+
+        Args:
+            name (str): Name of the tile, e.g. "tile_12_34.tif"
+
+        Returns:
+            np.ndarray: Float32 array of shape (bands, tile_size, tile_size), backed by the memory-mapped
+            shard for float32 stores and decoded into a new array otherwise
+        """
+        k = self.positions[name]
+        shard_num, offset = int(self.index["shard"][k]), int(self.index["offset"][k])
+        if self.raw:
+            return self._shard(shard_num)[offset]
+
+        tile_size = self.meta["tile_size"]
+        tile = np.empty((self.meta["num_bands"], tile_size, tile_size), dtype=np.float32)
+        for g, group in enumerate(self.groups):
+            tile[group["bands"]] = self._shard(shard_num, g)[offset]
+        tile *= self.scales[:, None, None]
+        tile += self.offsets[:, None, None]
+        return tile
+
+    def __getstate__(self):
+        # Memory maps are not sent to DataLoader workers; each worker maps the shards itself
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
@@ -3,18 +3,24 @@ import os
 import pandas as pd
 from tqdm import tqdm
 from utility import create_feature_interpret_tiles
+from data import get_normalizer, ablation_batch
 
 
 def feature_ablation(args, dataloader, model, criterion):
 
     device = args['device']
+    normalizer = get_normalizer(args, dataloader.dataset)
 
     model.eval()
     with torch.no_grad():
         for batch in tqdm(dataloader):
 
             img, _, paths = batch
-            img = img.to(device).squeeze()
+            img = img.to(device)
+            if normalizer is not None:
+                # Raw tiles are ablated here, after normalization, as the baselines are normalized values
+                img = ablation_batch(normalizer(img)[0], args['data']['data_description'])
+            img = img.squeeze()
             out = model(img)
 
             y = out[0].unsqueeze(0)
@@ -2,11 +2,13 @@ import torch
 import os
 from tqdm import tqdm
 from utility import save_prediction
+from data import get_normalizer
 
 
 def test_engine(args, dataloader, model):
 
     device = args['device']
+    normalizer = get_normalizer(args, dataloader.dataset)
     if os.path.exists(args['logging']['pred_dir']) == False:
         os.makedirs(args['logging']['pred_dir'])
 
@@ -14,7 +16,9 @@ def test_engine(args, dataloader, model):
     with torch.no_grad():
         for batch in tqdm(dataloader):
             img, gt, paths = batch
-            img, gt = img.to(device), gt.to(device)
+            img, gt = img.to(device, non_blocking=True), gt.to(device, non_blocking=True)
+            if normalizer is not None:
+                img = normalizer(img)
             out = model(img)
             out = out.cpu().numpy()
             save_prediction(args, out, paths, args['modelling']['model']['out_channels'])
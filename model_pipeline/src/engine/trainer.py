@@ -7,6 +7,7 @@ from utility import (
     save_ckp,
     get_metrics,
 )
+from data import get_normalizer
 
 
 def train_engine(args, train_dataloader, val_dataloader, model, optimizer, criterion, start_epoch=0, start_itr=0, val_loss_min=float('inf')):
@@ -26,6 +27,7 @@ def train_engine(args, train_dataloader, val_dataloader, model, optimizer, crite
     """
     device = args['device']
     itr = start_epoch * len(train_dataloader)
+    normalizer = get_normalizer(args, train_dataloader.dataset)
 
     # If checkpoints directory does not exist, create it
     if not os.path.exists(args['logging']['ckp_dir']):
@@ -46,7 +48,9 @@ def train_engine(args, train_dataloader, val_dataloader, model, optimizer, crite
             optimizer.zero_grad()
             
             img, gt = train_batch
-            img, gt = img.to(device), gt.to(device)
+            img, gt = img.to(device, non_blocking=True), gt.to(device, non_blocking=True)
+            if normalizer is not None:
+                img = normalizer(img)
 
             # Forward pass
             out = model(img)
@@ -74,7 +78,7 @@ def train_engine(args, train_dataloader, val_dataloader, model, optimizer, crite
 
             if itr % args['engine']['evaluation_interval'] == 0 :
                 print("Evaluating on validation set")
-                val_loss = evaluate(args, val_dataloader, model, criterion, itr)
+                val_loss = evaluate(args, val_dataloader, model, criterion, itr, normalizer)
                 print("Validation Loss = {}".format(val_loss))
                 # Saving checkpoint if validation loss is minimum
                 if val_loss < val_loss_min:
@@ -90,7 +94,7 @@ def train_engine(args, train_dataloader, val_dataloader, model, optimizer, crite
                     save_ckp(args, model_checkpoint)
 
 
-def evaluate(args, dataloader, model, criterion, itr):
+def evaluate(args, dataloader, model, criterion, itr, normalizer=None):
     """
     Runs the model on the dataloader and returns the loss
 
@@ -99,6 +103,8 @@ def evaluate(args, dataloader, model, criterion, itr):
         dataloader (torch.utils.data.DataLoader): Dataloader to run the model on
         model (torch.nn.Module): Model to be evaluated
         criterion (torch.nn object): Loss function
+        itr (int): Iteration logged with the metrics
+        normalizer (BandNormalizer, optional): Normalization of raw tiles on the device. Defaults to None.
 
     Returns:
         _type_: _description_
@@ -112,7 +118,9 @@ def evaluate(args, dataloader, model, criterion, itr):
     with torch.no_grad():
         for val_batch in tqdm(dataloader):
             img, gt = val_batch
-            img, gt = img.to(device), gt.to(device)
+            img, gt = img.to(device, non_blocking=True), gt.to(device, non_blocking=True)
+            if normalizer is not None:
+                img = normalizer(img)
 
             # Forward pass
             out = model(img)
@@ -4,6 +4,7 @@ import wandb
 import rasterio
 import numpy as np
 from tqdm import tqdm
+from data.datacube import parse_window_name
 
 
 def initialise_wandb(args):
@@ -40,11 +41,25 @@ def load_ckp(checkpoint_fpath, model, optimizer):
 
 def save_prediction(args, pred, paths, num_bands=3):
     """Saves prediction to disk"""
+    x_path = args['data']['dataset']['x_path']
     for i in range(len(paths)):
-        src = rasterio.open(os.path.join(args['data']['dataset']['x_path'], paths[i]))
-        profile = src.profile
+        if os.path.isfile(x_path):
+            # Windows of a datacube (format "datacube") are georeferenced from their name
+            with rasterio.open(x_path) as src:
+                window = parse_window_name(paths[i], pred.shape[-1])
+                profile = src.profile
+                profile.update(
+                    height = window.height,
+                    width = window.width,
+                    transform = src.window_transform(window)
+                )
+        else:
+            with rasterio.open(os.path.join(x_path, paths[i])) as src:
+                profile = src.profile
+        # Input tiles may be stored with a compact integer encoding; predictions are float32
         profile.update(
-            count = num_bands
+            count = num_bands,
+            dtype = "float32"
         )
         with rasterio.open(os.path.join(args['logging']['pred_dir'], paths[i]), 'w', **profile) as dst:
             dst.write(pred[i])